@@ -0,0 +1,122 @@
+"""Recall and per-query latency of the ivf index against the exact scan.
+
+Embeddings are drawn around random cluster centers, since real text embeddings are
+far from uniformly distributed.
+
+    pdm run python -m bench.ivf --sizes 10000 100000
+"""
+
+import argparse
+import random
+import time
+from typing import List, Set
+
+import numpy as np
+from numpy.typing import NDArray
+
+from game.ti_retriever import TIRetriever
+from schema import GameStage, Memory, MemoryConfig
+
+
+def clustered_embeddings(
+    size: int, centers: NDArray[np.float64], rng: np.random.Generator
+) -> NDArray[np.float32]:
+    embeddings = centers[rng.choice(len(centers), size)]
+    embeddings += 0.5 * rng.standard_normal(embeddings.shape)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+
+def build_retriever(
+    embeddings: NDArray[np.float32], memory_config: MemoryConfig, seed: int
+) -> TIRetriever:
+    """Both retrievers need the same importances and timestamps, hence the seed."""
+    rand = random.Random(seed)
+    retriever = TIRetriever(memory_config)
+    for i, embedding in enumerate(embeddings):
+        # construct() skips validation, which would otherwise dominate setup time
+        retriever.add_memory(
+            Memory.construct(
+                importance=rand.randint(1, 10),
+                description=str(i),
+                embedding=embedding,
+                timestamp=GameStage(stage=rand.randint(0, 2)),
+            )
+        )
+    return retriever
+
+
+def search(retriever: TIRetriever, queries: List[Memory], top_k: int) -> List[Set[str]]:
+    return [
+        {memory.description for memory, _ in retriever.get_relevant_memories(q, top_k)}
+        for q in queries
+    ]
+
+
+def time_per_query(retriever: TIRetriever, queries: List[Memory], top_k: int) -> float:
+    start = time.perf_counter()
+    search(retriever, queries, top_k)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--lists", type=int, default=256)
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'memories':>10} {'index':>10} {'recall':>8} {'ms/query':>10} {'speedup':>8}"
+    )
+    for size in args.sizes:
+        centers = rng.standard_normal((args.clusters, args.dims))
+        embeddings = clustered_embeddings(size, centers, rng)
+        queries = [
+            Memory.construct(
+                description="query",
+                embedding=embedding,
+                timestamp=GameStage(stage=2),
+            )
+            for embedding in clustered_embeddings(args.queries, centers, rng)
+        ]
+
+        exact = build_retriever(
+            embeddings, MemoryConfig(embedding_dims=args.dims, max_memories=size), size
+        )
+        expected = search(exact, queries, args.top_k)
+        exact_time = time_per_query(exact, queries, args.top_k)
+        print(f"{size:>10} {'exact':>10} {1:>8.3f} {exact_time * 1000:>10.3f}")
+        del exact
+
+        ivf = build_retriever(
+            embeddings,
+            MemoryConfig(
+                embedding_dims=args.dims,
+                max_memories=size,
+                index="ivf",
+                ivf_lists=args.lists,
+                ivf_train_size=min(size, 8192),
+            ),
+            size,
+        )
+        for probes in args.probes:
+            ivf._index._num_probes = probes  # type: ignore
+            results = search(ivf, queries, args.top_k)
+            recall = sum(
+                len(expected_top & top) for expected_top, top in zip(expected, results)
+            ) / (args.top_k * len(queries))
+            ivf_time = time_per_query(ivf, queries, args.top_k)
+            print(
+                f"{size:>10} {f'ivf/{probes}':>10} {recall:>8.3f}"
+                f" {ivf_time * 1000:>10.3f} {exact_time / ivf_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
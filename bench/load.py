@@ -0,0 +1,299 @@
+"""Load test of the server: throughput, latency per endpoint and memory per session.
+
+Creates sessions of a game, then has concurrent players chat, interact, query and
+guardrail with its agents, each waiting think_ms between turns.
+
+By default the app runs in this process, started with config.ini from the working
+directory as usual. Set `backend = fake` in [llm] and `fake_redis = true` in
+[server] to run it without an API key or redis; [fake_llm] latencies make the fake
+behave more like the real thing. In process, RSS includes the load generator.
+
+    pdm run python -m bench.load --sessions 20 --players 100 --turns 10
+
+Or against a running server, whose RSS is read from /proc if you give its pid:
+
+    pdm run python -m bench.load --url http://localhost:8000 --server-pid 1234
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from schema import GameDef
+from server.util.json_loader import load_game_from_path
+
+PLAYER_MESSAGES = [
+    "Where were you last night?",
+    "Did you know the victim well?",
+    "I found this letter in the study. Can you explain it?",
+    "Who do you think did it?",
+    "You seem nervous. Is something wrong?",
+    "Tell me about yourself.",
+    "Hand over the key, please.",
+    "I don't believe you.",
+]
+
+QUERIES = [
+    "How suspicious are you of {player}?",
+    "How nervous are you?",
+    "How much do you trust {player}?",
+]
+
+DEFAULT_MIX = "chat=4,interact=3,query=2,guardrail=1"
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def print_report(self, seconds: float):
+        print(
+            f"{'endpoint':>16} {'count':>7} {'errors':>7} {'p50 ms':>9}"
+            f" {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+        )
+        for endpoint, latencies in sorted(self.latencies.items()):
+            p50, p90, p99, p100 = np.percentile(latencies, [50, 90, 99, 100]) * 1000
+            print(
+                f"{endpoint:>16} {len(latencies):>7} {self.errors.get(endpoint, 0):>7}"
+                f" {p50:>9.1f} {p90:>9.1f} {p99:>9.1f} {p100:>9.1f}"
+            )
+
+        turns = sum(
+            len(latencies)
+            for endpoint, latencies in self.latencies.items()
+            if endpoint != "create_session"
+        )
+        print(f"{turns} turns in {seconds:.1f}s: {turns / seconds:.1f} turns/s")
+
+
+async def timed_request(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    endpoint: str,
+    url: str,
+    **kwargs: Any,
+) -> httpx.Response:
+    start = time.perf_counter()
+    try:
+        response = await client.post(url, **kwargs)
+    except httpx.HTTPError:
+        stats.record(endpoint, time.perf_counter() - start, ok=False)
+        raise
+    stats.record(endpoint, time.perf_counter() - start, response.is_success)
+    return response
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident memory of a process, or None where there's no /proc."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def ensure_game(client: httpx.AsyncClient, game_def: GameDef, password: str):
+    """Dev mode servers load the examples on startup, others need it uploaded."""
+    response = await client.get(f"/game/{game_def.uuid}")
+    if response.is_success:
+        return
+    response = await client.put(
+        "/game/json",
+        params={"jsoned_game": game_def.json()},
+        headers={"password": password},
+    )
+    response.raise_for_status()
+
+
+async def play(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    session_uuid: str,
+    agent: str,
+    mix: Dict[str, int],
+    turns: int,
+    think_time: float,
+    rand: random.Random,
+):
+    url = f"/session/{session_uuid}"
+    response = await client.post(f"{url}/start_chat", params={"agent": agent})
+    response.raise_for_status()
+
+    endpoints = list(mix.keys())
+    weights = list(mix.values())
+    for _ in range(turns):
+        await asyncio.sleep(rand.uniform(0, 2 * think_time))
+        endpoint = rand.choices(endpoints, weights)[0]
+        message = rand.choice(PLAYER_MESSAGES)
+        try:
+            if endpoint == "query":
+                await timed_request(
+                    client,
+                    stats,
+                    endpoint,
+                    f"{url}/query",
+                    params={"agent": agent},
+                    json=rand.sample(QUERIES, 2),
+                )
+            else:
+                await timed_request(
+                    client,
+                    stats,
+                    endpoint,
+                    f"{url}/{endpoint}",
+                    params={"agent": agent, "message": message},
+                )
+        except httpx.HTTPError:
+            pass
+
+
+@asynccontextmanager
+async def in_process_client(timeout: float) -> AsyncGenerator[httpx.AsyncClient, None]:
+    from server.main import app
+
+    async with app.router.lifespan_context(app) as state:  # type: ignore
+        # What an ASGI server does with the state the lifespan yields
+        async def app_with_state(scope: Any, receive: Any, send: Any):
+            scope["state"] = dict(state or {})
+            await app(scope, receive, send)
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app_with_state),  # type: ignore
+            base_url="http://load",
+            timeout=timeout,
+        ) as client:
+            yield client
+
+
+@asynccontextmanager
+async def remote_client(
+    url: str, timeout: float
+) -> AsyncGenerator[httpx.AsyncClient, None]:
+    async with httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+        yield client
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = dict(weight.split("=") for weight in mix.split(","))
+    return {endpoint: int(weight) for endpoint, weight in weights.items()}
+
+
+async def run(args: argparse.Namespace):
+    game_def = load_game_from_path(args.game)
+    mix = parse_mix(args.mix)
+    pid = args.server_pid if args.url else os.getpid()
+    rand = random.Random(args.seed)
+    stats = Stats()
+
+    client_context = (
+        remote_client(args.url, args.timeout)
+        if args.url
+        else in_process_client(args.timeout)
+    )
+    async with client_context as client:
+        # Dev mode logs at INFO, which would otherwise log every request
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        await ensure_game(client, game_def, args.password)
+
+        gc.collect()
+        rss_before = rss_bytes(pid) if pid else None
+        semaphore = asyncio.Semaphore(args.create_concurrency)
+
+        async def create_session() -> str:
+            async with semaphore:
+                response = await timed_request(
+                    client,
+                    stats,
+                    "create_session",
+                    "/session/create",
+                    params={"game_uuid": str(game_def.uuid)},
+                )
+                response.raise_for_status()
+                return response.json()
+
+        start = time.perf_counter()
+        session_uuids = await asyncio.gather(
+            *[create_session() for _ in range(args.sessions)]
+        )
+        print(f"Created {args.sessions} sessions in {time.perf_counter() - start:.1f}s")
+
+        gc.collect()
+        rss_after = rss_bytes(pid) if pid else None
+        if rss_before is not None and rss_after is not None:
+            per_session = (rss_after - rss_before) / args.sessions
+            print(
+                f"RSS {rss_after / 2**20:.0f} MiB,"
+                f" {per_session / 2**20:.2f} MiB per session"
+            )
+
+        agents = [agent.name for agent in game_def.agents]
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[
+                play(
+                    client,
+                    stats,
+                    session_uuids[i % len(session_uuids)],
+                    agents[(i // len(session_uuids)) % len(agents)],
+                    mix,
+                    args.turns,
+                    args.think_ms / 1000,
+                    random.Random(rand.random()),
+                )
+                for i in range(args.players)
+            ]
+        )
+        stats.print_report(time.perf_counter() - start)
+
+        if pid:
+            rss = rss_bytes(pid)
+            if rss is not None:
+                print(f"RSS after playing {rss / 2**20:.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--url", help="Server to load, instead of running the app in this process"
+    )
+    parser.add_argument("--server-pid", type=int, help="For RSS with --url")
+    parser.add_argument(
+        "--game",
+        default=os.path.join("server", "examples", "latest_detective.json"),
+    )
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--create-concurrency", type=int, default=4)
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--think-ms", type=float, default=500)
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help="Relative weights of each kind of turn"
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--password", default="", help="To upload the game in prod")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
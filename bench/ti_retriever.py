@@ -0,0 +1,118 @@
+"""Per-query latency of TIRetriever.get_relevant_memories.
+
+Compares the current retriever against the previous implementation, which added
+time_weighted_importance() to each score in a Python loop.
+
+    pdm run python -m bench.ti_retriever --sizes 1000 10000 100000
+"""
+
+import argparse
+import random
+import time
+from functools import partial
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from game.ti_retriever import TIRetriever, time_weighted_importance
+from schema import GameStage, Memory, MemoryConfig
+
+
+def legacy_get_relevant_memories(
+    retriever: TIRetriever, query: Memory, top_k: int
+) -> List[Tuple[Memory, float]]:
+    memories = retriever._memories  # type: ignore
+    num_memories = len(memories)
+    relevance = retriever._memory_embeddings[:num_memories] @ np.array(  # type: ignore
+        query.embedding
+    )
+    relevance += retriever._memory_importances[:num_memories] / 10  # type: ignore
+    for i, memory in enumerate(memories):
+        relevance[i] += time_weighted_importance(query.timestamp, memory)
+    return [
+        (memories[i], float(relevance[i]))
+        for i in np.argpartition(relevance, -top_k)[-top_k:]
+    ]
+
+
+def build_retriever(
+    size: int, dims: int, embedding_dtype: str, rng: np.random.Generator
+) -> TIRetriever:
+    retriever = TIRetriever(
+        MemoryConfig.parse_obj(
+            {
+                "embedding_dims": dims,
+                "max_memories": size,
+                "embedding_dtype": embedding_dtype,
+            }
+        )
+    )
+    embeddings = rng.standard_normal((size, dims))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    for i in range(size):
+        # construct() skips validation, which would otherwise dominate setup time
+        retriever.add_memory(
+            Memory.construct(
+                importance=random.randint(1, 10),
+                description=str(i),
+                embedding=embeddings[i],
+                timestamp=GameStage(
+                    stage=random.randint(0, 2),
+                    major=random.randint(0, 9),
+                    minor=random.randint(0, 99),
+                ),
+            )
+        )
+    return retriever
+
+
+def time_per_query(
+    retrieve: Callable[[Memory], List[Tuple[Memory, float]]],
+    queries: List[Memory],
+) -> float:
+    retrieve(queries[0])
+    start = time.perf_counter()
+    for query in queries:
+        retrieve(query)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument(
+        "--dtype", choices=["float32", "float64", "int8"], default="float32"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    rng = np.random.default_rng(0)
+    print(f"{'memories':>10} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        retriever = build_retriever(size, args.dims, args.dtype, rng)
+        queries = [
+            Memory.construct(
+                description="query",
+                embedding=rng.standard_normal(args.dims),
+                timestamp=GameStage(stage=2, major=9, minor=99),
+            )
+            for _ in range(args.queries)
+        ]
+
+        before = time_per_query(
+            partial(legacy_get_relevant_memories, retriever, top_k=args.top_k), queries
+        )
+        after = time_per_query(
+            partial(retriever.get_relevant_memories, top_k=args.top_k), queries
+        )
+        print(
+            f"{size:>10} {before * 1000:>12.3f} {after * 1000:>12.3f}"
+            f" {before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
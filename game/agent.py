@@ -1,22 +1,40 @@
 import asyncio
-from typing import List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union, cast
 
 from pydantic import UUID4
 
+from game.history import ConversationHistory
 from game.memory import GenAgentMemory
 from game.prompt_helpers import (
+    PromptTemplate,
     clean_response,
+    format_history_message,
     generate_functions_from_actions,
     get_action_messages,
+    get_batched_query_messages,
+    get_batched_rate_function,
     get_chat_messages,
     get_guardrail_query,
     get_interact_messages,
     get_query_messages,
     get_rate_function,
+    get_summarize_messages,
     rating_to_int,
+    ratings_to_ints,
+    response_prefixes,
+)
+from llm.base import LLMBase, close_stream
+from llm.call_context import CallKind, call_kind
+from schema import (
+    ActionCompletion,
+    Conversation,
+    HistoryConfig,
+    Knowledge,
+    Memory,
+    MemoryStats,
+    Message,
+    PromptConfig,
 )
-from llm.base import LLMBase
-from schema import ActionCompletion, Conversation, Knowledge, Memory, Message
 
 
 class GenAgent:
@@ -25,28 +43,53 @@ class GenAgent:
         knowledge: Knowledge,
         llm_interface: LLMBase,
         memory: GenAgentMemory,
+        history_config: Optional[HistoryConfig] = None,
+        prompt_config: Optional[PromptConfig] = None,
     ):
         """Should never be called directly. Use create() instead."""
         self._llm_interface = llm_interface
         self._memory = memory
-        self._conversation_history: List[Message] = []
+        self._conversation_history = ConversationHistory(
+            llm_interface,
+            history_config or HistoryConfig(),
+            self._summarize_messages,
+            self._format_history_message,
+        )
         self._knowledge = knowledge
         self._conversation_context = Conversation()
+        self._prompt_config = prompt_config or PromptConfig()
+        self._prompt_template: Optional[PromptTemplate] = None
+        self._action_functions: Optional[List[Dict[str, str]]] = None
 
     @classmethod
     async def create(
-        cls, knowledge: Knowledge, llm_interface: LLMBase, memory: GenAgentMemory
+        cls,
+        knowledge: Knowledge,
+        llm_interface: LLMBase,
+        memory: GenAgentMemory,
+        include_shared_lore: bool = True,
+        history_config: Optional[HistoryConfig] = None,
+        prompt_config: Optional[PromptConfig] = None,
     ):
-        agent = cls(knowledge, llm_interface, memory)
-        await agent._fill_memories()
+        """include_shared_lore copies the shared lore the agent knows about into its
+        own memory. Leave it off if `memory` already has a shared retriever.
+
+        history_config bounds how much of the conversation is sent with prompts, and
+        prompt_config sets how prompts are laid out."""
+        agent = cls(knowledge, llm_interface, memory, history_config, prompt_config)
+        await agent._fill_memories(include_shared_lore)
         return agent
 
-    async def _fill_memories(self):
-        initial_memories = [
-            lore.memory
-            for lore in self._knowledge.shared_lore
-            if self._knowledge.agent_def.uuid in lore.known_by
-        ]
+    async def _fill_memories(self, include_shared_lore: bool):
+        initial_memories: List[Memory] = []
+        if include_shared_lore:
+            # Shared lore is copied since every agent's retriever takes ownership of
+            # the memories it holds.
+            initial_memories += [
+                lore.memory.copy()
+                for lore in self._knowledge.shared_lore
+                if self._knowledge.agent_def.uuid in lore.known_by
+            ]
 
         initial_memories += self._knowledge.agent_def.personal_lore
 
@@ -61,6 +104,10 @@ class GenAgent:
     def name(self) -> str:
         return self._knowledge.agent_def.name
 
+    @property
+    def memory_stats(self) -> MemoryStats:
+        return self._memory.stats
+
     async def add_memory(self, memory: Memory) -> None:
         await self._memory.add_memory(memory)
 
@@ -76,16 +123,48 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._conversation_history.formatted_window(),
+            preformatted=True,
+            template=self._template(),
         )
-        functions = generate_functions_from_actions(self._knowledge.agent_def.actions)
-        completion = await self._llm_interface.completion(messages, functions)
+        functions = self._functions()
+        with call_kind(CallKind.INTERACT):
+            completion = await self._llm_interface.completion(messages, functions)
 
         if isinstance(completion, Message):
             self._conversation_history.append(clean_response(self.name, completion))
 
         return completion, messages
 
+    async def interact_stream(
+        self, message: Optional[str]
+    ) -> Tuple[AsyncIterator[Union[str, ActionCompletion]], List[Message]]:
+        """Like interact(), but the response is streamed as pieces of text, or as a
+        single ActionCompletion. The response joins the conversation history once
+        the stream is exhausted."""
+        if message:
+            self._conversation_history.append(Message(role="user", content=message))
+
+        memories = await self._queryMemories(message)
+
+        messages = get_interact_messages(
+            self._knowledge,
+            self._conversation_context,
+            memories,
+            self._conversation_history.formatted_window(),
+            preformatted=True,
+            template=self._template(),
+        )
+        functions = self._functions()
+
+        return (
+            self._clean_stream(
+                self._llm_interface.stream_completion(messages, functions),
+                CallKind.INTERACT,
+            ),
+            messages,
+        )
+
     async def chat(self, message: str) -> Tuple[Message, List[Message]]:
         self._conversation_history.append(Message(role="user", content=message))
 
@@ -95,14 +174,41 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._conversation_history.formatted_window(),
+            preformatted=True,
+            template=self._template(),
         )
 
-        completion = await self._llm_interface.chat_completion(messages)
+        with call_kind(CallKind.CHAT):
+            completion = await self._llm_interface.chat_completion(messages)
 
         self._conversation_history.append(clean_response(self.name, completion))
         return completion, messages
 
+    async def chat_stream(
+        self, message: str
+    ) -> Tuple[AsyncIterator[str], List[Message]]:
+        """Like chat(), but the response is streamed as pieces of text. The response
+        joins the conversation history once the stream is exhausted."""
+        self._conversation_history.append(Message(role="user", content=message))
+
+        memories = await self._queryMemories(message)
+
+        messages = get_chat_messages(
+            self._knowledge,
+            self._conversation_context,
+            memories,
+            self._conversation_history.formatted_window(),
+            preformatted=True,
+            template=self._template(),
+        )
+
+        stream = self._clean_stream(
+            self._llm_interface.stream_chat_completion(messages), CallKind.CHAT
+        )
+        # Only text goes in, so only text comes out.
+        return cast(AsyncIterator[str], stream), messages
+
     async def act(
         self, message: Optional[str]
     ) -> Tuple[Optional[ActionCompletion], List[Message]]:
@@ -115,29 +221,35 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._conversation_history.formatted_window(),
+            preformatted=True,
+            template=self._template(),
         )
-        functions = generate_functions_from_actions(self._knowledge.agent_def.actions)
+        functions = self._functions()
 
-        return (
-            await self._llm_interface.action_completion(messages, functions),
-            messages,
-        )
+        with call_kind(CallKind.ACT):
+            action = await self._llm_interface.action_completion(messages, functions)
+
+        return action, messages
 
     async def query(self, queries: List[str]) -> List[int]:
         """Returns a numerical answer to queries into the Agent's
         thoughts and emotions. 1 = not at all, 5 = extremely
         Ex. How happy are you given this conversation? -> 3 (moderately)"""
-        memories = await asyncio.gather(
-            *[self._queryMemories(query) for query in queries]
-        )
+        memories = await self._queryMemoriesBatch(list(queries))
+
+        if self._prompt_config.batch_queries and len(queries) > 1:
+            ratings = await self._batched_query(memories, queries)
+            if ratings is not None:
+                return ratings
 
         query_messages = get_query_messages(
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._conversation_history.window(),
             queries,
+            self._template(),
         )
 
         functions = [get_rate_function()]
@@ -146,10 +258,35 @@ class GenAgent:
             self._llm_interface.action_completion(msgs, functions)
             for msgs in query_messages
         ]
-        ratings = await asyncio.gather(*awaitables)
+        with call_kind(CallKind.QUERY):
+            ratings = await asyncio.gather(*awaitables)
 
         return [rating_to_int(rating) for rating in ratings]
 
+    async def _batched_query(
+        self, memories: List[List[str]], queries: List[str]
+    ) -> Optional[List[int]]:
+        """The ratings of all the queries from one request, or None if the LLM
+        didn't rate them all."""
+        # The memories relevant to each query, without repeats
+        facts = list(dict.fromkeys(fact for facts in memories for fact in facts))
+        messages = get_batched_query_messages(
+            self._knowledge,
+            self._conversation_context,
+            facts,
+            self._conversation_history.window(),
+            queries,
+            self._template(),
+        )
+
+        functions = [get_batched_rate_function(len(queries))]
+        with call_kind(CallKind.QUERY):
+            completion = await self._llm_interface.action_completion(
+                messages, functions
+            )
+
+        return ratings_to_ints(completion, len(queries))
+
     async def guardrail(self, message: str) -> int:
         """Is `message` something that the LLM thinks the GenAgent might say?
         Useful for playable characters and not letting players say inappropriate or
@@ -161,14 +298,16 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             [[]],
-            self._conversation_history,
+            self._conversation_history.window(),
             [guardrail_query],
+            self._template(),
         )
 
         functions = [get_rate_function()]
-        completion = await self._llm_interface.action_completion(
-            query_messages[0], functions
-        )
+        with call_kind(CallKind.GUARDRAIL):
+            completion = await self._llm_interface.action_completion(
+                query_messages[0], functions
+            )
 
         return rating_to_int(completion)
 
@@ -178,35 +317,153 @@ class GenAgent:
         history: List[Message],
     ):
         self._conversation_context = conversation
-        self._conversation_history = history
+        self._prompt_template = None
+        self._conversation_history.reset(history)
 
     def resetConversation(self):
-        self._conversation_history = []
+        self._conversation_history.reset([])
 
     # TODO: use setter?
     def updateKnowledge(self, knowledge: Knowledge):
         # TODO: this doesn't update their memories, but we also don't really
         # want to overwrite what exists. Not sure what to do here.
         self._knowledge = knowledge
+        self._prompt_template = None
+        self._action_functions = None
+        self._conversation_history.invalidate_formatting()
+
+    def attach_llm(self, llm: LLMBase) -> None:
+        """Gives an agent restored from a pickle the server's LLM to call."""
+        self._llm_interface = llm
+        self._memory.attach_llm(llm)
+        self._conversation_history.attach_llm(llm)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Dev mode pickles sessions. The LLM is the server's, see attach_llm().
+        return {**self.__dict__, "_llm_interface": None}
+
+    def _template(self) -> PromptTemplate:
+        if self._prompt_template is None:
+            self._prompt_template = PromptTemplate(
+                self._knowledge, self._conversation_context, self._prompt_config
+            )
+        return self._prompt_template
+
+    def _functions(self) -> List[Dict[str, str]]:
+        """The functions of the agent's actions, generated once per agent def."""
+        if self._action_functions is None:
+            self._action_functions = generate_functions_from_actions(
+                self._knowledge.agent_def.actions
+            )
+        return self._action_functions
+
+    def _format_history_message(self, message: Message) -> Message:
+        return format_history_message(
+            self._knowledge, self._conversation_context, message
+        )
+
+    def _summarize_messages(
+        self, summary: Optional[str], history: List[Message]
+    ) -> List[Message]:
+        return get_summarize_messages(
+            self._knowledge, self._conversation_context, summary, history
+        )
+
+    async def _clean_stream(
+        self, stream: AsyncIterator[Union[str, ActionCompletion]], kind: CallKind
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        """Does what clean_response does to a streamed response. Text is held back
+        only while it could still turn out to be one of the prefixes to remove.
+
+        The stream is read by whoever consumes the response, so `kind` is only set
+        while waiting on it. Closing the response closes the stream."""
+        prefixes = response_prefixes(self.name)
+        held_back: Optional[str] = ""
+        content = ""
+
+        try:
+            while True:
+                with call_kind(kind):
+                    try:
+                        piece = await stream.__anext__()
+                    except StopAsyncIteration:
+                        break
+
+                if not isinstance(piece, str):
+                    yield piece
+                    continue
+
+                if held_back is not None:
+                    held_back += piece
+                    if any(
+                        len(held_back) < len(prefix) and prefix.startswith(held_back)
+                        for prefix in prefixes
+                    ):
+                        continue
+                    piece = clean_response(
+                        self.name, Message(role="assistant", content=held_back)
+                    ).content
+                    held_back = None
+
+                content += piece
+                yield piece
+        finally:
+            await close_stream(stream)
+
+        if held_back:
+            content = clean_response(
+                self.name, Message(role="assistant", content=held_back)
+            ).content
+            yield content
+
+        if content:
+            self._conversation_history.append(
+                Message(role="assistant", content=content)
+            )
 
     async def _queryMemories(
         self, message: Optional[str] = None, max_memories: Optional[int] = None
-    ):
+    ) -> List[str]:
         if not max_memories:
             max_memories = self._conversation_context.memories_to_include
 
-        queries: List[Memory] = []
-        if message:
-            queries.append(Memory(description=message))
-        context_description = (self._conversation_context.scene_description or "") + (
-            self._conversation_context.instructions or ""
-        )
-        if context_description:
-            queries.append(Memory(description=context_description))
-
         return [
             memory.description
             for memory in await self._memory.retrieve_relevant_memories(
-                queries, top_k=max_memories
+                self._memoryQueries([message])[0], top_k=max_memories
+            )
+        ]
+
+    async def _queryMemoriesBatch(
+        self, messages: List[Optional[str]], max_memories: Optional[int] = None
+    ) -> List[List[str]]:
+        """Retrieves memories relevant to each message in a single retrieval pass."""
+        if not max_memories:
+            max_memories = self._conversation_context.memories_to_include
+
+        return [
+            [memory.description for memory in memories]
+            for memories in await self._memory.retrieve_relevant_memories_grouped(
+                self._memoryQueries(messages), top_k=max_memories
             )
         ]
+
+    def _memoryQueries(self, messages: List[Optional[str]]) -> List[List[Memory]]:
+        context_description = (self._conversation_context.scene_description or "") + (
+            self._conversation_context.instructions or ""
+        )
+        # Shared between messages so it's only embedded and scored once.
+        context_query = (
+            Memory(description=context_description) if context_description else None
+        )
+
+        query_groups: List[List[Memory]] = []
+        for message in messages:
+            queries: List[Memory] = []
+            if message:
+                queries.append(Memory(description=message))
+            if context_query:
+                queries.append(context_query)
+            query_groups.append(queries)
+
+        return query_groups
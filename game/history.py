@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from game.prompt_helpers import get_summary_message
+from llm.base import LLMBase
+from llm.call_context import CallKind, call_kind
+from llm.tokens import estimate_tokens
+from schema import HistoryConfig, Message
+
+# Given the current summary, if any, and the messages that follow it, returns the
+# prompt that asks for a new summary.
+SummarizeMessages = Callable[[Optional[str], List[Message]], List[Message]]
+FormatMessage = Callable[[Message], Message]
+
+
+class ConversationHistory:
+    """The messages of a conversation, sent with prompts within a token budget.
+
+    Once the messages outgrow config.max_tokens, all but the latest
+    config.recent_messages are summarized by the LLM in a background task, and are
+    replaced by the summary when it's done. Prompts never wait on it: until then,
+    the oldest messages that don't fit are left out of the window.
+
+    Messages are formatted for prompts with format_message as they're first sent,
+    and kept formatted until invalidate_formatting() is called."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        config: HistoryConfig,
+        summarize_messages: SummarizeMessages,
+        format_message: FormatMessage,
+    ):
+        self._llm = llm
+        self._config = config
+        self._summarize_messages = summarize_messages
+        self._format_message = format_message
+        self._messages: List[Message] = []
+        # Formatted versions of the first len(self._formatted) messages
+        self._formatted: List[Message] = []
+        self._summary: Optional[str] = None
+        self._summarizing: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def messages(self) -> List[Message]:
+        """The messages that haven't been summarized yet."""
+        return self._messages
+
+    @property
+    def summary(self) -> Optional[str]:
+        return self._summary
+
+    def append(self, message: Message) -> None:
+        self._messages.append(message)
+        self._maybe_summarize()
+
+    def reset(self, messages: List[Message]) -> None:
+        if self._summarizing:
+            self._summarizing.cancel()
+            self._summarizing = None
+        self._messages = list(messages)
+        self._formatted = []
+        self._summary = None
+        self._maybe_summarize()
+
+    def invalidate_formatting(self) -> None:
+        """Call when format_message would format messages differently."""
+        self._formatted = []
+
+    def window(self) -> List[Message]:
+        """The summary, if there is one, then as many of the latest messages as fit
+        in the budget, and at least the recent ones."""
+        summary = self._summary_messages()
+        return summary + self._messages[self._window_start(summary) :]
+
+    def formatted_window(self) -> List[Message]:
+        """Like window(), with the messages formatted. Only messages that haven't
+        been formatted before are."""
+        self._formatted += [
+            self._format_message(message)
+            for message in self._messages[len(self._formatted) :]
+        ]
+        summary = self._summary_messages()
+        return summary + self._formatted[self._window_start(summary) :]
+
+    def _summary_messages(self) -> List[Message]:
+        return [get_summary_message(self._summary)] if self._summary else []
+
+    def _window_start(self, summary: List[Message]) -> int:
+        """Index of the oldest message in the window."""
+        if not self._config.max_tokens:
+            return 0
+
+        start = len(self._messages)
+        budget = self._config.max_tokens - estimate_tokens(summary)
+        while start > 0:
+            tokens = estimate_tokens([self._messages[start - 1]])
+            recent = len(self._messages) - start < self._config.recent_messages
+            if tokens > budget and not recent:
+                break
+            budget -= tokens
+            start -= 1
+        return start
+
+    def attach_llm(self, llm: LLMBase) -> None:
+        """Gives history restored from a pickle the server's LLM to summarize with."""
+        self._llm = llm
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Dev mode pickles sessions. A summary in progress is simply started again,
+        # and the LLM is the server's, see attach_llm().
+        return {**self.__dict__, "_summarizing": None, "_llm": None}
+
+    def _maybe_summarize(self) -> None:
+        if (
+            not self._config.summarize
+            or not self._config.max_tokens
+            or self._summarizing
+            or estimate_tokens(self._messages) <= self._config.max_tokens
+        ):
+            return
+
+        old_messages = self._messages[
+            : max(0, len(self._messages) - self._config.recent_messages)
+        ]
+        if not old_messages:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside of an event loop, the next message starts the summary.
+            return
+        self._summarizing = loop.create_task(self._summarize(old_messages))
+
+    async def _summarize(self, old_messages: List[Message]) -> None:
+        try:
+            with call_kind(CallKind.SUMMARIZE):
+                summary = await self._llm.chat_completion(
+                    self._summarize_messages(self._summary, old_messages)
+                )
+        except Exception:
+            # The window still leaves out what doesn't fit.
+            logging.getLogger().exception("Couldn't summarize conversation")
+            return
+        finally:
+            # reset() may have cancelled this one and started another
+            if self._summarizing is asyncio.current_task():
+                self._summarizing = None
+
+        self._summary = summary.content
+        del self._messages[: len(old_messages)]
+        del self._formatted[: len(old_messages)]
+        self._maybe_summarize()
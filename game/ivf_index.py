@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from functools import partial
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Caps the k-means training set at this many points per list.
+_TRAINING_POINTS_PER_LIST = 64
+_KMEANS_ITERATIONS = 10
+# Rows are assigned to lists this many at a time to bound temporary memory.
+_ASSIGN_CHUNK_ROWS = 4096
+
+
+RowsToEmbeddings = Callable[[Union[slice, NDArray[np.intp]]], NDArray[np.float32]]
+# Centroids found by k-means, and the list of each row it was run on
+Fit = Tuple[NDArray[np.float32], NDArray[np.int32]]
+
+
+def _normalized(vectors: NDArray[np.float32]) -> NDArray[np.float32]:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+class IVFIndex:
+    """An inverted file index over the embedding rows of a TIRetriever.
+
+    Rows are partitioned into lists by spherical k-means. A search only returns the
+    rows in the lists whose centroids are closest to the query, so that the caller
+    only has to score a fraction of its memories.
+
+    The index trains itself once it holds train_size rows. New rows update the
+    centroid they are assigned to, and the index is retrained from scratch every time
+    the number of rows doubles. Training can run in another thread, see fitter()."""
+
+    def __init__(self, num_lists: int, num_probes: int, train_size: int, seed: int = 0):
+        self._num_lists = num_lists
+        self._num_probes = min(num_probes, num_lists)
+        self._train_size = max(train_size, num_lists)
+        self._rng = np.random.default_rng(seed)
+
+        self._centroids: Optional[NDArray[np.float32]] = None
+        self._list_sizes: NDArray[np.int64] = np.zeros(num_lists, dtype=np.int64)
+        self._assignments: NDArray[np.int32] = np.zeros(0, dtype=np.int32)
+        self._trained_rows = 0
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    def needs_training(self, num_rows: int) -> bool:
+        if not self.trained:
+            return num_rows >= self._train_size
+        return num_rows >= 2 * self._trained_rows
+
+    def train(self, num_rows: int, embeddings: RowsToEmbeddings) -> None:
+        """Runs k-means on a sample of the first num_rows rows and reassigns all of
+        them. embeddings looks up rows as float32."""
+        fit = self.fitter(embeddings(slice(0, num_rows)))
+        self.install(fit(), num_rows, embeddings)
+
+    def fitter(self, rows: NDArray[np.float32]) -> Callable[[], Fit]:
+        """What train() computes for `rows`, as a function that only uses copies of
+        the index, so that it can run in another thread while the index is used.
+        `rows` mustn't change meanwhile, and only one fitter may run at a time, since
+        they share the index's random generator. Pass what it returns to install()."""
+        centroids = None if self._centroids is None else self._centroids.copy()
+        return partial(_fit, rows, centroids, self._num_lists, self._rng)
+
+    def install(self, fit: Fit, num_rows: int, embeddings: RowsToEmbeddings) -> None:
+        """Starts using the lists of a fitter. Rows added after the fitter's rows
+        were taken, up to num_rows, are assigned here."""
+        centroids, assignments = fit
+        fitted = len(assignments)
+        self._centroids = centroids
+        self._assignments = np.zeros(
+            max(len(self._assignments), num_rows), dtype=np.int32
+        )
+        self._assignments[:fitted] = assignments
+        if num_rows > fitted:
+            self._assignments[fitted:num_rows] = self._nearest_lists(
+                embeddings(slice(fitted, num_rows))
+            )
+        self._list_sizes = np.bincount(
+            self._assignments[:num_rows], minlength=self._num_lists
+        )
+        self._trained_rows = num_rows
+
+    def add(self, row: int, embedding: NDArray[np.float32]) -> None:
+        if row >= len(self._assignments):
+            grown = np.zeros(max(2 * len(self._assignments), row + 1), dtype=np.int32)
+            grown[: len(self._assignments)] = self._assignments
+            self._assignments = grown
+
+        if self._centroids is None:
+            return
+
+        nearest = int(self._nearest_lists(embedding[np.newaxis])[0])
+        self._assignments[row] = nearest
+
+        # Online k-means: nudge the centroid towards its new member.
+        self._list_sizes[nearest] += 1
+        centroid = self._centroids[nearest]
+        centroid += (_normalized(embedding) - centroid) / self._list_sizes[nearest]
+        self._centroids[nearest] = _normalized(centroid)
+
+    def compact(self, kept_rows: NDArray[np.intp]) -> None:
+        """Mirrors the retriever moving kept_rows to the front of its arrays."""
+        self._assignments[: len(kept_rows)] = self._assignments[kept_rows]
+        if self._centroids is not None:
+            # Evicted rows no longer weigh on the online centroid updates.
+            self._list_sizes = np.bincount(
+                self._assignments[: len(kept_rows)], minlength=self._num_lists
+            )
+
+    def candidates(
+        self, query_matrix: NDArray[np.float32], num_rows: int
+    ) -> NDArray[np.intp]:
+        """Rows in the lists closest to any of the queries (columns of query_matrix),
+        in ascending order."""
+        if self._centroids is None:
+            return np.arange(num_rows)
+
+        centroid_scores = self._centroids @ query_matrix
+        probed = np.argpartition(-centroid_scores, self._num_probes - 1, axis=0)[
+            : self._num_probes
+        ]
+        is_probed = np.zeros(self._num_lists, dtype=np.bool_)
+        is_probed[probed.ravel()] = True
+        return np.flatnonzero(is_probed[self._assignments[:num_rows]])
+
+    def _nearest_lists(self, embeddings: NDArray[np.float32]) -> NDArray[np.intp]:
+        assert self._centroids is not None
+        return _nearest(embeddings, self._centroids)
+
+
+def _fit(
+    rows: NDArray[np.float32],
+    centroids: Optional[NDArray[np.float32]],
+    num_lists: int,
+    rng: np.random.Generator,
+) -> Fit:
+    """Spherical k-means on a sample of rows, starting from centroids if given, and
+    the list of every row."""
+    sample_size = min(len(rows), num_lists * _TRAINING_POINTS_PER_LIST)
+    sample = _normalized(
+        rows[np.sort(rng.choice(len(rows), sample_size, replace=False))]
+    )
+    if centroids is None:
+        centroids = sample[rng.choice(sample_size, num_lists, replace=False)]
+
+    for _ in range(_KMEANS_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=num_lists) == 0
+        # Restart empty lists from random points so that no list goes unused.
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = _normalized(sums)
+    centroids = centroids.astype(np.float32)
+
+    lists = np.zeros(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), _ASSIGN_CHUNK_ROWS):
+        end = min(start + _ASSIGN_CHUNK_ROWS, len(rows))
+        lists[start:end] = _nearest(rows[start:end], centroids)
+    return centroids, lists
+
+
+def _nearest(
+    embeddings: NDArray[np.float32], centroids: NDArray[np.float32]
+) -> NDArray[np.intp]:
+    return np.argmax(embeddings @ centroids.T, axis=1)
@@ -0,0 +1,130 @@
+import hashlib
+import io
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from game.memory import rate_importance
+from llm.base import LLMBase
+from schema import GameDef, Memory
+
+# Importance, or 0 if it wasn't rated, and embedding
+_Row = Tuple[int, NDArray[np.float32]]
+
+
+class LoreVectors:
+    """The importance and embedding of every lore memory of a game, computed when
+    the game is saved so that creating a session doesn't have to ask the LLM.
+
+    Rows are found by description, so a row can't go stale when lore changes, it
+    just stops being used. Serialized as a compact npz of sha256 digests, uint8
+    importances and float32 embeddings, separate from the game's JSON."""
+
+    def __init__(self, embedding_model: str):
+        self.embedding_model = embedding_model
+        self._rows: Dict[bytes, _Row] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def apply(self, memory: Memory) -> None:
+        """Fills in the importance and embedding of `memory`, if they're known and it
+        doesn't have its own."""
+        row = self._rows.get(_digest(memory.description))
+        if row is None:
+            return
+        importance, embedding = row
+        if memory.importance == 0 and importance:
+            memory.importance = importance
+        if not memory.embedding:
+            memory.embedding = embedding.tolist()
+
+    def apply_to_game(self, game_def: GameDef) -> None:
+        for memory in lore_memories(game_def):
+            self.apply(memory)
+
+    @classmethod
+    async def compute(
+        cls,
+        llm: LLMBase,
+        game_def: GameDef,
+        previous: Optional["LoreVectors"] = None,
+    ) -> "LoreVectors":
+        """Rates and embeds the lore of `game_def`, reusing what's in `previous`."""
+        needs_rating: Dict[bytes, bool] = {}
+        descriptions: Dict[bytes, str] = {}
+        for memory in lore_memories(game_def):
+            digest = _digest(memory.description)
+            descriptions[digest] = memory.description
+            needs_rating[digest] = needs_rating.get(digest, False) or (
+                memory.importance == 0
+            )
+
+        known: Dict[bytes, _Row] = {}
+        if previous and previous.embedding_model == llm.embedding_model:
+            known = previous._rows
+
+        to_embed = [digest for digest in descriptions if digest not in known]
+        to_rate = [
+            digest
+            for digest, rating in needs_rating.items()
+            if rating and not (digest in known and known[digest][0])
+        ]
+        embedded: Dict[bytes, List[float]] = {}
+        if to_embed:
+            embeddings = await llm.embed_batch([descriptions[d] for d in to_embed])
+            embedded = dict(zip(to_embed, embeddings))
+        rated: Dict[bytes, int] = {}
+        if to_rate:
+            importances = await rate_importance(llm, [descriptions[d] for d in to_rate])
+            # A failed rating comes back as 0, to be rated again next time.
+            rated = {d: i for d, i in zip(to_rate, importances) if i > 0}
+
+        vectors = cls(llm.embedding_model)
+        for digest in descriptions:
+            if digest in embedded:
+                embedding = np.asarray(embedded[digest], dtype=np.float32)
+            else:
+                embedding = known[digest][1]
+            importance = rated.get(digest, known[digest][0] if digest in known else 0)
+            vectors._rows[digest] = (importance, embedding)
+        return vectors
+
+    def to_bytes(self) -> bytes:
+        digests = list(self._rows)
+        embeddings = (
+            np.stack([self._rows[d][1] for d in digests])
+            if digests
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            embedding_model=np.array(self.embedding_model),
+            digests=np.frombuffer(b"".join(digests), dtype=np.uint8).reshape(-1, 32),
+            importances=np.array([self._rows[d][0] for d in digests], dtype=np.uint8),
+            embeddings=embeddings,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LoreVectors":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            vectors = cls(str(arrays["embedding_model"]))
+            for digest, importance, embedding in zip(
+                arrays["digests"], arrays["importances"], arrays["embeddings"]
+            ):
+                vectors._rows[digest.tobytes()] = (int(importance), embedding)
+        return vectors
+
+
+def lore_memories(game_def: GameDef) -> List[Memory]:
+    """The shared lore, then every agent's personal lore."""
+    return [lore.memory for lore in game_def.shared_lore] + [
+        memory for agent in game_def.agents for memory in agent.personal_lore
+    ]
+
+
+def _digest(description: str) -> bytes:
+    return hashlib.sha256(description.encode()).digest()
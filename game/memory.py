@@ -1,11 +1,17 @@
+import asyncio
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from pydantic import UUID4
 
 from game.ti_retriever import TIRetriever
 from llm.base import LLMBase
+from llm.call_context import CallKind, call_kind
 
 # from eastworld.wrappers.openai
-from schema import Memory, Message
+from schema import Lore, Memory, MemoryStats, Message
 
 _MEM_IMPORTANCE_TMPL = """On the scale of 0 to 9, where 0 is purely mundane"
 (e.g., brushing teeth, making bed) and 9 is
@@ -24,10 +30,32 @@ class GenAgentMemory:
         llm_interface: LLMBase,
         default_num_memories_returned: int,
         retriever: TIRetriever,
+        shared_retriever: Optional[TIRetriever] = None,
+        shared_visibility: Optional[NDArray[np.bool_]] = None,
     ):
+        """shared_retriever holds memories shared by every agent in a session, i.e.
+        shared lore. The agent only recalls the rows set in shared_visibility."""
         self._llm_interface = llm_interface
         self._default_num_memories_returned = default_num_memories_returned
         self._retriever = retriever
+        self._shared_retriever = shared_retriever
+        self._shared_visibility = shared_visibility
+
+    @property
+    def retriever(self) -> TIRetriever:
+        return self._retriever
+
+    @property
+    def stats(self) -> MemoryStats:
+        return self._retriever.stats
+
+    def attach_llm(self, llm: LLMBase) -> None:
+        """Gives memory restored from a pickle the server's LLM to call."""
+        self._llm_interface = llm
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Dev mode pickles sessions. The LLM is the server's, see attach_llm().
+        return {**self.__dict__, "_llm_interface": None}
 
     async def add_memory(self, memory: Memory) -> None:
         # TODO: parallelize
@@ -36,43 +64,79 @@ class GenAgentMemory:
         if not memory.embedding:
             memory.embedding = await self._llm_interface.embed(memory.description)
 
-        self._retriever.add_memory(memory)
+        # k-means would hold up every other session, so it's run in a thread.
+        self._retriever.add_memory(memory, train_index=False)
+        await self._retriever.train_index_in_thread()
 
     async def retrieve_relevant_memories(
         self, queries: List[Memory], top_k: Optional[int]
     ) -> List[Memory]:
+        return (await self.retrieve_relevant_memories_grouped([queries], top_k))[0]
+
+    async def retrieve_relevant_memories_grouped(
+        self, query_groups: List[List[Memory]], top_k: Optional[int]
+    ) -> List[List[Memory]]:
+        """Returns the top_k most relevant memories for each group of queries,
+        where a memory is as relevant as its best matching query in the group.
+        All groups are scored together in one pass."""
         if not top_k:
             top_k = self._default_num_memories_returned
 
-        # TODO: remember CS170 and find a faster alg for this
-        # TODO: also gather awaits instead
-        memory_to_max_importance: Dict[str, float] = dict()
-        # TODO: fix this lol
-        memory_desc_to_memory: Dict[str, Memory] = dict()
-
-        for query in queries:
-            if not query.embedding:
-                query.embedding = await self._llm_interface.embed(query.description)
-
-            top_k_for_query = self._retriever.get_relevant_memories(query, top_k)
-            for memory, score in top_k_for_query:
-                memory_to_max_importance[memory.description] = max(
-                    memory_to_max_importance.get(memory.description, 0), score
-                )
-                memory_desc_to_memory[memory.description] = memory
+        unembedded = list(
+            {
+                id(query): query
+                for group in query_groups
+                for query in group
+                if not query.embedding
+            }.values()
+        )
+        embeddings = await asyncio.gather(
+            *[self._llm_interface.embed(query.description) for query in unembedded]
+        )
+        for query, embedding in zip(unembedded, embeddings):
+            query.embedding = embedding
 
-        vals = list(memory_to_max_importance.items())
-        vals.sort(key=lambda x: -x[1])
+        groups = self._retriever.get_relevant_memories_grouped(query_groups, top_k)
+        if self._shared_retriever is not None:
+            shared_groups = self._shared_retriever.get_relevant_memories_grouped(
+                query_groups, top_k, self._shared_visibility
+            )
+            groups = [
+                sorted(group + shared_group, key=lambda x: -x[1])[:top_k]
+                for group, shared_group in zip(groups, shared_groups)
+            ]
 
         logger = logging.getLogger()
         logger.debug("Pulled memories: \n")
-        logger.debug("\n".join([f"{desc}: {val}" for desc, val in vals]))
+        for group in groups:
+            logger.debug("\n".join([f"{m.description}: {val}" for m, val in group]))
 
-        return [memory_desc_to_memory[desc] for desc, _ in vals[:top_k]]
+        return [[memory for memory, _ in group] for group in groups]
 
     async def _rate_importance(self, memory: Memory) -> int:
-        message = Message(
-            role="user",
-            content=_MEM_IMPORTANCE_TMPL.format(memory_content=memory.description),
-        )
-        return (await self._llm_interface.digit_completions([[message]]))[0] + 1
+        return (await rate_importance(self._llm_interface, [memory.description]))[0]
+
+
+async def rate_importance(llm: LLMBase, descriptions: List[str]) -> List[int]:
+    """How important memories with these descriptions are, from 1 to 10."""
+    query_messages = [
+        [
+            Message(
+                role="user",
+                content=_MEM_IMPORTANCE_TMPL.format(memory_content=description),
+            )
+        ]
+        for description in descriptions
+    ]
+    with call_kind(CallKind.IMPORTANCE):
+        ratings = await llm.digit_completions(query_messages)
+    return [rating + 1 for rating in ratings]
+
+
+def lore_visibility(shared_lore: List[Lore], agent: UUID4) -> NDArray[np.bool_]:
+    """Which rows of a shared retriever holding `shared_lore` the agent knows about."""
+    visibility = np.zeros(len(shared_lore), dtype=np.bool_)
+    for lore in shared_lore:
+        if agent in lore.known_by and lore.memory.embedding_row is not None:
+            visibility[lore.memory.embedding_row] = True
+    return visibility
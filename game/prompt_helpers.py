@@ -1,10 +1,120 @@
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
 
-from schema import Action, ActionCompletion, Conversation, Knowledge, Message, Parameter
+from schema import (
+    Action,
+    ActionCompletion,
+    Conversation,
+    Knowledge,
+    Message,
+    Parameter,
+    PromptConfig,
+)
+
+# Stands in for the facts while the rest of a prompt is formatted
+_FACTS_PLACEHOLDER = "\x00facts\x00"
+
+
+_MEMORIES_FRAGMENT = "{knowledge.agent_def.name} has the following memories: \n{facts}"
+
+
+class PromptTemplate:
+    """The system prompt and knowledge fragment of an agent in a conversation,
+    formatted once with only the facts left to splice in. Build a new one when the
+    knowledge or the conversation changes."""
+
+    def __init__(
+        self,
+        knowledge: Knowledge,
+        conversation: Conversation,
+        config: Optional[PromptConfig] = None,
+    ):
+        self._knowledge = knowledge
+        self._conversation = conversation
+        self._config = config or PromptConfig()
+        # The text before and after the facts, keyed by whether there are any.
+        self._system_prompts: Dict[bool, Tuple[str, str]] = {}
+        self._knowledge_fragments: Dict[bool, Tuple[str, str]] = {}
+
+    def system_prompt(self, facts: List[str]) -> Message:
+        return Message(
+            role="system",
+            content=self._splice(self._system_prompts, _format_system_prompt, facts),
+        )
+
+    def knowledge_fragment(self, facts: List[str]) -> str:
+        return self._splice(
+            self._knowledge_fragments, _format_knowledge_fragment, facts
+        )
+
+    def messages(self, facts: List[str], history: List[Message]) -> List[Message]:
+        """The system prompt with the facts, and the history.
+
+        With the prefix_cache layout, the facts come in a message of their own just
+        before the latest one, so that the messages before it stay the same from
+        one turn to the next."""
+        if self._config.layout == "prefix_cache":
+            return (
+                [self.system_prompt([])]
+                + history[:-1]
+                + self._memories_message(facts)
+                + history[-1:]
+            )
+        return [self.system_prompt(facts)] + history
+
+    def query_messages(self, facts: List[str], history: List[Message]) -> List[Message]:
+        """Like messages(), with the knowledge fragment as the system prompt."""
+        if self._config.layout == "prefix_cache":
+            return (
+                [Message(role="system", content=self.knowledge_fragment([]))]
+                + history
+                + self._memories_message(facts)
+            )
+        fragment = Message(role="system", content=self.knowledge_fragment(facts))
+        return [fragment] + history
+
+    def _memories_message(self, facts: List[str]) -> List[Message]:
+        if not facts:
+            return []
+        content = _MEMORIES_FRAGMENT.format(
+            knowledge=self._knowledge, facts="\n".join(facts)
+        )
+        return [Message(role="system", content=content)]
+
+    def _splice(
+        self,
+        formatted: Dict[bool, Tuple[str, str]],
+        format_prompt: Callable[[Knowledge, Conversation, List[str]], str],
+        facts: List[str],
+    ) -> str:
+        has_facts = bool(facts)
+        if has_facts not in formatted:
+            prompt = format_prompt(
+                self._knowledge,
+                self._conversation,
+                [_FACTS_PLACEHOLDER] if has_facts else [],
+            )
+            before, _, after = prompt.partition(_FACTS_PLACEHOLDER)
+            formatted[has_facts] = (before, after)
+
+        before, after = formatted[has_facts]
+        return before + "\n".join(facts) + after
 
 
 def get_knowledge_fragment(
     knowledge: Knowledge, conversation: Conversation, facts: List[str]
+) -> str:
+    return PromptTemplate(knowledge, conversation).knowledge_fragment(facts)
+
+
+def get_system_prompt(
+    knowledge: Knowledge, conversation: Conversation, facts: List[str]
+) -> Message:
+    return PromptTemplate(knowledge, conversation).system_prompt(facts)
+
+
+def _format_knowledge_fragment(
+    knowledge: Knowledge, conversation: Conversation, facts: List[str]
 ) -> str:
     fragment = [
         """You are roleplaying as a character named {knowledge.agent_def.name}.
@@ -27,9 +137,7 @@ Description of {knowledge.agent_def.name}:
         )
 
     if facts:
-        fragment.append(
-            "{knowledge.agent_def.name} has the following memories: \n{facts}"
-        )
+        fragment.append(_MEMORIES_FRAGMENT)
 
     if conversation.correspondent:
         fragment.append(
@@ -56,10 +164,10 @@ Description of {knowledge.agent_def.name}:
     )
 
 
-def get_system_prompt(
+def _format_system_prompt(
     knowledge: Knowledge, conversation: Conversation, facts: List[str]
-) -> Message:
-    system_prompt = get_knowledge_fragment(knowledge, conversation, facts)
+) -> str:
+    system_prompt = _format_knowledge_fragment(knowledge, conversation, facts)
 
     instructions: List[str] = []
     instructions.append(
@@ -76,11 +184,8 @@ respond ONLY as {knowledge.agent_def.name}."""
     )
     system_prompt += "\n".join(instructions)
 
-    return Message(
-        role="system",
-        content=system_prompt.format(
-            knowledge=knowledge, conversation=conversation, facts=facts
-        ),
+    return system_prompt.format(
+        knowledge=knowledge, conversation=conversation, facts=facts
     )
 
 
@@ -93,19 +198,19 @@ def get_chat_messages(
     conversation: Conversation,
     facts: List[str],
     history: List[Message],
+    preformatted: bool = False,
+    template: Optional[PromptTemplate] = None,
 ) -> List[Message]:
-    return (
-        [get_system_prompt(knowledge, conversation, facts)]
-        + _format_history(knowledge, conversation, history)
-        + [
-            Message(
-                role="assistant",
-                content=_CHARACTER_DIALOG_PREPEND.format(
-                    character=knowledge.agent_def.name, message=""
-                ),
-            )
-        ]
-    )
+    template = template or PromptTemplate(knowledge, conversation)
+    history = _format_history(knowledge, conversation, history, preformatted)
+    return template.messages(facts, history) + [
+        Message(
+            role="assistant",
+            content=_CHARACTER_DIALOG_PREPEND.format(
+                character=knowledge.agent_def.name, message=""
+            ),
+        )
+    ]
 
 
 def get_interact_messages(
@@ -113,19 +218,19 @@ def get_interact_messages(
     conversation: Conversation,
     facts: List[str],
     history: List[Message],
+    preformatted: bool = False,
+    template: Optional[PromptTemplate] = None,
 ) -> List[Message]:
-    return (
-        [get_system_prompt(knowledge, conversation, facts)]
-        + _format_history(knowledge, conversation, history)
-        + [
-            Message(
-                role="assistant",
-                content=_CHARACTER_INTERACT_PREPEND.format(
-                    character=knowledge.agent_def.name
-                ),
-            )
-        ]
-    )
+    template = template or PromptTemplate(knowledge, conversation)
+    history = _format_history(knowledge, conversation, history, preformatted)
+    return template.messages(facts, history) + [
+        Message(
+            role="assistant",
+            content=_CHARACTER_INTERACT_PREPEND.format(
+                character=knowledge.agent_def.name
+            ),
+        )
+    ]
 
 
 def get_action_messages(
@@ -133,45 +238,92 @@ def get_action_messages(
     conversation: Conversation,
     facts: List[str],
     history: List[Message],
+    preformatted: bool = False,
+    template: Optional[PromptTemplate] = None,
 ) -> List[Message]:
-    return (
-        [get_system_prompt(knowledge, conversation, facts)]
-        + _format_history(knowledge, conversation, history)
-        + [Message(role="system", content="You must return a function call.")]
+    template = template or PromptTemplate(knowledge, conversation)
+    history = _format_history(knowledge, conversation, history, preformatted)
+    return template.messages(facts, history) + [
+        Message(role="system", content="You must return a function call.")
+    ]
+
+
+def format_history_message(
+    knowledge: Knowledge, conversation: Conversation, message: Message
+) -> Message:
+    """How a message of the conversation history appears in prompts. Depends only
+    on the agent's name and the correspondent's, so it can be cached until either
+    changes. Pass preformatted to get_*_messages for history formatted with it."""
+    # Summaries of earlier messages
+    if message.role == "system":
+        return message
+
+    if message.role == "user":
+        character = (
+            conversation.correspondent.name if conversation.correspondent else "Player"
+        )
+    else:
+        character = knowledge.agent_def.name
+
+    new_message = message.copy()
+    new_message.content = _CHARACTER_DIALOG_PREPEND.format(
+        character=character, message=message.content
     )
+    return new_message
 
 
 def _format_history(
-    knowledge: Knowledge, conversation: Conversation, history: List[Message]
+    knowledge: Knowledge,
+    conversation: Conversation,
+    history: List[Message],
+    preformatted: bool,
 ) -> List[Message]:
-    def format_message(message: Message) -> Message:
-        if message.role == "user":
-            character = (
-                conversation.correspondent.name
-                if conversation.correspondent
-                else "Player"
-            )
-        else:
-            character = knowledge.agent_def.name
+    if preformatted:
+        return history
+    return [
+        format_history_message(knowledge, conversation, message) for message in history
+    ]
 
-        new_message = message.copy()
-        new_message.content = _CHARACTER_DIALOG_PREPEND.format(
-            character=character, message=message.content
-        )
-        return new_message
 
-    return [format_message(message) for message in history]
+_SUMMARY_PREPEND = "Summary of the conversation so far: {summary}"
+
+
+def get_summary_message(summary: str) -> Message:
+    """Stands in for the messages that `summary` summarizes."""
+    return Message(role="system", content=_SUMMARY_PREPEND.format(summary=summary))
+
+
+def get_summarize_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    summary: Optional[str],
+    history: List[Message],
+) -> List[Message]:
+    """Asks for a summary of `history`, which follows on from `summary`."""
+    instructions = """Summarize the following conversation from \
+{knowledge.agent_def.name}'s point of view in one paragraph. Keep the names, facts, \
+promises and events that {knowledge.agent_def.name} would remember. Respond with \
+the summary only."""
+
+    return (
+        [Message(role="system", content=instructions.format(knowledge=knowledge))]
+        + ([get_summary_message(summary)] if summary else [])
+        + _format_history(knowledge, conversation, history, preformatted=False)
+    )
+
+
+def response_prefixes(agent_name: str) -> List[str]:
+    """What the LLM sometimes starts its responses with, imitating the prompt."""
+    return [
+        _CHARACTER_DIALOG_PREPEND.format(character=agent_name, message="").strip(),
+        _CHARACTER_INTERACT_PREPEND.format(character=agent_name).strip(),
+    ]
 
 
 def clean_response(agent_name: str, message: Message) -> Message:
-    dialog_prepend = _CHARACTER_DIALOG_PREPEND.format(
-        character=agent_name, message=""
-    ).strip()
-    if message.content.startswith(dialog_prepend):
-        message.content = message.content[len(dialog_prepend) :]
-    interact_prepend = _CHARACTER_INTERACT_PREPEND.format(character=agent_name).strip()
-    if message.content.startswith(interact_prepend):
-        message.content = message.content[len(interact_prepend) :]
+    for prefix in response_prefixes(agent_name):
+        if message.content.startswith(prefix):
+            message.content = message.content[len(prefix) :]
     return message
 
 
@@ -181,35 +333,63 @@ def get_query_messages(
     facts: List[List[str]],
     history: List[Message],
     queries: List[str],
+    template: Optional[PromptTemplate] = None,
 ) -> List[List[Message]]:
+    template = template or PromptTemplate(knowledge, conversation)
     query_base = """Pretend you are {knowledge.agent_def.name}'s inner \
 thoughts. Despite what {knowledge.agent_def.name} may be saying, {query}?
 {{your answer here}}. Please respond with the provided Rate() function."""
 
     formatted_queries: List[List[Message]] = []
     for index in range(len(queries)):
-        query = queries[index]
-        base_message = Message(
-            role="system",
-            content=get_knowledge_fragment(knowledge, conversation, facts[index]),
-        )
-
-        name = (
-            conversation.correspondent.name if conversation.correspondent else "player"
-        )
-        user_formatted_query = query.format(
-            agent=knowledge.agent_def.name, player=name, player_character=name
-        )
+        user_formatted_query = _format_query(knowledge, conversation, queries[index])
         formatted_query = query_base.format(
             knowledge=knowledge, query=user_formatted_query
         )
 
         query_as_message = Message(role="system", content=formatted_query)
-        formatted_queries.append([base_message] + history + [query_as_message])
+        formatted_queries.append(
+            template.query_messages(facts[index], history) + [query_as_message]
+        )
 
     return formatted_queries
 
 
+def get_batched_query_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    facts: List[str],
+    history: List[Message],
+    queries: List[str],
+    template: Optional[PromptTemplate] = None,
+) -> List[Message]:
+    """One prompt asking all the queries, to be answered with
+    get_batched_rate_function(len(queries))."""
+    template = template or PromptTemplate(knowledge, conversation)
+    query_base = """Pretend you are {knowledge.agent_def.name}'s inner \
+thoughts. Despite what {knowledge.agent_def.name} may be saying, answer each of \
+these questions:
+{questions}
+Please respond with the provided RateAll() function, with a rating for each \
+question."""
+
+    questions = "\n".join(
+        f"{index + 1}. {_format_query(knowledge, conversation, query)}?"
+        for index, query in enumerate(queries)
+    )
+    formatted_query = query_base.format(knowledge=knowledge, questions=questions)
+    return template.query_messages(facts, history) + [
+        Message(role="system", content=formatted_query)
+    ]
+
+
+def _format_query(knowledge: Knowledge, conversation: Conversation, query: str) -> str:
+    name = conversation.correspondent.name if conversation.correspondent else "player"
+    return query.format(
+        agent=knowledge.agent_def.name, player=name, player_character=name
+    )
+
+
 def get_guardrail_query(
     knowledge: Knowledge,
     user_message: str,
@@ -257,23 +437,61 @@ _RATING_ENUM_MAP: Dict[str, int] = {
 }
 
 
+_RATE_ACTION = Action(
+    name="Rate",
+    description="Answers the question with a rating",
+    parameters=[
+        Parameter(
+            name="rating",
+            description="The rating you want to give in response to the question.",
+            type="string",
+            enum=list(_RATING_ENUM_MAP.keys()),
+        ),
+    ],
+)
+_RATE_FUNCTION = generate_functions_from_actions([_RATE_ACTION])[0]
+
+
 def get_rate_function() -> Dict[str, str]:
+    """Shared by every caller, don't modify it."""
+    return _RATE_FUNCTION
+
+
+@lru_cache(maxsize=None)
+def get_batched_rate_function(count: int) -> Dict[str, str]:
+    """Rates `count` questions at once. Shared by every caller, don't modify it."""
     act = Action(
-        name="Rate",
-        description="Answers the question with a rating",
+        name="RateAll",
+        description="Answers each of the questions with a rating",
         parameters=[
             Parameter(
-                name="rating",
-                description="The rating you want to give in response to the question.",
+                name=f"rating_{index + 1}",
+                description=f"The rating you want to give to question {index + 1}.",
                 type="string",
                 enum=list(_RATING_ENUM_MAP.keys()),
-            ),
+            )
+            for index in range(count)
         ],
     )
-
     return generate_functions_from_actions([act])[0]
 
 
+def ratings_to_ints(
+    completion: Optional[ActionCompletion], count: int
+) -> Optional[List[int]]:
+    """The ratings of a get_batched_rate_function(count) completion, or None unless
+    it has a valid rating for every question."""
+    if completion is None:
+        return None
+    ratings: List[int] = []
+    for index in range(count):
+        rating = completion.args.get(f"rating_{index + 1}")
+        if not isinstance(rating, str) or rating not in _RATING_ENUM_MAP:
+            return None
+        ratings.append(_RATING_ENUM_MAP[rating])
+    return ratings
+
+
 def rating_to_int(completion: Optional[ActionCompletion]) -> int:
     if (
         completion is None
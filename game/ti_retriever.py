@@ -1,11 +1,14 @@
 from __future__ import annotations
 
-from typing import List, Optional, Tuple
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple, TypeVar, Union
 
 import numpy as np
 from numpy.typing import NDArray
 
-from schema import GameStage, Memory, MemoryConfig
+from game.ivf_index import IVFIndex
+from schema import GameStage, Memory, MemoryConfig, MemoryStats
 
 
 # My constraints:
@@ -23,6 +26,21 @@ def time_weighted_importance(
     return importance
 
 
+_INITIAL_CAPACITY = 10
+
+# int8 embeddings are dequantized this many rows at a time while scoring, which
+# bounds the temporary float32 copy.
+_DEQUANTIZE_CHUNK_ROWS = 1024
+
+_ScalarT = TypeVar("_ScalarT", bound=np.generic)
+
+
+def _resized(array: NDArray[_ScalarT], capacity: int) -> NDArray[_ScalarT]:
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
 # TODO: support non-normalized embeddings
 class TIRetriever:
     """A retriever that weights by time and importance"""
@@ -30,42 +48,356 @@ class TIRetriever:
     def __init__(self, memory_config: MemoryConfig):
         self._memory_config = memory_config
         self._memories: List[Memory] = []
-        self._memory_embeddings: NDArray[np.float64] = np.zeros(
-            (10, memory_config.embedding_dims)
+
+        self._quantized = memory_config.embedding_dtype == "int8"
+        # Queries are scored in float64 only if embeddings are stored that way.
+        self._score_dtype = (
+            np.float64 if memory_config.embedding_dtype == "float64" else np.float32
+        )
+
+        # Memories don't keep their embeddings, they live here as contiguous rows.
+        self._memory_embeddings: NDArray[Any] = np.zeros(
+            (_INITIAL_CAPACITY, memory_config.embedding_dims),
+            dtype=memory_config.embedding_dtype,
+        )
+        # Per row scale of int8 embeddings, i.e. embedding ~= scale * int8 row
+        self._memory_scales: NDArray[np.float32] = np.ones(
+            _INITIAL_CAPACITY, dtype=np.float32
+        )
+        self._memory_importances: NDArray[np.float64] = np.zeros(_INITIAL_CAPACITY)
+
+        # (stage, major, minor) of each memory, packed so that the time weight
+        # of every memory can be computed in one pass instead of per Memory.
+        self._memory_timestamps: NDArray[np.int64] = np.zeros(
+            (_INITIAL_CAPACITY, 3), dtype=np.int64
+        )
+        # Memories without a timestamp get no time weight.
+        self._memory_untimed: NDArray[np.bool_] = np.zeros(
+            _INITIAL_CAPACITY, dtype=np.bool_
+        )
+
+        # Scratch space reused by every query so that scoring doesn't allocate.
+        self._scores: NDArray[Any] = np.zeros(
+            _INITIAL_CAPACITY, dtype=self._score_dtype
+        )
+        self._time_scratch: NDArray[np.float64] = np.zeros((2, _INITIAL_CAPACITY))
+
+        self._evictions = 0
+        self._evicted_memories = 0
+
+        self._index = (
+            IVFIndex(
+                memory_config.ivf_lists,
+                memory_config.ivf_probes,
+                memory_config.ivf_train_size,
+            )
+            if memory_config.index == "ivf"
+            else None
+        )
+        self._training_index = False
+
+    @property
+    def stats(self) -> MemoryStats:
+        return MemoryStats(
+            memories=len(self._memories),
+            evictions=self._evictions,
+            evicted_memories=self._evicted_memories,
         )
-        self._memory_importances: NDArray[np.float64] = np.zeros(10)
 
     def get_relevant_memories(
         self, query: Memory, top_k: int
     ) -> List[Tuple[Memory, float]]:
-        top_k = min(len(self._memories), top_k)
-        relevance = self._memory_embeddings @ np.array(query.embedding).T
-        relevance += self._memory_importances / 10
-        for i, memory in enumerate(self._memories):
-            relevance[i] += time_weighted_importance(query.timestamp, memory)
-        return [
-            (self._memories[i], float(relevance[i]))
-            for i in np.argpartition(relevance, -top_k)[-top_k:]
-            if i < len(self._memories)
-        ]
-
-    def add_memory(self, memory: Memory) -> None:
+        return self.get_relevant_memories_grouped([[query]], top_k)[0]
+
+    def get_relevant_memories_grouped(
+        self,
+        query_groups: List[List[Memory]],
+        top_k: int,
+        visible: Optional[NDArray[np.bool_]] = None,
+    ) -> List[List[Tuple[Memory, float]]]:
+        """Scores every query against every memory with a single matrix product.
+        For each group of queries, returns the top_k memories by their best score
+        among the group's queries, from most to least relevant.
+
+        If given, only memories whose row is set in `visible` are considered."""
+        num_memories = len(self._memories)
+        top_k = min(num_memories, top_k)
+
+        # The same query can be shared between groups, only score it once.
+        query_columns: Dict[int, int] = {}
+        queries: List[Memory] = []
+        group_columns: List[List[int]] = []
+        for group in query_groups:
+            columns: List[int] = []
+            for query in group:
+                if id(query) not in query_columns:
+                    query_columns[id(query)] = len(queries)
+                    queries.append(query)
+                columns.append(query_columns[id(query)])
+            group_columns.append(columns)
+
+        if top_k <= 0 or not queries:
+            return [[] for _ in query_groups]
+
+        relevance, rows = self._score(queries, visible)
+        top_k = min(len(relevance), top_k)
+        if top_k <= 0:
+            return [[] for _ in query_groups]
+
+        results: List[List[Tuple[Memory, float]]] = []
+        for columns in group_columns:
+            if not columns:
+                results.append([])
+                continue
+
+            if len(columns) == 1:
+                group_relevance = relevance[:, columns[0]]
+            else:
+                group_relevance = relevance[:, columns].max(axis=1)
+
+            top = np.argpartition(group_relevance, -top_k)[-top_k:]
+            top = top[np.argsort(-group_relevance[top], kind="stable")]
+            results.append(
+                [
+                    (
+                        self._memories[i if rows is None else rows[i]],
+                        float(group_relevance[i]),
+                    )
+                    for i in top
+                ]
+            )
+
+        return results
+
+    def get_embedding(self, memory: Memory) -> NDArray[np.float32]:
+        """Returns a copy of the embedding of a memory held by this retriever."""
+        row = memory.embedding_row
+        if (
+            row is None
+            or row >= len(self._memories)
+            or self._memories[row] is not memory
+        ):
+            raise ValueError(f"Memory is not held by this retriever: {memory}")
+        return self._float32_rows(slice(row, row + 1))[0].copy()
+
+    def add_memory(self, memory: Memory, train_index: bool = True) -> None:
+        """Takes ownership of `memory`. If train_index is off, the ivf index is left
+        for train_index_in_thread() to train."""
+        if len(self._memories) >= self._memory_config.max_memories:
+            self._evict(memory.timestamp)
+
         self._memories.append(memory)
+        index = len(self._memories) - 1
 
-        # TODO: delete memories when it goes over max_memories
-        # Doubling size keeps add_memory linear time
+        # Doubling size keeps add_memory linear time. Eviction above guarantees
+        # that we never need more than max_memories rows.
         if len(self._memories) > len(self._memory_embeddings):
-            self._memory_embeddings = np.concatenate(
-                (
-                    self._memory_embeddings,
-                    np.zeros((len(self._memories), len(self._memory_embeddings[0]))),
-                ),
-                axis=0,
+            self._grow(
+                min(2 * len(self._memory_embeddings), self._memory_config.max_memories)
+            )
+
+        if self._quantized:
+            embedding = np.asarray(memory.embedding, dtype=np.float32)
+            scale = float(np.abs(embedding).max()) / 127 or 1.0
+            self._memory_embeddings[index] = np.round(embedding / scale)
+            self._memory_scales[index] = scale
+        else:
+            self._memory_embeddings[index] = memory.embedding
+        memory.move_embedding(index)
+        self._memory_importances[index] = memory.importance
+        if memory.timestamp:
+            self._memory_timestamps[index] = (
+                memory.timestamp.stage,
+                memory.timestamp.major,
+                memory.timestamp.minor,
+            )
+            self._memory_untimed[index] = False
+        else:
+            self._memory_timestamps[index] = 0
+            self._memory_untimed[index] = True
+
+        if self._index is not None:
+            self._index.add(index, self._float32_rows(slice(index, index + 1))[0])
+            if train_index and self._index.needs_training(len(self._memories)):
+                self._index.train(len(self._memories), self._float32_rows)
+
+    async def train_index_in_thread(self) -> None:
+        """Trains the ivf index if it needs it, in a worker thread so that the event
+        loop isn't held up by k-means. Until it's done, searches use the index as it
+        was. Does nothing if the index is already being trained."""
+        num_rows = len(self._memories)
+        if (
+            self._index is None
+            or self._training_index
+            or not self._index.needs_training(num_rows)
+        ):
+            return
+
+        evictions = self._evictions
+        fit = self._index.fitter(self._float32_rows(slice(0, num_rows)).copy())
+        self._training_index = True
+        try:
+            fitted = await asyncio.to_thread(fit)
+        finally:
+            self._training_index = False
+        # Eviction moves rows around, so the fit no longer matches them. The index
+        # is trained again with the next memory.
+        if self._evictions == evictions:
+            self._index.install(fitted, len(self._memories), self._float32_rows)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Dev mode pickles sessions. Training in progress is simply started again.
+        return {**self.__dict__, "_training_index": False}
+
+    def _float32_rows(
+        self, rows: Union[slice, NDArray[np.intp]]
+    ) -> NDArray[np.float32]:
+        """Embeddings of the given rows as float32. Only copies when it has to."""
+        embeddings = self._memory_embeddings[rows]
+        if self._quantized:
+            return embeddings * self._memory_scales[rows, np.newaxis]
+        return embeddings.astype(np.float32, copy=False)
+
+    def _score(
+        self, queries: List[Memory], visible: Optional[NDArray[np.bool_]] = None
+    ) -> Tuple[NDArray[Any], Optional[NDArray[np.intp]]]:
+        """Relevance of memories (rows) to every query (columns). Returns a view into
+        scratch space that is only valid until the next call.
+
+        If only some rows are visible, or there's an index, only those rows (or the
+        candidate rows the index returns) are scored, and the rows are returned as
+        well."""
+        num_memories = len(self._memories)
+        query_matrix = np.array(
+            [query.embedding for query in queries], dtype=self._score_dtype
+        ).T
+
+        rows: Optional[NDArray[np.intp]] = None
+        if self._index is not None and self._index.trained:
+            rows = self._index.candidates(query_matrix.astype(np.float32), num_memories)
+            if visible is not None:
+                rows = rows[visible[rows]]
+        elif visible is not None:
+            rows = np.flatnonzero(visible[:num_memories])
+        num_scored = num_memories if rows is None else len(rows)
+
+        if self._scores.size < num_scored * len(queries):
+            self._scores = np.zeros(
+                len(self._memory_embeddings) * len(queries), dtype=self._score_dtype
             )
+        relevance = self._scores[: num_scored * len(queries)].reshape(
+            num_scored, len(queries)
+        )
 
-            self._memory_importances = np.concatenate(
-                (self._memory_importances, np.zeros(len(self._memories)))
+        if rows is not None:
+            np.matmul(
+                self._float32_rows(rows).astype(self._score_dtype, copy=False),
+                query_matrix,
+                out=relevance,
+            )
+        elif self._quantized:
+            for start in range(0, num_memories, _DEQUANTIZE_CHUNK_ROWS):
+                end = min(start + _DEQUANTIZE_CHUNK_ROWS, num_memories)
+                np.matmul(
+                    self._memory_embeddings[start:end].astype(np.float32),
+                    query_matrix,
+                    out=relevance[start:end],
+                )
+            relevance *= self._memory_scales[:num_memories, np.newaxis]
+        else:
+            np.matmul(
+                self._memory_embeddings[:num_memories], query_matrix, out=relevance
             )
 
-        self._memory_embeddings[len(self._memories) - 1] = memory.embedding
-        self._memory_importances[len(self._memories) - 1] = memory.importance
+        selected = slice(0, num_memories) if rows is None else rows
+        importance = self._time_scratch[0, :num_scored]
+        np.divide(self._memory_importances[selected], 10, out=importance)
+        relevance += importance[:, np.newaxis]
+
+        for column, query in enumerate(queries):
+            if query.timestamp:
+                relevance[:, column] += self._time_weighted_importances(
+                    query.timestamp, rows
+                )
+
+        return relevance, rows
+
+    def _evict(self, current_time: Optional[GameStage]) -> None:
+        """Forgets the memories with the lowest time weighted importance, then
+        compacts the remaining memories to the front of the arrays."""
+        num_memories = len(self._memories)
+        num_evicted = min(
+            num_memories,
+            max(
+                1,
+                int(
+                    self._memory_config.max_memories
+                    * self._memory_config.eviction_fraction
+                ),
+            ),
+        )
+
+        importance = self._scores[:num_memories]
+        np.divide(self._memory_importances[:num_memories], 10, out=importance)
+        if current_time:
+            importance += self._time_weighted_importances(current_time)
+
+        keep = np.ones(num_memories, dtype=np.bool_)
+        keep[np.argpartition(importance, num_evicted - 1)[:num_evicted]] = False
+        kept = np.flatnonzero(keep)
+        num_kept = len(kept)
+
+        self._memory_embeddings[:num_kept] = self._memory_embeddings[kept]
+        self._memory_scales[:num_kept] = self._memory_scales[kept]
+        self._memory_importances[:num_kept] = self._memory_importances[kept]
+        self._memory_timestamps[:num_kept] = self._memory_timestamps[kept]
+        self._memory_untimed[:num_kept] = self._memory_untimed[kept]
+        if self._index is not None:
+            self._index.compact(kept)
+        self._memories = [self._memories[i] for i in kept]
+        for row, memory in enumerate(self._memories):
+            memory.move_embedding(row)
+
+        self._evictions += 1
+        self._evicted_memories += num_evicted
+        logging.getLogger().debug(
+            f"Evicted {num_evicted} memories, {num_kept} remaining. "
+            f"{self._evicted_memories} evicted in total."
+        )
+
+    def _time_weighted_importances(
+        self, current_time: GameStage, rows: Optional[NDArray[np.intp]] = None
+    ) -> NDArray[np.float64]:
+        """Vectorized time_weighted_importance() for the given rows, or every stored
+        memory. Returns a view into scratch space that is only valid until the next
+        call."""
+        selected = slice(0, len(self._memories)) if rows is None else rows
+        timestamps = self._memory_timestamps[selected]
+        untimed = self._memory_untimed[selected]
+        weights = self._time_scratch[0, : len(timestamps)]
+        term = self._time_scratch[1, : len(timestamps)]
+
+        np.subtract(current_time.stage + 1, timestamps[:, 0], out=weights)
+        np.power(0.5, weights, out=weights)
+
+        np.subtract(current_time.major, timestamps[:, 1], out=term)
+        np.power(0.8, term, out=term)
+        term *= 0.4
+        weights += term
+
+        np.subtract(current_time.minor, timestamps[:, 2], out=term)
+        np.power(0.9, term, out=term)
+        term *= 0.1
+        weights += term
+
+        np.copyto(weights, 0, where=untimed)
+        return weights
+
+    def _grow(self, capacity: int) -> None:
+        self._memory_embeddings = _resized(self._memory_embeddings, capacity)
+        self._memory_scales = _resized(self._memory_scales, capacity)
+        self._memory_importances = _resized(self._memory_importances, capacity)
+        self._memory_timestamps = _resized(self._memory_timestamps, capacity)
+        self._memory_untimed = _resized(self._memory_untimed, capacity)
+        self._scores = np.zeros(capacity, dtype=self._score_dtype)
+        self._time_scratch = np.zeros((2, capacity))
@@ -1,5 +1,7 @@
+import asyncio
+import inspect
 from abc import abstractmethod
-from typing import Dict, List, Optional, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
 from schema import ActionCompletion, Message
 
@@ -24,6 +26,22 @@ class LLMBase:
     ) -> Optional[ActionCompletion]:
         """Attempts to return a function call from the LLM."""
 
+    async def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        """Streams a chat completion as pieces of text, or yields a single action
+        completion once it's done. Yields the whole completion at once unless the
+        LLM supports streaming."""
+        completion = await self.completion(messages, functions)
+        yield completion.content if isinstance(completion, Message) else completion
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        """Streams a chat completion as pieces of text."""
+        yield (await self.chat_completion(messages)).content
+
     # TODO: make this return number 100% of time when OpenAI supports
     # JSONformer or logit masking or something similar.
     # Or massage this into action_completion for OpenAI and keep it for
@@ -39,7 +57,95 @@ class LLMBase:
     async def embed(self, query: str) -> List[float]:
         """Embeds a piece of text."""
 
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        """Embeds several pieces of text, in one request if the LLM supports it."""
+        return await asyncio.gather(*[self.embed(query) for query in queries])
+
     @property
     @abstractmethod
     def embedding_size(self) -> int:
         """Embedding size."""
+
+    @property
+    def embedding_model(self) -> str:
+        """Identifies the embedding model, e.g. for cache keys."""
+        return type(self).__name__
+
+    @property
+    def completion_model(self) -> str:
+        """Identifies the completion model, e.g. for cache keys."""
+        return type(self).__name__
+
+    def stats(self) -> Dict[str, int]:
+        """Counters describing how calls to the LLM have been handled."""
+        return {}
+
+
+class LLMWrapper(LLMBase):
+    """Base class for layers around another LLMBase. Every call is forwarded to the
+    wrapped LLM unless a subclass overrides it, and stats are merged."""
+
+    def __init__(self, llm: LLMBase):
+        self._llm = llm
+
+    async def completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Union[Message, ActionCompletion]:
+        return await self._llm.completion(messages, functions)
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        return await self._llm.chat_completion(messages)
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        return await self._llm.action_completion(messages, functions)
+
+    def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        return self._llm.stream_completion(messages, functions)
+
+    def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        return self._llm.stream_chat_completion(messages)
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        return await self._llm.digit_completions(query_messages)
+
+    async def embed(self, query: str) -> List[float]:
+        return await self._llm.embed(query)
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        return await self._llm.embed_batch(queries)
+
+    @property
+    def embedding_size(self) -> int:
+        return self._llm.embedding_size
+
+    @property
+    def embedding_model(self) -> str:
+        return self._llm.embedding_model
+
+    @property
+    def completion_model(self) -> str:
+        return self._llm.completion_model
+
+    def stats(self) -> Dict[str, int]:
+        return self._llm.stats()
+
+
+async def close_stream(stream: AsyncIterator[Any]) -> None:
+    """Closes `stream` if it's an async generator, so that what it holds, such as an
+    HTTP response or a scheduler slot, is let go now rather than once it's garbage
+    collected."""
+    if inspect.isasyncgen(stream):
+        await stream.aclose()
@@ -0,0 +1,67 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+from typing import AsyncContextManager, Generator, Optional
+
+
+class CallKind(str, Enum):
+    """What an LLM call is made for, so that LLM layers can treat calls differently
+    without every LLMBase method taking it as an argument."""
+
+    CHAT = "chat"
+    INTERACT = "interact"
+    ACT = "act"
+    QUERY = "query"
+    GUARDRAIL = "guardrail"
+    IMPORTANCE = "importance"
+    RATE = "rate"
+    SUMMARIZE = "summarize"
+
+
+_call_kind: ContextVar[Optional[CallKind]] = ContextVar("call_kind", default=None)
+
+
+@contextmanager
+def call_kind(kind: CallKind) -> Generator[None, None, None]:
+    """LLM calls made inside this block, including in tasks it starts, are `kind`."""
+    token = _call_kind.set(kind)
+    try:
+        yield
+    finally:
+        _call_kind.reset(token)
+
+
+def current_call_kind() -> Optional[CallKind]:
+    return _call_kind.get()
+
+
+class CallSlot(ABC):
+    """The room a call holds in a layer that bounds the requests in flight, such as
+    llm.scheduler.LLMScheduler. Layers below it that wait between requests, or send
+    more than one at a time, use it to stay within the bound."""
+
+    @abstractmethod
+    def paused(self) -> AsyncContextManager[None]:
+        """Gives up the room inside this block, and takes it back on the way out."""
+
+    @abstractmethod
+    def extra(self) -> AsyncContextManager[None]:
+        """Holds room for another request inside this block."""
+
+
+_call_slot: ContextVar[Optional[CallSlot]] = ContextVar("call_slot", default=None)
+
+
+@contextmanager
+def call_slot(slot: CallSlot) -> Generator[None, None, None]:
+    """LLM calls made inside this block, including in tasks it starts, hold `slot`."""
+    token = _call_slot.set(slot)
+    try:
+        yield
+    finally:
+        _call_slot.reset(token)
+
+
+def current_call_slot() -> Optional[CallSlot]:
+    return _call_slot.get()
@@ -0,0 +1,334 @@
+import asyncio
+import base64
+import gzip
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from llm.base import LLMBase, LLMWrapper
+from llm.hashing import request_hash
+from schema import ActionCompletion, Message
+
+# A recorded response, and how many seconds it took
+Recording = Tuple[float, Any]
+
+
+class CassetteMiss(KeyError):
+    """Raised when a replayed request wasn't recorded."""
+
+
+class Cassette:
+    """LLM responses, as JSON, and how long they took, keyed by request_hash.
+
+    A request recorded several times (e.g. a prompt repeated with different
+    outcomes) replays its responses in order, then repeats the last one.
+
+    Saved as gzipped JSON lines, with embeddings as base64 float32."""
+
+    def __init__(self, embedding_size: int, embedding_model: str):
+        self.embedding_size = embedding_size
+        self.embedding_model = embedding_model
+        self._recordings: Dict[str, List[Recording]] = {}
+        self._replayed: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return sum(len(recordings) for recordings in self._recordings.values())
+
+    def record(self, key: str, latency: float, response: Any) -> None:
+        self._recordings.setdefault(key, []).append((latency, response))
+
+    def replay(self, key: str) -> Optional[Recording]:
+        recordings = self._recordings.get(key)
+        if not recordings:
+            return None
+        i = self._replayed.get(key, 0)
+        self._replayed[key] = i + 1
+        return recordings[min(i, len(recordings) - 1)]
+
+    def save(self, path: str) -> None:
+        with gzip.open(path, "wt") as f:
+            header = dict(
+                embedding_size=self.embedding_size,
+                embedding_model=self.embedding_model,
+            )
+            f.write(json.dumps(header) + "\n")
+            for key, recordings in self._recordings.items():
+                for latency, response in recordings:
+                    f.write(json.dumps([key, round(latency, 4), response]) + "\n")
+
+    @classmethod
+    def load(cls, path: str) -> "Cassette":
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline())
+            cassette = cls(header["embedding_size"], header["embedding_model"])
+            for line in f:
+                key, latency, response = json.loads(line)
+                cassette.record(key, latency, response)
+        return cassette
+
+
+class RecordingLLM(LLMWrapper):
+    """Records every response of the wrapped LLM, and how long it took, into
+    `cassette`. Embeddings and digit completions are recorded per text and per
+    query, so that they replay however they end up batched."""
+
+    def __init__(self, llm: LLMBase, cassette: Optional[Cassette] = None):
+        super().__init__(llm)
+        self.cassette = cassette or Cassette(llm.embedding_size, llm.embedding_model)
+
+    async def completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Union[Message, ActionCompletion]:
+        key = request_hash("completion", messages, functions)
+        start_time = time.monotonic()
+        completion = await self._llm.completion(messages, functions)
+        self._record(key, start_time, _encode_piece(completion))
+        return completion
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        key = request_hash("chat_completion", messages)
+        start_time = time.monotonic()
+        completion = await self._llm.chat_completion(messages)
+        self._record(key, start_time, completion.dict())
+        return completion
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        key = request_hash("action_completion", messages, functions)
+        start_time = time.monotonic()
+        completion = await self._llm.action_completion(messages, functions)
+        self._record(key, start_time, completion.dict() if completion else None)
+        return completion
+
+    async def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        key = request_hash("stream_completion", messages, functions)
+        start_time = time.monotonic()
+        pieces: List[Any] = []
+        async for piece in self._llm.stream_completion(messages, functions):
+            pieces.append([time.monotonic() - start_time, _encode_piece(piece)])
+            yield piece
+        self._record(key, start_time, pieces)
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        key = request_hash("stream_chat_completion", messages)
+        start_time = time.monotonic()
+        pieces: List[Any] = []
+        async for piece in self._llm.stream_chat_completion(messages):
+            pieces.append([time.monotonic() - start_time, piece])
+            yield piece
+        self._record(key, start_time, pieces)
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        keys = [request_hash("digit_completion", m) for m in query_messages]
+        start_time = time.monotonic()
+        digits = await self._llm.digit_completions(query_messages)
+        for key, digit in zip(keys, digits):
+            self._record(key, start_time, digit)
+        return digits
+
+    async def embed(self, query: str) -> List[float]:
+        key = request_hash("embed", query)
+        start_time = time.monotonic()
+        embedding = await self._llm.embed(query)
+        self._record(key, start_time, _encode_embedding(embedding))
+        return embedding
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        start_time = time.monotonic()
+        embeddings = await self._llm.embed_batch(queries)
+        for query, embedding in zip(queries, embeddings):
+            key = request_hash("embed", query)
+            self._record(key, start_time, _encode_embedding(embedding))
+        return embeddings
+
+    def _record(self, key: str, start_time: float, response: Any) -> None:
+        """Records `response` under the request's hash, `key`. The hash is taken
+        before the request is sent, since the LLM may add to the messages while
+        retrying (e.g. asking again for a function call)."""
+        self.cassette.record(key, time.monotonic() - start_time, response)
+
+
+class ReplayLLM(LLMBase):
+    """Serves responses recorded by RecordingLLM, instantly or, if realtime is set,
+    after as long as they originally took.
+
+    Requests that weren't recorded go to `fallback` if one is given, and otherwise
+    raise CassetteMiss."""
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        realtime: bool = False,
+        fallback: Optional[LLMBase] = None,
+    ):
+        self._cassette = cassette
+        self._realtime = realtime
+        self._fallback = fallback
+        self._hits = 0
+        self._misses = 0
+
+    async def completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Union[Message, ActionCompletion]:
+        try:
+            completion = _decode_piece(
+                await self._replay("completion", messages, functions)
+            )
+        except CassetteMiss as miss:
+            return await self._require_fallback(miss).completion(messages, functions)
+        assert not isinstance(completion, str)
+        return completion
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        try:
+            response = await self._replay("chat_completion", messages)
+        except CassetteMiss as miss:
+            return await self._require_fallback(miss).chat_completion(messages)
+        return Message.parse_obj(response)
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        try:
+            response = await self._replay("action_completion", messages, functions)
+        except CassetteMiss as miss:
+            return await self._require_fallback(miss).action_completion(
+                messages, functions
+            )
+        return ActionCompletion.parse_obj(response) if response else None
+
+    async def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        try:
+            pieces = await self._replay("stream_completion", messages, functions)
+        except CassetteMiss as miss:
+            fallback = self._require_fallback(miss)
+            async for piece in fallback.stream_completion(messages, functions):
+                yield piece
+            return
+
+        async for piece in self._play_stream(pieces):
+            decoded = _decode_piece(piece)
+            assert not isinstance(decoded, Message)
+            yield decoded
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        try:
+            pieces = await self._replay("stream_chat_completion", messages)
+        except CassetteMiss as miss:
+            async for piece in self._require_fallback(miss).stream_chat_completion(
+                messages
+            ):
+                yield piece
+            return
+
+        async for piece in self._play_stream(pieces):
+            yield piece
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        async def digit_completion(messages: List[Message]) -> int:
+            try:
+                return await self._replay("digit_completion", messages)
+            except CassetteMiss as miss:
+                fallback = self._require_fallback(miss)
+                return (await fallback.digit_completions([messages]))[0]
+
+        return await asyncio.gather(*[digit_completion(m) for m in query_messages])
+
+    async def embed(self, query: str) -> List[float]:
+        try:
+            response = await self._replay("embed", query)
+        except CassetteMiss as miss:
+            return await self._require_fallback(miss).embed(query)
+        return _decode_embedding(response)
+
+    @property
+    def embedding_size(self) -> int:
+        return self._cassette.embedding_size
+
+    @property
+    def embedding_model(self) -> str:
+        return self._cassette.embedding_model
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **(self._fallback.stats() if self._fallback else {}),
+            "cassette_hits": self._hits,
+            "cassette_misses": self._misses,
+        }
+
+    async def _replay(self, operation: str, *request: Any) -> Any:
+        """The recorded response. Waits out the recorded latency if realtime is
+        set, except for streams which wait before each piece."""
+        recording = self._cassette.replay(request_hash(operation, *request))
+        if recording is None:
+            self._misses += 1
+            raise CassetteMiss(f"No {operation} recorded for this request")
+
+        self._hits += 1
+        latency, response = recording
+        if self._realtime and not operation.startswith("stream"):
+            await asyncio.sleep(latency)
+        return response
+
+    async def _play_stream(self, pieces: List[Any]) -> AsyncIterator[Any]:
+        played = 0.0
+        for at, piece in pieces:
+            if self._realtime:
+                await asyncio.sleep(at - played)
+                played = at
+            yield piece
+
+    def _require_fallback(self, miss: CassetteMiss) -> LLMBase:
+        """The fallback, or raises `miss` if there's none."""
+        if self._fallback is None:
+            raise miss
+        return self._fallback
+
+
+def _encode_piece(piece: Union[str, Message, ActionCompletion]) -> Any:
+    if isinstance(piece, ActionCompletion):
+        return dict(action=piece.dict())
+    if isinstance(piece, Message):
+        return dict(message=piece.dict())
+    return piece
+
+
+def _decode_piece(piece: Any) -> Union[str, Message, ActionCompletion]:
+    if isinstance(piece, str):
+        return piece
+    if "action" in piece:
+        return ActionCompletion.parse_obj(piece["action"])
+    return Message.parse_obj(piece["message"])
+
+
+def _encode_embedding(embedding: List[float]) -> str:
+    return base64.b64encode(np.asarray(embedding, np.float32).tobytes()).decode()
+
+
+def _decode_embedding(encoded: str) -> List[float]:
+    return np.frombuffer(base64.b64decode(encoded), np.float32).tolist()
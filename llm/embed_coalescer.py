@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from llm.base import LLMBase, LLMWrapper
+
+
+class EmbedCoalescer(LLMWrapper):
+    """Sends concurrent embed() calls to the wrapped LLM as one embed_batch() call.
+
+    The first call starts a window of window_seconds. Every call made during the
+    window joins the batch, which is sent when the window ends or when it reaches
+    max_batch_size texts, whichever comes first. Identical texts in a batch are only
+    sent once. If a batch fails, its texts are retried one by one."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        window_seconds: float = 0.005,
+        max_batch_size: int = 256,
+    ):
+        super().__init__(llm)
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, "asyncio.Future[List[float]]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The event loop only keeps weak references to tasks.
+        self._sends: Set["asyncio.Task[None]"] = set()
+        self._batches = 0
+        self._batched_queries = 0
+
+    async def embed(self, query: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[List[float]]" = loop.create_future()
+        self._pending.append((query, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window_seconds, self._flush)
+
+        return await future
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._llm.stats(),
+            "embed_batches": self._batches,
+            "embed_batched_queries": self._batched_queries,
+        }
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            send = asyncio.create_task(self._send(batch))
+            self._sends.add(send)
+            send.add_done_callback(self._sends.discard)
+
+    async def _send(
+        self, batch: List[Tuple[str, "asyncio.Future[List[float]]"]]
+    ) -> None:
+        queries = list(dict.fromkeys(query for query, _ in batch))
+        self._batches += 1
+        self._batched_queries += len(queries)
+
+        try:
+            results = await self._embed_queries(queries)
+        except BaseException:
+            # Cancelled, e.g. on shutdown. Callers mustn't wait forever.
+            for _, future in batch:
+                future.cancel()
+            raise
+
+        for query, future in batch:
+            # Callers that were cancelled while waiting have no use for the result.
+            if future.done():
+                continue
+            result = results[query]
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _embed_queries(
+        self, queries: List[str]
+    ) -> Dict[str, Union[List[float], BaseException]]:
+        """Embeds the queries in one batch. If the batch fails, they're embedded one
+        by one, so that a bad query only fails its own callers."""
+        try:
+            return dict(zip(queries, await self._llm.embed_batch(queries)))
+        except Exception as e:
+            if len(queries) == 1:
+                return {queries[0]: e}
+            logging.getLogger().exception(
+                f"Embedding a batch of {len(queries)} failed, embedding one by one"
+            )
+
+        embeddings = await asyncio.gather(
+            *[self._llm.embed(query) for query in queries], return_exceptions=True
+        )
+        return dict(zip(queries, embeddings))
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from llm.base import LLMBase, LLMWrapper
+
+REDIS_KEY_PREFIX = "embedding"
+
+
+class EmbeddingCache(LLMWrapper):
+    """Caches embeddings by model and text hash.
+
+    Lookups go to a bounded in-process LRU first, then to Redis if a client is given.
+    Embeddings are kept as float32, in memory and in Redis as raw bytes, which is
+    also the precision agents store them at by default, so every path returns the
+    same values. Redis errors are logged and treated as misses so that the cache
+    never fails an embed call."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        max_entries: int = 4096,
+        redis: Optional[Redis[bytes]] = None,
+    ):
+        super().__init__(llm)
+        self._max_entries = max_entries
+        self._redis = redis
+        # float32 like in redis, rather than a list of boxed floats
+        self._entries: OrderedDict[str, NDArray[np.float32]] = OrderedDict()
+        self._hits = 0
+        self._redis_hits = 0
+        self._misses = 0
+
+    async def embed(self, query: str) -> List[float]:
+        key = self._key(query)
+
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return embedding.tolist()
+
+        embedding = await self._redis_get(key)
+        if embedding is not None:
+            self._redis_hits += 1
+        else:
+            self._misses += 1
+            embedding = np.asarray(await self._llm.embed(query), dtype=np.float32)
+            await self._redis_set(key, embedding)
+
+        self._remember(key, embedding)
+        return embedding.tolist()
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        return await asyncio.gather(*[self.embed(query) for query in queries])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._llm.stats(),
+            "embedding_cache_hits": self._hits,
+            "embedding_cache_redis_hits": self._redis_hits,
+            "embedding_cache_misses": self._misses,
+        }
+
+    def _key(self, query: str) -> str:
+        digest = hashlib.sha256(query.encode()).hexdigest()
+        return f"{REDIS_KEY_PREFIX}:{self.embedding_model}:{digest}"
+
+    def _remember(self, key: str, embedding: NDArray[np.float32]) -> None:
+        self._entries[key] = embedding
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def _redis_get(self, key: str) -> Optional[NDArray[np.float32]]:
+        if self._redis is None:
+            return None
+        try:
+            value = await self._redis.get(key)
+        except RedisError:
+            logging.getLogger().exception("Embedding cache lookup failed")
+            return None
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32)
+
+    async def _redis_set(self, key: str, embedding: NDArray[np.float32]) -> None:
+        if self._redis is None:
+            return
+        try:
+            await self._redis.set(key, embedding.tobytes())
+        except RedisError:
+            logging.getLogger().exception("Embedding cache store failed")
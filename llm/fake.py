@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import math
+import random
+import re
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Literal, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from openai.error import RateLimitError
+
+from llm.base import LLMBase
+from llm.openai import retry_after
+from llm.retry import RetryPolicy
+from schema import ActionCompletion, Message
+
+LatencyDistribution = Literal["constant", "uniform", "exponential", "lognormal"]
+
+# Spread of the lognormal distribution. Gives a p99 of about 5x the mean.
+_LOGNORMAL_SIGMA = 1.0
+
+_CANNED_RESPONSES = [
+    "I'm not sure what you mean.",
+    "That's an interesting thought, tell me more.",
+    "Let me think about that for a moment.",
+    "I'd rather not say, stranger.",
+    "Is that so? I had no idea.",
+]
+
+# How often completion() calls a function, when it's given any.
+_FUNCTION_CALL_ODDS = 4
+
+
+def _stable_hash(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+
+
+@lru_cache(maxsize=65536)
+def _word_vector(word: str, size: int) -> NDArray[np.float64]:
+    return np.random.default_rng(_stable_hash(word)).standard_normal(size)
+
+
+class FakeLLM(LLMBase):
+    """An LLM that needs no network, for load tests, benchmarks and CI.
+
+    Everything it returns is a function of its input. Embeddings are the normalized
+    sum of a random vector per word, so texts sharing words are similar. Chats get
+    one of a few canned lines, and function calls are filled in with a hashed choice
+    of each parameter's allowed values.
+
+    Every request takes a random latency with the given mean (in seconds), and
+    fails with a RateLimitError at error_rate, which the retry policy retries."""
+
+    def __init__(
+        self,
+        embedding_size: int = 1536,
+        latency: float = 0.0,
+        latency_distribution: LatencyDistribution = "constant",
+        embedding_latency: float = 0.0,
+        stream_token_latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        self._embedding_size = embedding_size
+        self._latency = latency
+        self._latency_distribution: LatencyDistribution = latency_distribution
+        self._embedding_latency = embedding_latency
+        self._stream_token_latency = stream_token_latency
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._retry_policy = retry_policy or RetryPolicy()
+
+    async def completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Union[Message, ActionCompletion]:
+        await self._request("completion", self._latency)
+        if functions and _prompt_hash(messages) % _FUNCTION_CALL_ODDS == 0:
+            return _function_call(messages, functions)
+        return _chat(messages)
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        await self._request("chat_completion", self._latency)
+        return _chat(messages)
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        await self._request("action_completion", self._latency)
+        if not functions:
+            return None
+        return _function_call(messages, functions)
+
+    async def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        completion = await self.completion(messages, functions)
+        if isinstance(completion, ActionCompletion):
+            yield completion
+            return
+
+        for i, piece in enumerate(re.findall(r"\S+\s*", completion.content)):
+            if i > 0 and self._stream_token_latency:
+                await asyncio.sleep(self._stream_token_latency)
+            yield piece
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        async for piece in self.stream_completion(messages, []):
+            if isinstance(piece, str):
+                yield piece
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        async def digit_completion(messages: List[Message]) -> int:
+            await self._request("digit_completion", self._latency)
+            return _prompt_hash(messages) % 10
+
+        return await asyncio.gather(*[digit_completion(m) for m in query_messages])
+
+    async def embed(self, query: str) -> List[float]:
+        await self._request("embedding", self._embedding_latency)
+        return self._embedding(query)
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        await self._request("embedding", self._embedding_latency)
+        return [self._embedding(query) for query in queries]
+
+    @property
+    def embedding_size(self) -> int:
+        return self._embedding_size
+
+    def stats(self) -> Dict[str, int]:
+        return self._retry_policy.stats()
+
+    def _embedding(self, text: str) -> List[float]:
+        words = re.findall(r"\w+", text.lower()) or [text]
+        vector = np.zeros(self._embedding_size)
+        for word in words:
+            vector += _word_vector(word, self._embedding_size)
+        return (vector / max(np.linalg.norm(vector), 1e-12)).tolist()
+
+    async def _request(self, operation: str, mean_latency: float) -> None:
+        async def request() -> None:
+            await asyncio.sleep(self._draw_latency(mean_latency))
+            if self._random.random() < self._error_rate:
+                raise RateLimitError("Injected by FakeLLM", headers={})
+
+        await self._retry_policy.run(operation, request, retry_after)
+
+    def _draw_latency(self, mean: float) -> float:
+        if mean <= 0:
+            return 0
+        draw: Dict[LatencyDistribution, Callable[[], float]] = {
+            "constant": lambda: mean,
+            "uniform": lambda: self._random.uniform(0, 2 * mean),
+            "exponential": lambda: self._random.expovariate(1 / mean),
+            "lognormal": lambda: self._random.lognormvariate(
+                math.log(mean) - _LOGNORMAL_SIGMA**2 / 2, _LOGNORMAL_SIGMA
+            ),
+        }
+        return draw[self._latency_distribution]()
+
+
+def _prompt_hash(messages: List[Message]) -> int:
+    return _stable_hash("\n".join(message.content for message in messages))
+
+
+def _chat(messages: List[Message]) -> Message:
+    content = _CANNED_RESPONSES[_prompt_hash(messages) % len(_CANNED_RESPONSES)]
+    return Message(role="assistant", content=content)
+
+
+def _function_call(
+    messages: List[Message], functions: List[Dict[str, str]]
+) -> ActionCompletion:
+    prompt_hash = _prompt_hash(messages)
+    function: Any = functions[prompt_hash % len(functions)]
+
+    args: Dict[str, Any] = {}
+    for name, parameter in function["parameters"]["properties"].items():
+        if parameter.get("enum"):
+            args[name] = parameter["enum"][prompt_hash % len(parameter["enum"])]
+        elif parameter["type"] == "number":
+            args[name] = prompt_hash % 100
+        elif parameter["type"] == "boolean":
+            args[name] = prompt_hash % 2 == 0
+        else:
+            args[name] = name
+
+    return ActionCompletion(action=function["name"], args=args)
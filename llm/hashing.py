@@ -0,0 +1,27 @@
+import hashlib
+import json
+from typing import Any
+
+from pydantic import BaseModel
+
+
+def request_hash(operation: str, *args: Any) -> str:
+    """Identifies an LLM request by its operation and arguments, e.g. the messages
+    and functions of a completion. Equal requests hash equally across processes."""
+    canonical = json.dumps(
+        [operation, *[_jsonable(arg) for arg in args]],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]  # type: ignore
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}  # type: ignore
+    return value
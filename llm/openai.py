@@ -2,12 +2,22 @@ import asyncio
 import json
 import os
 import re
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Union, cast
 
 import openai
 from aiohttp import ClientSession
+from openai.error import (
+    APIConnectionError,
+    APIError,
+    OpenAIError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+    TryAgain,
+)
 
-from llm.base import LLMBase
+from llm.base import LLMBase, close_stream
+from llm.retry import RetryPolicy
 from schema import ActionCompletion, Message
 
 
@@ -17,11 +27,15 @@ class OpenAIInterface(LLMBase):
         api_key: str = "",
         model: str = "gpt-3.5-turbo",
         embedding_size: int = 1536,
+        embedding_model: str = "text-embedding-ada-002",
         api_base: Optional[str] = None,
         client_session: Optional[ClientSession] = None,
+        retry_policy: Optional[RetryPolicy] = None,
     ):
         self._model = model
+        self._retry_policy = retry_policy or RetryPolicy()
         self._embedding_size = embedding_size
+        self._embedding_model = embedding_model
         if api_key:
             openai.api_key = api_key
         else:
@@ -36,14 +50,8 @@ class OpenAIInterface(LLMBase):
         messages: List[Message],
         functions: List[Dict[str, str]],
     ) -> Union[Message, ActionCompletion]:
-        chat_function_arguments = _generate_completions_function_args(functions)
-        completion: Any = (
-            await openai.ChatCompletion.acreate(  # type: ignore
-                messages=_parse_messages(messages),
-                model=self._model,
-                **chat_function_arguments,
-            )
-        )["choices"][0]["message"]
+        response: Any = await self._chat_completion(messages, functions)
+        completion = response["choices"][0]["message"]
 
         if completion.get("function_call"):
             func_call = completion.get("function_call")
@@ -61,15 +69,52 @@ class OpenAIInterface(LLMBase):
         self,
         messages: List[Message],
     ) -> Message:
-        completion: Any = (
-            await openai.ChatCompletion.acreate(  # type: ignore
-                messages=_parse_messages(messages),
-                model=self._model,
-            )
-        )["choices"][0]["message"]["content"]
+        response: Any = await self._chat_completion(messages)
+        completion = response["choices"][0]["message"]["content"]
 
         return Message(role="assistant", content=completion)
 
+    async def stream_completion(
+        self,
+        messages: List[Message],
+        functions: List[Dict[str, str]],
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        chunks: Any = await self._chat_completion(
+            messages, functions, operation="stream_completion", stream=True
+        )
+
+        # Function calls are streamed too, but are only useful once complete.
+        function_name = ""
+        function_arguments = ""
+        try:
+            async for chunk in chunks:
+                delta = chunk["choices"][0]["delta"]
+                if delta.get("function_call"):
+                    function_name += delta["function_call"].get("name", "")
+                    function_arguments += delta["function_call"].get("arguments", "")
+                elif delta.get("content"):
+                    yield delta["content"]
+        finally:
+            # Closes the response as soon as this is closed, e.g. on a disconnect.
+            await close_stream(chunks)
+
+        if function_name:
+            # TODO: Sometimes the arguments are malformed.
+            try:
+                args = json.loads(function_arguments)
+            except json.JSONDecodeError:
+                args: Any = {}
+
+            yield ActionCompletion(action=function_name, args=args)
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        async for content in self.stream_completion(messages, []):
+            if isinstance(content, str):
+                yield content
+
     async def action_completion(
         self,
         messages: List[Message],
@@ -77,16 +122,11 @@ class OpenAIInterface(LLMBase):
     ) -> Optional[ActionCompletion]:
         retries = 3
 
-        chat_function_arguments = _generate_completions_function_args(functions)
-
+        # Asking again for a function call shares the deadline.
+        deadline = self._retry_policy.deadline()
         for _ in range(retries):
-            completion: Any = (
-                await openai.ChatCompletion.acreate(  # type: ignore
-                    messages=_parse_messages(messages),
-                    model=self._model,
-                    **chat_function_arguments,
-                )
-            )["choices"][0]["message"]
+            response: Any = await self._chat_completion(messages, functions, deadline)
+            completion = response["choices"][0]["message"]
 
             if completion.get("function_call"):
                 func_call = completion.get("function_call")
@@ -121,23 +161,71 @@ class OpenAIInterface(LLMBase):
         )
 
     async def embed(self, query: str) -> List[float]:
-        return (
-            await openai.Embedding.acreate(  # type: ignore
-                input=query, model="text-embedding-ada-002"
-            )
-        )["data"][0]["embedding"]
+        response: Any = await self._embedding(input=query, model=self._embedding_model)
+        return response["data"][0]["embedding"]
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        response: Any = await self._embedding(
+            input=queries, model=self._embedding_model
+        )
+        embeddings: List[List[float]] = [[] for _ in queries]
+        for d in response["data"]:
+            embeddings[d["index"]] = d["embedding"]
+        return embeddings
 
     @property
     def embedding_size(self) -> int:
         return self._embedding_size
 
+    @property
+    def embedding_model(self) -> str:
+        return self._embedding_model
+
+    @property
+    def completion_model(self) -> str:
+        return self._model
+
+    def stats(self) -> Dict[str, int]:
+        return self._retry_policy.stats()
+
+    async def _chat_completion(
+        self,
+        messages: List[Message],
+        functions: Optional[List[Dict[str, str]]] = None,
+        deadline: Optional[float] = None,
+        operation: str = "chat_completion",
+        **kwargs: Any,
+    ) -> Any:
+        """operation groups requests with similar latencies, for hedging."""
+        chat_function_arguments = _generate_completions_function_args(functions or [])
+        return await self._retry_policy.run(
+            operation,
+            lambda: openai.ChatCompletion.acreate(  # type: ignore
+                messages=_parse_messages(messages),
+                model=self._model,
+                **chat_function_arguments,
+                **kwargs,
+            ),
+            retry_after,
+            deadline,
+        )
+
+    async def _embedding(self, **kwargs: Any) -> Any:
+        return await self._retry_policy.run(
+            "embedding",
+            lambda: openai.Embedding.acreate(**kwargs),  # type: ignore
+            retry_after,
+        )
+
     async def _digit_completion_with_retries(self, messages: List[Message]) -> int:
+        deadline = self._retry_policy.deadline()
         for _ in range(3):
             text = str(
                 (
-                    await openai.ChatCompletion.acreate(  # type: ignore
-                        messages=_parse_messages(messages),
-                        model=self._model,
+                    await self._chat_completion(
+                        messages,
+                        deadline=deadline,
+                        operation="digit_completion",
                         temperature=0,
                         max_tokens=1,
                     )
@@ -161,6 +249,35 @@ class OpenAIInterface(LLMBase):
         return -1
 
 
+def retry_after(error: BaseException) -> Optional[float]:
+    """How long OpenAI asks us to wait before retrying, or None if retrying won't
+    help."""
+    if isinstance(error, asyncio.TimeoutError):
+        return 0
+    if not isinstance(error, OpenAIError):
+        return None
+    # The openai package leaves these untyped.
+    code = cast(Optional[str], error.code)  # type: ignore
+    http_status = cast(Optional[int], error.http_status)  # type: ignore
+    headers = cast(Mapping[str, str], error.headers)  # type: ignore
+
+    if isinstance(error, RateLimitError):
+        if code == "insufficient_quota":
+            return None
+    elif isinstance(error, APIError):
+        if http_status and http_status < 500:
+            return None
+    elif not isinstance(
+        error, (APIConnectionError, ServiceUnavailableError, Timeout, TryAgain)
+    ):
+        return None
+
+    try:
+        return float(headers.get("retry-after", 0))
+    except ValueError:
+        return 0
+
+
 def _parse_messages(
     messages: List[Message],
 ) -> List[Dict[str, str]]:
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from llm.base import LLMBase, LLMWrapper
+from llm.call_context import CallKind, current_call_kind
+from llm.hashing import request_hash
+from schema import ActionCompletion, Message
+
+REDIS_KEY_PREFIX = "response"
+
+# Calls that classify their input, so that equal prompts deserve equal answers
+DEFAULT_CACHED_KINDS = frozenset(
+    [CallKind.GUARDRAIL, CallKind.RATE, CallKind.IMPORTANCE]
+)
+
+# When an entry expires, in time.monotonic() seconds, and the response as JSON
+_Entry = Tuple[float, Any]
+
+
+class ResponseCache(LLMWrapper):
+    """Caches the action completions and digit completions of the call kinds in
+    `kinds`, by completion model, prompt and functions. Prompts are compared with
+    their whitespace normalized.
+
+    Like EmbeddingCache, lookups go to a bounded in-process LRU first, then to Redis
+    if a client is given, and Redis errors are treated as misses. Responses expire
+    after ttl seconds, 0 for never. Other calls go straight to the wrapped LLM."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        max_entries: int = 4096,
+        ttl: float = 0,
+        redis: Optional[Redis[bytes]] = None,
+        kinds: FrozenSet[CallKind] = DEFAULT_CACHED_KINDS,
+    ):
+        super().__init__(llm)
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._redis = redis
+        self._kinds = kinds
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._hits: Dict[CallKind, int] = {kind: 0 for kind in kinds}
+        self._misses: Dict[CallKind, int] = {kind: 0 for kind in kinds}
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        kind = current_call_kind()
+        if kind is None or kind not in self._kinds:
+            return await self._llm.action_completion(messages, functions)
+
+        key = self._key("action_completion", messages, functions)
+        response = await self._get(kind, key)
+        if response is not None:
+            return ActionCompletion.parse_obj(response)
+
+        completion = await self._llm.action_completion(messages, functions)
+        # No completion is more likely a fluke than the answer
+        if completion is not None:
+            await self._set(key, completion.dict())
+        return completion
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        kind = current_call_kind()
+        if kind is None or kind not in self._kinds:
+            return await self._llm.digit_completions(query_messages)
+
+        keys = [self._key("digit_completion", messages) for messages in query_messages]
+        digits: List[Optional[int]] = list(
+            await asyncio.gather(*[self._get(kind, key) for key in keys])
+        )
+
+        # The misses are sent together, as they would have been
+        missing = [i for i, digit in enumerate(digits) if digit is None]
+        if missing:
+            completed = await self._llm.digit_completions(
+                [query_messages[i] for i in missing]
+            )
+            for i, digit in zip(missing, completed):
+                digits[i] = digit
+                # -1 means no digit came back, which is more likely a fluke too
+                if digit >= 0:
+                    await self._set(keys[i], digit)
+
+        return [digit for digit in digits if digit is not None]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._llm.stats(),
+            **{f"response_cache_{k.value}_hits": n for k, n in self._hits.items()},
+            **{f"response_cache_{k.value}_misses": n for k, n in self._misses.items()},
+        }
+
+    def _key(self, operation: str, messages: List[Message], *request: Any) -> str:
+        normalized = [
+            (message.role, _normalize_whitespace(message.content))
+            for message in messages
+        ]
+        digest = request_hash(operation, normalized, *request)
+        return f"{REDIS_KEY_PREFIX}:{self.completion_model}:{digest}"
+
+    async def _get(self, kind: CallKind, key: str) -> Any:
+        """The cached response, or None. Counts the hit or miss."""
+        response = self._get_local(key)
+        if response is None:
+            response = await self._redis_get(key)
+            if response is not None:
+                self._remember(key, response)
+
+        if response is None:
+            self._misses[kind] += 1
+        else:
+            self._hits[kind] += 1
+        return response
+
+    async def _set(self, key: str, response: Any) -> None:
+        self._remember(key, response)
+        await self._redis_set(key, response)
+
+    def _get_local(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if self._ttl and time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _remember(self, key: str, response: Any) -> None:
+        self._entries[key] = (time.monotonic() + self._ttl, response)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def _redis_get(self, key: str) -> Any:
+        if self._redis is None:
+            return None
+        try:
+            value = await self._redis.get(key)
+        except RedisError:
+            logging.getLogger().exception("Response cache lookup failed")
+            return None
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def _redis_set(self, key: str, response: Any) -> None:
+        if self._redis is None:
+            return
+        try:
+            await self._redis.set(
+                key, json.dumps(response), px=int(self._ttl * 1000) or None
+            )
+        except RedisError:
+            logging.getLogger().exception("Response cache store failed")
+
+
+def _normalize_whitespace(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+from llm.call_context import current_call_slot
+
+T = TypeVar("T")
+
+# Latencies kept per operation to estimate when a request is slow.
+_LATENCY_SAMPLES = 200
+
+# Returns how long to wait before retrying after an error (at least), or None if
+# the error shouldn't be retried.
+RetryAfter = Callable[[BaseException], Optional[float]]
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """An LLM call ran out of time, including its retries."""
+
+
+class RetryPolicy:
+    """Retries failed LLM requests with jittered exponential backoff.
+
+    Every call gets an overall deadline, shared by its attempts and the waits
+    between them. A wait is never shorter than the Retry-After the error asks for,
+    and an error is raised as is rather than waiting past the deadline. Missing the
+    deadline raises DeadlineExceeded.
+
+    If hedge is set, an attempt that takes longer than the hedge_quantile latency of
+    the operation's recent attempts is raced against a duplicate request, and
+    whichever loses is cancelled.
+
+    Under a scheduler, the waits don't hold the call's slot and the duplicate
+    requests need a slot of their own (see llm.call_context.CallSlot)."""
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        deadline: float = 60.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+    ):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+        self._hedge = hedge
+        self._hedge_quantile = hedge_quantile
+        self._hedge_min_samples = hedge_min_samples
+
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._retries = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+
+    def deadline(self) -> float:
+        """The deadline, in time.monotonic() seconds, of a call starting now."""
+        return time.monotonic() + self._deadline
+
+    async def run(
+        self,
+        operation: str,
+        request: Callable[[], Awaitable[T]],
+        retry_after: RetryAfter,
+        deadline: Optional[float] = None,
+    ) -> T:
+        """Makes `request` until it succeeds. Pass the deadline of the call that
+        `request` is part of if it makes several."""
+        if deadline is None:
+            deadline = self.deadline()
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await asyncio.wait_for(
+                    self._attempt(operation, request),
+                    timeout=max(0, deadline - time.monotonic()),
+                )
+            except Exception as e:
+                # Otherwise the timeout is the request's own, e.g. a socket's.
+                if isinstance(e, asyncio.TimeoutError) and time.monotonic() >= deadline:
+                    raise DeadlineExceeded(f"{operation} missed its deadline") from None
+
+                wait = retry_after(e)
+                if wait is None or attempt >= self._max_attempts:
+                    raise
+
+                backoff = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+                wait = max(wait, random.uniform(0, backoff))
+                if time.monotonic() + wait >= deadline:
+                    raise
+
+                logging.getLogger().info(
+                    f"Retrying {operation} in {wait:.2f}s after {type(e).__name__}"
+                )
+                self._retries += 1
+                slot = current_call_slot()
+                if slot is None:
+                    await asyncio.sleep(wait)
+                else:
+                    async with slot.paused():
+                        await asyncio.sleep(wait)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "llm_retries": self._retries,
+            "llm_hedges": self._hedges,
+            "llm_hedge_wins": self._hedge_wins,
+        }
+
+    async def _attempt(self, operation: str, request: Callable[[], Awaitable[T]]) -> T:
+        latencies = self._latencies.setdefault(
+            operation, deque(maxlen=_LATENCY_SAMPLES)
+        )
+        slow = self._slow_latency(latencies)
+
+        async def timed() -> T:
+            start_time = time.monotonic()
+            result = await request()
+            latencies.append(time.monotonic() - start_time)
+            return result
+
+        async def hedge() -> T:
+            slot = current_call_slot()
+            if slot is None:
+                return await timed()
+            async with slot.extra():
+                return await timed()
+
+        if slow is None:
+            return await timed()
+
+        first = asyncio.ensure_future(timed())
+        pending: Set["asyncio.Future[T]"] = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=slow)
+            if done:
+                return first.result()
+
+            self._hedges += 1
+            pending.add(asyncio.ensure_future(hedge()))
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [future for future in done if not future.exception()]
+                if succeeded:
+                    if first not in succeeded:
+                        self._hedge_wins += 1
+                    return succeeded[0].result()
+                if not pending:
+                    # Both failed, the first one's error is as good as any.
+                    return first.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _slow_latency(self, latencies: Deque[float]) -> Optional[float]:
+        """When an attempt should be hedged, or None if it shouldn't be."""
+        if not self._hedge or len(latencies) < self._hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(self._hedge_quantile * len(ordered)))]
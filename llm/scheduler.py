@@ -0,0 +1,280 @@
+import asyncio
+import heapq
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from llm.base import LLMBase, LLMWrapper, close_stream
+from llm.call_context import CallKind, CallSlot, call_slot, current_call_kind
+from llm.tokens import estimate_tokens
+from schema import ActionCompletion, Message
+
+T = TypeVar("T")
+
+_TOKEN_WINDOW_SECONDS = 60.0
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    ACTION = 1
+    BACKGROUND = 2
+
+
+_PRIORITIES: Dict[CallKind, Priority] = {
+    CallKind.CHAT: Priority.INTERACTIVE,
+    CallKind.INTERACT: Priority.INTERACTIVE,
+    CallKind.ACT: Priority.ACTION,
+}
+
+
+def _current_priority() -> Priority:
+    kind = current_call_kind()
+    if kind is None:
+        return Priority.BACKGROUND
+    return _PRIORITIES.get(kind, Priority.BACKGROUND)
+
+
+class LLMScheduler(LLMWrapper):
+    """Bounds the completion calls in flight to the wrapped LLM.
+
+    At most max_concurrency calls run at once, and if tokens_per_minute is set, the
+    prompts started in any 60 second window stay within it. Calls that can't start
+    wait in order of priority, set with llm.call_context.call_kind: chat and
+    interact first, then act, then everything else. Embeddings aren't scheduled.
+
+    A call gives up its slot while the LLM below waits to retry, and a hedged
+    request needs a slot of its own (see llm.call_context.CallSlot). A stream holds
+    its slot until it's drained or closed."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        max_concurrency: int = 16,
+        tokens_per_minute: int = 0,
+    ):
+        super().__init__(llm)
+        self._max_concurrency = max_concurrency
+        self._tokens_per_minute = tokens_per_minute
+
+        self._in_flight = 0
+        self._sequence = 0
+        self._waiting: List[Tuple[Priority, int, int, "asyncio.Future[None]"]] = []
+        self._budget_timer: Optional[asyncio.TimerHandle] = None
+        # When each call in the token window started and its estimated tokens.
+        self._window: Deque[Tuple[float, int]] = deque()
+        self._window_tokens = 0
+
+        self._calls = {priority: 0 for priority in Priority}
+        self._wait_ms = {priority: 0 for priority in Priority}
+
+    async def completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Union[Message, ActionCompletion]:
+        return await self._call(
+            messages, lambda: self._llm.completion(messages, functions)
+        )
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        return await self._call(messages, lambda: self._llm.chat_completion(messages))
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        return await self._call(
+            messages, lambda: self._llm.action_completion(messages, functions)
+        )
+
+    def stream_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        return self._stream(
+            messages, lambda: self._llm.stream_completion(messages, functions)
+        )
+
+    def stream_chat_completion(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        return self._stream(
+            messages, lambda: self._llm.stream_chat_completion(messages)
+        )
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        async def digit_completion(messages: List[Message]) -> int:
+            return (
+                await self._call(
+                    messages, lambda: self._llm.digit_completions([messages])
+                )
+            )[0]
+
+        return await asyncio.gather(*[digit_completion(m) for m in query_messages])
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            **self._llm.stats(),
+            "llm_in_flight": self._in_flight,
+            "llm_queue_depth": len(self._waiting),
+        }
+        for priority in Priority:
+            name = priority.name.lower()
+            stats[f"llm_calls_{name}"] = self._calls[priority]
+            stats[f"llm_wait_ms_{name}"] = self._wait_ms[priority]
+        return stats
+
+    async def _call(
+        self, messages: List[Message], request: Callable[[], Awaitable[T]]
+    ) -> T:
+        async with self._slot(messages) as slot:
+            with call_slot(slot):
+                return await request()
+
+    async def _stream(
+        self, messages: List[Message], open_stream: Callable[[], AsyncIterator[T]]
+    ) -> AsyncIterator[T]:
+        """Passes on the stream while holding a slot. Both are let go as soon as
+        this is closed, whether or not it was drained.
+
+        The stream is read by whoever consumes it, so the slot is only current
+        while waiting on it."""
+        async with self._slot(messages) as slot:
+            stream = open_stream()
+            try:
+                while True:
+                    with call_slot(slot):
+                        try:
+                            piece = await stream.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    yield piece
+            finally:
+                await close_stream(stream)
+
+    @asynccontextmanager
+    async def _slot(self, messages: List[Message]) -> AsyncGenerator["_Slot", None]:
+        priority = _current_priority()
+        tokens = estimate_tokens(messages)
+        if self._tokens_per_minute:
+            # Otherwise a prompt over the budget would never start.
+            tokens = min(tokens, self._tokens_per_minute)
+
+        start_time = time.perf_counter()
+        await self._acquire(priority, tokens)
+        self._calls[priority] += 1
+        self._wait_ms[priority] += int(1000 * (time.perf_counter() - start_time))
+
+        slot = _Slot(self, priority, tokens)
+        try:
+            yield slot
+        finally:
+            if slot.held:
+                self._release()
+
+    async def _acquire(self, priority: Priority, tokens: int) -> None:
+        """Waits for room for a call of `tokens`, then takes it."""
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, self._sequence, tokens, future))
+        self._sequence += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Started just as it was cancelled.
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Starts waiting calls, highest priority first, while there's room."""
+        while self._waiting and self._in_flight < self._max_concurrency:
+            _, _, tokens, future = self._waiting[0]
+            if future.done():
+                heapq.heappop(self._waiting)
+                continue
+
+            budget_wait = self._budget_wait(tokens)
+            if budget_wait > 0:
+                if self._budget_timer is None:
+                    self._budget_timer = asyncio.get_running_loop().call_later(
+                        budget_wait, self._on_budget_timer
+                    )
+                return
+
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            if self._tokens_per_minute:
+                self._window.append((time.monotonic(), tokens))
+                self._window_tokens += tokens
+            future.set_result(None)
+
+    def _on_budget_timer(self) -> None:
+        self._budget_timer = None
+        self._dispatch()
+
+    def _budget_wait(self, tokens: int) -> float:
+        """Seconds until `tokens` fit in the token budget."""
+        if not self._tokens_per_minute:
+            return 0
+
+        now = time.monotonic()
+        while self._window and self._window[0][0] <= now - _TOKEN_WINDOW_SECONDS:
+            self._window_tokens -= self._window.popleft()[1]
+
+        excess = self._window_tokens + tokens - self._tokens_per_minute
+        if excess <= 0:
+            return 0
+        for started, started_tokens in self._window:
+            excess -= started_tokens
+            if excess <= 0:
+                return started + _TOKEN_WINDOW_SECONDS - now
+        return _TOKEN_WINDOW_SECONDS
+
+
+class _Slot(CallSlot):
+    """A call's room in an LLMScheduler. Requests after the first, such as retries
+    and hedges, count against the token budget like the first did."""
+
+    def __init__(self, scheduler: LLMScheduler, priority: Priority, tokens: int):
+        self._scheduler = scheduler
+        self._priority = priority
+        self._tokens = tokens
+        self.held = True
+
+    @asynccontextmanager
+    async def paused(self) -> AsyncGenerator[None, None]:
+        self._scheduler._release()  # type: ignore
+        self.held = False
+        yield
+        await self._scheduler._acquire(self._priority, self._tokens)  # type: ignore
+        self.held = True
+
+    @asynccontextmanager
+    async def extra(self) -> AsyncGenerator[None, None]:
+        await self._scheduler._acquire(self._priority, self._tokens)  # type: ignore
+        try:
+            yield
+        finally:
+            self._scheduler._release()  # type: ignore
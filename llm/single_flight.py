@@ -0,0 +1,149 @@
+import asyncio
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+
+from llm.base import LLMBase, LLMWrapper
+from llm.call_context import CallKind, current_call_kind
+from llm.hashing import request_hash
+from llm.response_cache import DEFAULT_CACHED_KINDS
+from schema import ActionCompletion, Message
+
+T = TypeVar("T")
+
+
+class SingleFlight(LLMWrapper):
+    """Sends concurrent identical requests upstream once, and gives every caller
+    the same result, or the same exception. Unlike a cache, nothing is kept once
+    the request is done.
+
+    Embeddings are shared per text, also within a batch. Digit completions and
+    action completions are only shared for the call kinds in `kinds`, by default
+    those ResponseCache caches, since a completion sampled for one caller isn't
+    the answer to another's (e.g. two sessions acting on the same prompt). Digit
+    completions are shared per query, action completions whole. Chat completions
+    and streams aren't shared.
+
+    A caller that's cancelled doesn't cancel the request for the others."""
+
+    def __init__(self, llm: LLMBase, kinds: FrozenSet[CallKind] = DEFAULT_CACHED_KINDS):
+        super().__init__(llm)
+        self._kinds = kinds
+        self._in_flight: Dict[str, "asyncio.Future[Any]"] = {}
+        self._shared: Dict[str, int] = {
+            "embed": 0,
+            "digit_completion": 0,
+            "action_completion": 0,
+        }
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        if not self._shared_kind():
+            return await self._llm.action_completion(messages, functions)
+        results = await self._share(
+            "action_completion",
+            [(messages, functions)],
+            lambda requests: self._action_completions(*requests[0]),
+        )
+        return results[0]
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        if not self._shared_kind():
+            return await self._llm.digit_completions(query_messages)
+        return await self._share(
+            "digit_completion", query_messages, self._llm.digit_completions
+        )
+
+    async def embed(self, query: str) -> List[float]:
+        return (await self.embed_batch([query]))[0]
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        return await self._share("embed", queries, self._embed_batch)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._llm.stats(),
+            **{f"single_flight_{op}_shared": n for op, n in self._shared.items()},
+        }
+
+    def _shared_kind(self) -> bool:
+        kind = current_call_kind()
+        return kind is not None and kind in self._kinds
+
+    async def _action_completions(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> List[Optional[ActionCompletion]]:
+        return [await self._llm.action_completion(messages, functions)]
+
+    async def _embed_batch(self, queries: List[str]) -> List[List[float]]:
+        if len(queries) == 1:
+            return [await self._llm.embed(queries[0])]
+        return await self._llm.embed_batch(queries)
+
+    async def _share(
+        self,
+        operation: str,
+        requests: Sequence[Any],
+        send: Callable[[List[Any]], Awaitable[List[T]]],
+    ) -> List[T]:
+        """The results of `requests`. Those that aren't in flight yet are sent
+        together with `send`, the others wait for the requests in flight."""
+        keys = [request_hash(operation, request) for request in requests]
+        new: Dict[str, Any] = {}
+        for key, request in zip(keys, requests):
+            if key in self._in_flight or key in new:
+                self._shared[operation] += 1
+            else:
+                new[key] = request
+
+        if new:
+            sent = asyncio.ensure_future(send(list(new.values())))
+            for i, key in enumerate(new):
+                self._in_flight[key] = self._result(sent, key, i)
+
+        futures = [self._in_flight[key] for key in keys]
+        return list(await asyncio.gather(*[asyncio.shield(f) for f in futures]))
+
+    def _result(
+        self, sent: "asyncio.Future[List[T]]", key: str, i: int
+    ) -> "asyncio.Future[T]":
+        """The i-th result of `sent`, in flight under `key` until it's done."""
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+
+        def done(sent: "asyncio.Future[List[T]]") -> None:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if sent.cancelled():
+                future.cancel()
+            elif sent.exception() is not None:
+                future.set_exception(_exception(sent))
+            else:
+                future.set_result(sent.result()[i])
+            # Retrieve it, in case every caller was cancelled
+            future.add_done_callback(_ignore_exception)
+
+        sent.add_done_callback(done)
+        return future
+
+
+def _exception(future: "asyncio.Future[Any]") -> BaseException:
+    exception = future.exception()
+    assert exception is not None
+    return exception
+
+
+def _ignore_exception(future: "asyncio.Future[Any]") -> None:
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,12 @@
+from typing import List
+
+from schema import Message
+
+# Close enough for English text and OpenAI's tokenizers, which is all that budgets
+# and stats need.
+_CHARACTERS_PER_TOKEN = 4
+
+
+def estimate_tokens(messages: List[Message]) -> int:
+    """Estimates how many prompt tokens `messages` take."""
+    return sum(len(message.content) for message in messages) // _CHARACTERS_PER_TOKEN
@@ -38,6 +38,32 @@ class Conversation(BaseModel):
     conversation, you may want to set this higher than default."""
 
 
+class HistoryConfig(BaseModel):
+    max_tokens: int = 2048
+    """Estimated tokens of conversation history sent with each prompt. 0 sends the
+    whole history, however long it gets."""
+
+    recent_messages: int = 8
+    """How many of the latest messages are always sent as they are."""
+
+    summarize: bool = True
+    """Older messages that don't fit are summarized by the LLM in the background.
+    Otherwise they're left out."""
+
+
+class PromptConfig(BaseModel):
+    layout: Literal["standard", "prefix_cache"] = "standard"
+    """standard puts the memories retrieved for each turn in the system prompt.
+    prefix_cache puts them just before the latest message instead, so consecutive
+    prompts of a conversation share everything up to there. Servers that cache
+    prompt prefixes, like most local inference servers, then only have to process
+    the end of each prompt."""
+    batch_queries: bool = False
+    """Ask all the queries of GenAgent.query in one request, with the memories
+    relevant to any of them, instead of one request each. If the answer doesn't
+    rate every query, they're asked one by one after all."""
+
+
 class GameDef(BaseModel):
     uuid: UUID4 = Field(default_factory=uuid.uuid4)
     name: str
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from typing import List, Optional, Set
+from typing import Any, Dict, List, Literal, Optional, Set
 
-from pydantic import UUID4, BaseModel, Field
+from pydantic import UUID4, BaseModel, Field, PrivateAttr
+from pydantic.class_validators import root_validator  # type: ignore
 
 
 class GameStage(BaseModel):
@@ -29,14 +30,64 @@ class GameStage(BaseModel):
 
 
 class MemoryConfig(BaseModel):
-    max_memories: int = 1024
-    embedding_dims: int = Field(...)
+    max_memories: int = Field(default=1024, ge=1)
+    """How many memories an agent can hold before it forgets the least important
+    ones."""
+
+    eviction_fraction: float = Field(default=0.125, gt=0, le=1)
+    """Fraction of max_memories forgotten at once when the cap is reached. Evicting in
+    batches keeps adding a memory amortized O(1)."""
+
+    embedding_dims: int = Field(..., ge=1)
     """The dimensions of the vector that the embedding models return.
     i.e. OpenAI ada-002 is 1536."""
 
-    memories_returned: int = 5
+    memories_returned: int = Field(default=5, ge=1)
     """How many memories to return."""
 
+    embedding_dtype: Literal["float32", "float64", "int8"] = "float32"
+    """How embeddings are stored. int8 quantizes each embedding with its own scale,
+    which uses a quarter of the memory of float32 for a small loss in recall."""
+
+    index: Literal["exact", "ivf"] = "exact"
+    """exact scores every memory on every query. ivf partitions memories into
+    ivf_lists clusters and only scores the memories in the ivf_probes clusters closest
+    to the query, which is much faster for very large memories at a small cost in
+    recall."""
+
+    ivf_lists: int = Field(default=256, ge=1)
+    ivf_probes: int = Field(default=16, ge=1)
+    """How many of the ivf_lists clusters are scanned per query, at most ivf_lists."""
+
+    ivf_train_size: int = Field(default=8192, ge=1)
+    """How many memories an agent needs before the ivf index is built. Smaller
+    memories are scanned exactly. With the ivf index, it can't be more than
+    max_memories. The index is built, and rebuilt whenever memory doubles, in a
+    worker thread; until that's done, searches use the index as it was."""
+
+    @root_validator(skip_on_failure=True)  # type: ignore
+    def _check_ivf(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values["ivf_probes"] > values["ivf_lists"]:
+            raise ValueError("ivf_probes can't be more than ivf_lists")
+        # Otherwise the index would never be built
+        if (
+            values["index"] == "ivf"
+            and values["ivf_train_size"] > values["max_memories"]
+        ):
+            raise ValueError("ivf needs ivf_train_size to be at most max_memories")
+        return values
+
+
+class MemoryStats(BaseModel):
+    memories: int = 0
+    """How many memories are currently held."""
+
+    evictions: int = 0
+    """How many times memories were evicted because max_memories was reached."""
+
+    evicted_memories: int = 0
+    """Total number of memories forgotten."""
+
 
 class Memory(BaseModel):
     importance: int = 0
@@ -47,8 +98,25 @@ class Memory(BaseModel):
 
     description: str
     embedding: Optional[List[float]] = None
+    """
+    Only used at the API boundary. Once the memory is added to a TIRetriever, the
+    embedding is moved into the retriever's float32 matrix and this is cleared.
+    """
+
     timestamp: Optional[GameStage] = None
 
+    _embedding_row: Optional[int] = PrivateAttr(default=None)
+
+    @property
+    def embedding_row(self) -> Optional[int]:
+        """Row of the embedding in the TIRetriever that owns this memory."""
+        return self._embedding_row
+
+    def move_embedding(self, row: Optional[int]) -> None:
+        """Called by the TIRetriever that takes ownership of the embedding."""
+        self.embedding = None
+        self._embedding_row = row
+
 
 class Lore(BaseModel):
     known_by: Set[UUID4] = Field(default_factory=set)
@@ -1,6 +1,6 @@
 from configparser import ConfigParser
 
-from fastapi import Request
+from fastapi.requests import HTTPConnection
 from fastapi_sso.sso.github import GithubSSO  # type: ignore
 from fastapi_sso.sso.google import GoogleSSO  # type: ignore
 from pydantic import UUID4
@@ -11,25 +11,25 @@ from llm.base import LLMBase
 SessionsType = dict[UUID4, Session]
 
 
-def get_redis(request: Request):
+def get_redis(request: HTTPConnection):
     return request.state.redis_client
 
 
-def get_sessions(request: Request) -> SessionsType:
+def get_sessions(request: HTTPConnection) -> SessionsType:
     return request.state.sessions
 
 
-def get_config_parser(request: Request) -> ConfigParser:
+def get_config_parser(request: HTTPConnection) -> ConfigParser:
     return request.state.parser
 
 
-def get_llm(request: Request) -> LLMBase:
+def get_llm(request: HTTPConnection) -> LLMBase:
     return request.state.llm
 
 
-def get_google_sso(request: Request) -> GoogleSSO:
+def get_google_sso(request: HTTPConnection) -> GoogleSSO:
     return request.state.google_sso
 
 
-def get_github_sso(request: Request) -> GithubSSO:
+def get_github_sso(request: HTTPConnection) -> GithubSSO:
     return request.state.github_sso
@@ -1,17 +1,29 @@
+import asyncio
 import configparser
 import logging
 import os
 import pickle
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, cast, get_args
 
 from aiohttp import ClientSession
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi_limiter import FastAPILimiter  # type: ignore
+from openai.error import OpenAIError
 from redis.asyncio import Redis
 
-from llm.openai import OpenAIInterface
+from llm.base import LLMBase
+from llm.cassette import Cassette, RecordingLLM, ReplayLLM
+from llm.embed_coalescer import EmbedCoalescer
+from llm.embedding_cache import EmbeddingCache
+from llm.fake import FakeLLM, LatencyDistribution
+from llm.openai import OpenAIInterface, retry_after
+from llm.response_cache import ResponseCache
+from llm.retry import DeadlineExceeded, RetryPolicy
+from llm.scheduler import LLMScheduler
+from llm.single_flight import SingleFlight
 from schema import GameDef
 from server.context import SessionsType
 from server.router import (
@@ -33,14 +45,21 @@ GAMES_DEFS_SET = "GAME_DEFS"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    redis_client: Redis[bytes] = Redis(
-        host="localhost",
-        port=6379,
-    )
     sessions: SessionsType = {}
     parser = configparser.ConfigParser()
     parser.read("config.ini")
 
+    redis_client: Redis[bytes]
+    if parser.getboolean("server", "fake_redis", fallback=False):
+        from fakeredis import aioredis
+
+        redis_client = cast("Redis[bytes]", aioredis.FakeRedis())
+    else:
+        redis_client = Redis(
+            host="localhost",
+            port=6379,
+        )
+
     use_local_llm = parser.getboolean("llm", "use_local_llm", fallback=False)
     api_base = "http://localhost:8080/v1" if use_local_llm else None
 
@@ -51,17 +70,73 @@ async def lifespan(app: FastAPI):
     google_sso = generate_google_sso(parser=parser)
     github_sso = generate_github_sso(parser=parser)
 
+    retry_policy = RetryPolicy(
+        max_attempts=parser.getint("llm", "max_attempts", fallback=4),
+        deadline=parser.getfloat("llm", "request_deadline_seconds", fallback=60),
+        hedge=parser.getboolean("llm", "hedge_requests", fallback=False),
+    )
+
     openai_http_client = ClientSession()
-    llm = OpenAIInterface(
-        api_key=key,
-        model=chat_model,
-        api_base=api_base,
-        embedding_size=embedding_size,
-        client_session=openai_http_client,
+    llm: LLMBase
+    backend = parser.get("llm", "backend", fallback="openai")
+    cassette_path = parser.get("cassette", "path", fallback="cassette.jsonl.gz")
+    if backend == "replay":
+        llm = ReplayLLM(
+            Cassette.load(cassette_path),
+            realtime=parser.getboolean("cassette", "realtime", fallback=False),
+        )
+    elif backend == "fake":
+        llm = create_fake_llm(parser, embedding_size, retry_policy)
+    else:
+        llm = OpenAIInterface(
+            api_key=key,
+            model=chat_model,
+            api_base=api_base,
+            embedding_size=embedding_size,
+            client_session=openai_http_client,
+            retry_policy=retry_policy,
+        )
+
+    recorder = None
+    if backend != "replay" and parser.getboolean("cassette", "record", fallback=False):
+        llm = recorder = RecordingLLM(llm)
+
+    llm = LLMScheduler(
+        llm,
+        parser.getint("llm", "max_concurrent_requests", fallback=16),
+        parser.getint("llm", "tokens_per_minute", fallback=0),
     )
 
+    embed_max_batch_size = parser.getint("llm", "embed_max_batch_size", fallback=256)
+    if embed_max_batch_size > 1:
+        embed_batch_window_ms = parser.getfloat(
+            "llm", "embed_batch_window_ms", fallback=5
+        )
+        llm = EmbedCoalescer(llm, embed_batch_window_ms / 1000, embed_max_batch_size)
+
+    if parser.getboolean("llm", "single_flight", fallback=True):
+        llm = SingleFlight(llm)
+
+    embedding_cache_size = parser.getint("llm", "embedding_cache_size", fallback=4096)
+    if embedding_cache_size > 0:
+        use_redis = parser.getboolean("llm", "embedding_cache_redis", fallback=True)
+        llm = EmbeddingCache(
+            llm, embedding_cache_size, redis_client if use_redis else None
+        )
+
+    response_cache_size = parser.getint("llm", "response_cache_size", fallback=0)
+    if response_cache_size > 0:
+        use_redis = parser.getboolean("llm", "response_cache_redis", fallback=True)
+        llm = ResponseCache(
+            llm,
+            response_cache_size,
+            parser.getfloat("llm", "response_cache_ttl_s", fallback=86400),
+            redis_client if use_redis else None,
+        )
+
     await FastAPILimiter.init(redis_client)  # type: ignore
 
+    lore_tasks: List["asyncio.Task[None]"] = []
     dev_mode = parser.getboolean("server", "dev_mode", fallback=False)
     if dev_mode:
         # getLogger returns the same singleton everywhere, so usages in
@@ -74,6 +149,10 @@ async def lifespan(app: FastAPI):
         resp = await redis_client.get("sessions")
         if resp:
             sessions = pickle.loads(resp)
+            # Restored sessions share the LLM, its limits and caches, like new ones.
+            for session in sessions.values():
+                for agent in session.agents:
+                    agent.attach_llm(llm)
         game_defs = load_existing_game_defs_from_json(
             parser.get("server", "game_defs_path", fallback="")
         )
@@ -81,7 +160,17 @@ async def lifespan(app: FastAPI):
         for game in game_defs:
             pipe.set(str(game.uuid), game.json(), nx=True)
             pipe.sadd(GAMES_DEFS_SET, str(game.uuid))
-        await pipeline_exec(pipe)
+        stored = (await pipeline_exec(pipe))[::2]
+        # Like games saved through the API, new games get their lore computed
+        lore_tasks = [
+            asyncio.create_task(
+                game_def_handlers.save_lore_vectors(
+                    str(game.uuid), game, redis_client, llm
+                )
+            )
+            for game, was_stored in zip(game_defs, stored)
+            if was_stored
+        ]
 
     yield {
         "redis_client": redis_client,
@@ -92,12 +181,44 @@ async def lifespan(app: FastAPI):
         "github_sso": github_sso,
     }
 
+    for task in lore_tasks:
+        task.cancel()
     if dev_mode:
         await redis_client.set("sessions", pickle.dumps(sessions))
 
     await redis_client.close()
     await openai_http_client.close()
 
+    if recorder:
+        recorder.cassette.save(cassette_path)
+
+
+def create_fake_llm(
+    parser: configparser.ConfigParser, embedding_size: int, retry_policy: RetryPolicy
+) -> FakeLLM:
+    latency_distribution = parser.get(
+        "fake_llm", "latency_distribution", fallback="constant"
+    )
+    if latency_distribution not in get_args(LatencyDistribution):
+        raise ValueError(f"Unknown latency_distribution {latency_distribution}")
+
+    return FakeLLM(
+        embedding_size=embedding_size,
+        latency=parser.getfloat("fake_llm", "latency_ms", fallback=0) / 1000,
+        latency_distribution=cast(LatencyDistribution, latency_distribution),
+        embedding_latency=parser.getfloat(
+            "fake_llm", "embedding_latency_ms", fallback=0
+        )
+        / 1000,
+        stream_token_latency=parser.getfloat(
+            "fake_llm", "stream_token_latency_ms", fallback=0
+        )
+        / 1000,
+        error_rate=parser.getfloat("fake_llm", "error_rate", fallback=0),
+        seed=parser.getint("fake_llm", "seed", fallback=0),
+        retry_policy=retry_policy,
+    )
+
 
 def get_redis(request: Request):
     return request.state.redis_client
@@ -125,6 +246,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+# What's left of retryable LLM errors after retries, and LLM calls that missed their
+# deadline. Other errors, like a bad request or API key, are ours to fix: a 500.
+@app.exception_handler(OpenAIError)
+@app.exception_handler(DeadlineExceeded)
+async def llm_unavailable(request: Request, exc: Exception):
+    if isinstance(exc, OpenAIError) and retry_after(exc) is None:
+        logging.getLogger().exception(f"LLM request failed: {exc!r}", exc_info=exc)
+        return JSONResponse(
+            status_code=500, content=dict(detail="Internal Server Error")
+        )
+    logging.getLogger().warning(f"LLM unavailable: {exc!r}")
+    return JSONResponse(status_code=503, content=dict(detail="LLM unavailable"))
+
+
 app.include_router(util_handlers.router)
 app.include_router(llm_handlers.router)
 app.include_router(game_def_handlers.router)
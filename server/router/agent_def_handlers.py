@@ -1,10 +1,11 @@
 from typing import List
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from pydantic import UUID4
 
+from llm.base import LLMBase
 from schema import AgentDef
-from server.context import get_redis
+from server.context import get_llm, get_redis
 from server.router.game_def_handlers import get_game_def, update_game_def
 from server.typecheck_fighter import RedisType
 
@@ -13,14 +14,25 @@ router = APIRouter(prefix="/game/{game_uuid}/agent", tags=["Agent Definitions"])
 
 @router.post("/create", operation_id="create_agent", response_model=AgentDef)
 async def create_agent_def(
-    game_uuid: str, agent_name: str, redis: RedisType = Depends(get_redis)
+    game_uuid: str,
+    agent_name: str,
+    background_tasks: BackgroundTasks,
+    redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
 ):
     game = await get_game_def(game_uuid, redis)
 
     agent = AgentDef(name=agent_name)
     game.agents.append(agent)
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game,
+        background_tasks,
+        overwrite_agents=True,
+        redis=redis,
+        llm=llm,
+    )
 
     return agent
 
@@ -53,7 +65,9 @@ async def update_agent_def(
     game_uuid: str,
     agent_uuid: str,
     agent: AgentDef,
+    background_tasks: BackgroundTasks,
     redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
 ):
     game = await get_game_def(game_uuid, redis)
 
@@ -67,7 +81,14 @@ async def update_agent_def(
 
     game.agents[index] = agent
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game,
+        background_tasks,
+        overwrite_agents=True,
+        redis=redis,
+        llm=llm,
+    )
 
     return agent
 
@@ -76,10 +97,19 @@ async def update_agent_def(
 async def delete_agent_def(
     game_uuid: str,
     agent_uuid: str,
+    background_tasks: BackgroundTasks,
     redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
 ):
     game = await get_game_def(game_uuid, redis)
 
     game.agents = [agent for agent in game.agents if str(agent.uuid) != agent_uuid]
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game,
+        background_tasks,
+        overwrite_agents=True,
+        redis=redis,
+        llm=llm,
+    )
@@ -1,11 +1,15 @@
-from typing import List, Union
+import logging
+from typing import List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
 from pydantic import UUID4
+from redis.exceptions import WatchError
 
+from game.lore_vectors import LoreVectors
+from llm.base import LLMBase
 from schema import GameDef, Lore
-from server.context import get_redis
+from server.context import get_llm, get_redis
 from server.schema.summary import GameDefSummary
 from server.security.auth import authenticate, password_protected
 from server.typecheck_fighter import RedisType, pipeline_exec
@@ -101,10 +105,19 @@ async def get_game_def_json(
 )
 async def update_game_def_json(
     jsoned_game: str,
+    background_tasks: BackgroundTasks,
     redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
 ):
     game: GameDef = GameDef.parse_raw(jsoned_game)
-    await update_game_def(str(game.uuid), game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        str(game.uuid),
+        game,
+        background_tasks,
+        overwrite_agents=True,
+        redis=redis,
+        llm=llm,
+    )
 
 
 @router.put(
@@ -116,30 +129,26 @@ async def update_game_def_json(
 async def update_game_def(
     uuid: str,
     game: GameDef,
+    background_tasks: BackgroundTasks,
     overwrite_agents: bool = False,
     redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
 ):
+    """Saves the game, then rates and embeds its lore in the background so that
+    sessions of it can be created without asking the LLM."""
     game.uuid = UUID4(uuid)
-    pipe = redis.pipeline()
-    if overwrite_agents:
-        pipe.set(uuid, game.json())
-        pipe.sadd(GAME_DEFS_SET, uuid)
-        await pipeline_exec(pipe)
-        return game
+    if not overwrite_agents:
+        jsoned = await redis.get(uuid)
+        if jsoned:
+            old_game = GameDef.parse_raw(jsoned)
+            if old_game.agents:
+                game.agents = old_game.agents
 
-    jsoned = await redis.get(uuid)
-    if not jsoned:
-        pipe.set(uuid, game.json())
-        pipe.sadd(GAME_DEFS_SET, uuid)
-        await pipeline_exec(pipe)
-        return game
-
-    old_game = GameDef.parse_raw(jsoned)
-    if old_game.agents:
-        game.agents = old_game.agents
+    pipe = redis.pipeline()
     pipe.set(uuid, game.json())
     pipe.sadd(GAME_DEFS_SET, uuid)
     await pipeline_exec(pipe)
+    background_tasks.add_task(save_lore_vectors, uuid, game, redis, llm)
     return game
 
 
@@ -153,6 +162,58 @@ async def delete_game_def(
     redis: RedisType = Depends(get_redis),
 ):
     pipe = redis.pipeline()
-    pipe.delete(uuid)
+    pipe.delete(uuid, lore_vectors_key(uuid))
     pipe.srem(GAME_DEFS_SET, uuid)
     await pipeline_exec(pipe)
+
+
+def lore_vectors_key(uuid: str) -> str:
+    return f"{uuid}:lore_vectors"
+
+
+async def save_lore_vectors(
+    uuid: str, game: GameDef, redis: RedisType, llm: LLMBase
+) -> None:
+    """Rates and embeds the lore of the game, reusing what was computed for its
+    previous versions. The vectors are only saved if the game still is, so that
+    saves finishing out of order can't replace newer vectors with older ones."""
+    try:
+        saved = await redis.get(lore_vectors_key(uuid))
+        previous = _read_lore_vectors(uuid, saved) if saved else None
+        vectors = await LoreVectors.compute(llm, game, previous)
+
+        async with redis.pipeline() as pipe:
+            await pipe.watch(uuid)
+            if await pipe.get(uuid) != game.json().encode():
+                return
+            pipe.multi()
+            pipe.set(lore_vectors_key(uuid), vectors.to_bytes())
+            await pipeline_exec(pipe)
+    except WatchError:
+        # Saved again just now, that save's vectors are the ones to keep.
+        pass
+    except Exception:
+        # Sessions rate and embed what's missing themselves.
+        logging.getLogger().exception(f"Couldn't compute the lore of game {uuid}")
+
+
+def _read_lore_vectors(uuid: str, saved: bytes) -> Optional[LoreVectors]:
+    """The saved vectors, or None if they can't be read, so that they're replaced."""
+    try:
+        return LoreVectors.from_bytes(saved)
+    except Exception:
+        logging.getLogger().exception(f"Couldn't read the lore vectors of game {uuid}")
+        return None
+
+
+async def load_lore_vectors(
+    uuid: str, game: GameDef, redis: RedisType, llm: LLMBase
+) -> None:
+    """Fills in the importance and embedding of the lore of the game, as far as
+    they were computed when it was saved."""
+    saved = await redis.get(lore_vectors_key(uuid))
+    if not saved:
+        return
+    vectors = _read_lore_vectors(uuid, saved)
+    if vectors and vectors.embedding_model == llm.embedding_model:
+        vectors.apply_to_game(game)
@@ -1,9 +1,10 @@
-from typing import List
+from typing import Dict, List
 
 from fastapi import APIRouter, Depends
 
 from game.prompt_helpers import get_rate_function, rating_to_int
 from llm.base import LLMBase
+from llm.call_context import CallKind, call_kind
 from schema import Message
 from server.context import (
     get_llm,
@@ -28,14 +29,22 @@ async def rate(
     question: str,
     llm: LLMBase = Depends(get_llm),
 ) -> int:
-    rating = await llm.action_completion(
-        [
-            Message(
-                role="system",
-                content=question + " Please use the provided Rate() function.",
-            )
-        ],
-        [get_rate_function()],
-    )
+    with call_kind(CallKind.RATE):
+        rating = await llm.action_completion(
+            [
+                Message(
+                    role="system",
+                    content=question + " Please use the provided Rate() function.",
+                )
+            ],
+            [get_rate_function()],
+        )
 
     return rating_to_int(rating)
+
+
+@router.get("/stats", operation_id="llm_stats", response_model=Dict[str, int])
+async def stats(
+    llm: LLMBase = Depends(get_llm),
+) -> Dict[str, int]:
+    return llm.stats()
@@ -1,24 +1,42 @@
 import asyncio
+import json
+import logging
+import math
+import time
 import uuid
+from collections import defaultdict
 from configparser import ConfigParser
-from typing import Awaitable, List, Optional
-
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import UUID4
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Set, Union
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+    WebSocketException,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import UUID4, ValidationError
+from starlette.status import WS_1008_POLICY_VIOLATION
 
 from game.agent import GenAgent
-from game.memory import GenAgentMemory
+from game.memory import GenAgentMemory, lore_visibility
 from game.session import Session
 from game.ti_retriever import TIRetriever
-from llm.base import LLMBase
+from llm.base import LLMBase, close_stream
+from llm.tokens import estimate_tokens
 from schema import (
+    ActionCompletion,
     AgentDef,
     Conversation,
     GameDef,
+    HistoryConfig,
     Knowledge,
-    Lore,
     MemoryConfig,
+    MemoryStats,
     Message,
+    PromptConfig,
 )
 from server.context import (
     SessionsType,
@@ -27,15 +45,21 @@ from server.context import (
     get_redis,
     get_sessions,
 )
-from server.router.game_def_handlers import get_game_def
+from server.router.game_def_handlers import get_game_def, load_lore_vectors
 from server.schema.debug import (
     ActionCompletionWithDebug,
     InteractWithDebug,
     MessageWithDebug,
 )
-from server.security.auth import authenticate
+from server.schema.session_socket import SocketRequest, SocketResponse
+from server.security.auth import authenticate, authenticate_websocket
 from server.typecheck_fighter import RedisType
-from server.util.rate_limit import rate_limiter
+from server.util.rate_limit import (
+    TurnRateLimiter,
+    rate_limiter,
+    user,
+    websocket_rate_limiter,
+)
 
 router = APIRouter(prefix="/session", tags=["Game Sessions"])
 
@@ -56,6 +80,64 @@ def get_gen_agent(agent: str, session: Session):
     return gen_agent
 
 
+def server_sent_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def stream_response(
+    stream: AsyncIterator[Union[str, ActionCompletion]],
+    debug: List[Message],
+    send_debug: bool,
+    start_time: float,
+) -> AsyncIterator[Union[str, InteractWithDebug]]:
+    """Passes on each piece of text, then yields the whole response."""
+    content = ""
+    action: Optional[ActionCompletion] = None
+    try:
+        async for piece in stream:
+            if isinstance(piece, ActionCompletion):
+                action = piece
+                continue
+
+            if not content:
+                logging.getLogger().debug(
+                    f"First token after {time.perf_counter() - start_time:.3f}s"
+                )
+            content += piece
+            yield piece
+    finally:
+        # Lets go of the LLM as soon as the client does.
+        await close_stream(stream)
+
+    response_with_debug = InteractWithDebug(
+        response=action or Message(role="assistant", content=content)
+    )
+    if send_debug:
+        response_with_debug.debug = debug
+        response_with_debug.prompt_tokens = estimate_tokens(debug)
+    yield response_with_debug
+
+
+async def stream_events(
+    stream: AsyncIterator[Union[str, ActionCompletion]],
+    debug: List[Message],
+    send_debug: bool,
+    start_time: float,
+) -> AsyncIterator[str]:
+    """Sends each piece of text as a `token` event, then the whole response as a
+    `done` event holding an InteractWithDebug, or an `error` event if it fails."""
+    try:
+        async for piece in stream_response(stream, debug, send_debug, start_time):
+            if isinstance(piece, str):
+                yield server_sent_event("token", json.dumps(dict(content=piece)))
+            else:
+                yield server_sent_event("done", piece.json())
+    except Exception:
+        # The 200 is already sent, so only an event can tell the client.
+        logging.getLogger().exception("Streaming a response failed")
+        yield server_sent_event("error", json.dumps(dict(detail="Internal error")))
+
+
 def get_agent_def(agent: str, session: Session) -> AgentDef:
     agent_def = next(
         (
@@ -105,26 +187,66 @@ async def create_session(
     - **session_uuid** (uuid4 as str): the uuid of the session created
     """
     game_def = await get_game_def(game_uuid, redis)
+    # Lore computed when the game was saved isn't rated and embedded again
+    await load_lore_vectors(game_uuid, game_def, redis, llm)
+
+    # parse_obj so that values from config.ini are validated
+    memory_config = MemoryConfig.parse_obj(
+        dict(
+            max_memories=config_parser.getint(
+                "memory_config", "max_memories", fallback=1024
+            ),
+            memories_returned=config_parser.getint(
+                "memory_config", "default_memories_returned", fallback=5
+            ),
+            eviction_fraction=config_parser.getfloat(
+                "memory_config", "eviction_fraction", fallback=0.125
+            ),
+            embedding_dtype=config_parser.get(
+                "memory_config", "embedding_dtype", fallback="float32"
+            ),
+            index=config_parser.get("memory_config", "index", fallback="exact"),
+            ivf_lists=config_parser.getint("memory_config", "ivf_lists", fallback=256),
+            ivf_probes=config_parser.getint("memory_config", "ivf_probes", fallback=16),
+            ivf_train_size=config_parser.getint(
+                "memory_config", "ivf_train_size", fallback=8192
+            ),
+            embedding_dims=llm.embedding_size,
+        )
+    )
 
-    memory_config = MemoryConfig(
-        max_memories=config_parser.getint(
-            "memory_config", "max_memories", fallback=1024
-        ),
-        memories_returned=config_parser.getint(
-            "memory_config", "default_memories_returned", fallback=5
+    # Shared lore is rated, embedded and stored once per session; each agent only
+    # recalls the rows it knows about.
+    shared_memory = GenAgentMemory(
+        llm,
+        memory_config.memories_returned,
+        TIRetriever(
+            memory_config.copy(
+                update=dict(max_memories=max(1, len(game_def.shared_lore)))
+            )
         ),
-        embedding_dims=llm.embedding_size,
+    )
+    await asyncio.gather(
+        *[shared_memory.add_memory(lore.memory) for lore in game_def.shared_lore]
     )
 
-    # TODO: embed personal lore at the same time as this
-    async def lore_task(lore: Lore):
-        lore.memory.embedding = await llm.embed(lore.memory.description)
-
-    set_lore_coroutines: List[Awaitable[None]] = []
-    for shared_lore in game_def.shared_lore:
-        set_lore_coroutines.append(lore_task(shared_lore))
-
-    await asyncio.gather(*set_lore_coroutines)
+    history_config = HistoryConfig.parse_obj(
+        dict(
+            max_tokens=config_parser.getint("history", "max_tokens", fallback=2048),
+            recent_messages=config_parser.getint(
+                "history", "recent_messages", fallback=8
+            ),
+            summarize=config_parser.getboolean("history", "summarize", fallback=True),
+        )
+    )
+    prompt_config = PromptConfig.parse_obj(
+        dict(
+            layout=config_parser.get("prompt", "layout", fallback="standard"),
+            batch_queries=config_parser.getboolean(
+                "prompt", "batch_queries", fallback=False
+            ),
+        )
+    )
 
     awaitable_agents: List[Awaitable[GenAgent]] = []
     for agent_def in game_def.agents:
@@ -138,11 +260,23 @@ async def create_session(
             llm,
             memory_config.memories_returned,
             TIRetriever(memory_config),
+            shared_retriever=shared_memory.retriever,
+            shared_visibility=lore_visibility(game_def.shared_lore, agent_def.uuid),
         )
 
-        awaitable_agents.append(GenAgent.create(knowledge, llm, memory))
+        awaitable_agents.append(
+            GenAgent.create(
+                knowledge,
+                llm,
+                memory,
+                include_shared_lore=False,
+                history_config=history_config,
+                prompt_config=prompt_config,
+            )
+        )
 
     agents = await asyncio.gather(*awaitable_agents)
+
     session = Session(uuid=uuid.uuid4(), game_def=game_def, agents=agents)
     sessions[session.uuid] = session
 
@@ -180,6 +314,30 @@ def is_session_active(
     return uuid.UUID(session_uuid, version=4) in sessions.keys()
 
 
+@router.get(
+    "/{session_uuid}/memory_stats",
+    operation_id="memory_stats",
+    response_model=Dict[str, MemoryStats],
+    dependencies=[Depends(authenticate)],
+)
+def get_memory_stats(
+    session_uuid: str,
+    sessions: SessionsType = Depends(get_sessions),
+):
+    """How many memories each agent holds and how many it has forgotten
+    because it reached max_memories.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+
+    <h3>Returns:</h3>
+    - **memory_stats** (Dict[str, MemoryStats]): stats keyed by agent name
+    """
+    session = sessions[UUID4(session_uuid)]
+    return {gen_agent.name: gen_agent.memory_stats for gen_agent in session.agents}
+
+
 @router.post(
     "/{session_uuid}/start_chat",
     operation_id="start_chat",
@@ -254,10 +412,52 @@ async def chat(
     msg_with_debug = MessageWithDebug(message=response)
     if send_debug:
         msg_with_debug.debug = debug
+        msg_with_debug.prompt_tokens = estimate_tokens(debug)
 
     return msg_with_debug
 
 
+@router.post(
+    "/{session_uuid}/chat_stream",
+    operation_id="chat_stream",
+    response_class=StreamingResponse,
+    dependencies=[Depends(authenticate), Depends(rate_limiter)],
+)
+async def chat_stream(
+    session_uuid: str,
+    agent: str,
+    message: str,
+    send_debug: bool = False,
+    sessions: SessionsType = Depends(get_sessions),
+):
+    """Like chat, but streams the response as Server-Sent Events.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+    - **agent** (str): either the uuid or the name of the agent.
+    - **message** (str): what you're saying to the agent
+    - **send_debug** (bool): sends optional debugging information
+
+    <h3>Returns:</h3>
+    - **events** (text/event-stream): `token` events with a piece of the
+    response in data.content, then one `done` event whose data is the whole
+    response. done.response is the Message, debug information is in done.debug.
+    If the response fails midway, an `error` event with data.detail comes instead
+    of `done`.
+    """
+    start_time = time.perf_counter()
+    session = sessions[UUID4(session_uuid)]
+    gen_agent = get_gen_agent(agent, session)
+
+    stream, debug = await gen_agent.chat_stream(message)
+
+    return StreamingResponse(
+        stream_events(stream, debug, send_debug, start_time),
+        media_type="text/event-stream",
+    )
+
+
 @router.post(
     "/{session_uuid}/interact",
     operation_id="interact",
@@ -296,10 +496,53 @@ async def interact(
 
     if send_debug:
         response_with_debug.debug = debug
+        response_with_debug.prompt_tokens = estimate_tokens(debug)
 
     return response_with_debug
 
 
+@router.post(
+    "/{session_uuid}/interact_stream",
+    operation_id="interact_stream",
+    response_class=StreamingResponse,
+    dependencies=[Depends(authenticate), Depends(rate_limiter)],
+)
+async def interact_stream(
+    session_uuid: str,
+    agent: str,
+    message: str,
+    send_debug: bool = False,
+    sessions: SessionsType = Depends(get_sessions),
+):
+    """Like interact, but streams the response as Server-Sent Events.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+    - **agent** (str): either the uuid or the name of the agent.
+    - **message** (str): what you're saying to the agent
+    - **send_debug** (bool): sends optional debugging information
+
+    <h3>Returns:</h3>
+    - **events** (text/event-stream): `token` events with a piece of the
+    response in data.content, then one `done` event whose data is the whole
+    response. done.response is either a Message or an ActionCompletion; no
+    `token` events are sent for actions. Debug information is in done.debug.
+    If the response fails midway, an `error` event with data.detail comes instead
+    of `done`.
+    """
+    start_time = time.perf_counter()
+    session = sessions[UUID4(session_uuid)]
+    gen_agent = get_gen_agent(agent, session)
+
+    stream, debug = await gen_agent.interact_stream(message)
+
+    return StreamingResponse(
+        stream_events(stream, debug, send_debug, start_time),
+        media_type="text/event-stream",
+    )
+
+
 @router.post(
     "/{session_uuid}/act",
     operation_id="action",
@@ -336,6 +579,7 @@ async def act(
 
     if send_debug:
         action_with_debug.debug = debug
+        action_with_debug.prompt_tokens = estimate_tokens(debug)
 
     return action_with_debug
 
@@ -411,6 +655,117 @@ async def query(
     return await gen_agent.query(queries)
 
 
+@router.websocket("/{session_uuid}/ws")
+async def session_socket(
+    websocket: WebSocket,
+    session_uuid: str,
+    sessions: SessionsType = Depends(get_sessions),
+    _: None = Depends(authenticate_websocket),
+    __: None = Depends(websocket_rate_limiter),
+):
+    """A connection for a whole play session. Authenticates once, then takes
+    SocketRequest frames (as JSON) for chat, interact, act and query with any
+    agent in the session and answers each with SocketResponse frames. Chat and
+    interact responses are streamed as `token` frames before the `done` frame.
+    Turns are rate limited like their HTTP endpoints, across all of a user's
+    sockets."""
+    session = sessions.get(UUID4(session_uuid))
+    if not session:
+        raise WebSocketException(
+            code=WS_1008_POLICY_VIOLATION, reason="Session not found"
+        )
+
+    await websocket.accept()
+
+    send_lock = asyncio.Lock()
+    agent_locks: Dict[UUID4, asyncio.Lock] = defaultdict(asyncio.Lock)
+    turns: Set["asyncio.Task[None]"] = set()
+    user_id = await user(websocket)
+
+    async def send(response: SocketResponse):
+        async with send_lock:
+            await websocket.send_text(response.json())
+
+    async def take_turn(request: SocketRequest, gen_agent: GenAgent):
+        start_time = time.perf_counter()
+        async with agent_locks[gen_agent.uuid]:
+            if request.type == "act":
+                action, debug = await gen_agent.act(request.message)
+                action_with_debug = ActionCompletionWithDebug(action=action)
+                if request.send_debug:
+                    action_with_debug.debug = debug
+                    action_with_debug.prompt_tokens = estimate_tokens(debug)
+                await send(
+                    SocketResponse(
+                        id=request.id, type="done", response=action_with_debug
+                    )
+                )
+            elif request.type == "query":
+                ratings = await gen_agent.query(request.queries)
+                await send(SocketResponse(id=request.id, type="done", response=ratings))
+            else:
+                if request.type == "chat":
+                    stream, debug = await gen_agent.chat_stream(request.message or "")
+                else:
+                    stream, debug = await gen_agent.interact_stream(request.message)
+
+                async for piece in stream_response(
+                    stream, debug, request.send_debug, start_time
+                ):
+                    if isinstance(piece, str):
+                        await send(
+                            SocketResponse(id=request.id, type="token", content=piece)
+                        )
+                    else:
+                        await send(
+                            SocketResponse(id=request.id, type="done", response=piece)
+                        )
+
+    async def take_turn_or_fail(request: SocketRequest, gen_agent: GenAgent):
+        try:
+            await take_turn(request, gen_agent)
+        except WebSocketDisconnect:
+            pass
+        except Exception:
+            logging.getLogger().exception(f"WebSocket {request.type} failed")
+            await send(
+                SocketResponse(id=request.id, type="error", detail="Internal error")
+            )
+
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            try:
+                request = SocketRequest.parse_raw(frame)
+                if request.type == "chat" and not request.message:
+                    raise ValueError("chat requires a message")
+                gen_agent = get_gen_agent(request.agent, session)
+            except (ValidationError, ValueError, HTTPException) as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                await send(SocketResponse(type="error", detail=detail))
+                continue
+
+            # Looked up per turn, since idle limiters are dropped
+            retry_after = TurnRateLimiter.for_user(user_id).retry_after()
+            if retry_after:
+                await send(
+                    SocketResponse(
+                        id=request.id,
+                        type="error",
+                        detail="Too Many Requests. Retry after "
+                        f"{math.ceil(retry_after)}s",
+                    )
+                )
+                continue
+
+            turn = asyncio.create_task(take_turn_or_fail(request, gen_agent))
+            turns.add(turn)
+            turn.add_done_callback(turns.discard)
+    except WebSocketDisconnect:
+        for turn in turns:
+            turn.cancel()
+
+
 @router.put(
     "/sync",
     operation_id="sync_sessions_to_game_defs",
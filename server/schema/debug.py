@@ -8,13 +8,19 @@ from schema import ActionCompletion, Message
 class MessageWithDebug(BaseModel):
     message: Message
     debug: List[Message] = Field(default_factory=list)
+    prompt_tokens: int = 0
+    """Estimated tokens of the prompt in debug."""
 
 
 class ActionCompletionWithDebug(BaseModel):
     action: Optional[ActionCompletion]
     debug: List[Message] = Field(default_factory=list)
+    prompt_tokens: int = 0
+    """Estimated tokens of the prompt in debug."""
 
 
 class InteractWithDebug(BaseModel):
     response: Union[Message, ActionCompletion]
     debug: List[Message] = Field(default_factory=list)
+    prompt_tokens: int = 0
+    """Estimated tokens of the prompt in debug."""
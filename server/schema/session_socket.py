@@ -0,0 +1,38 @@
+from typing import List, Literal, Optional, Union
+
+from pydantic import BaseModel, Field
+
+from server.schema.debug import ActionCompletionWithDebug, InteractWithDebug
+
+
+class SocketRequest(BaseModel):
+    """A turn sent over a session's WebSocket. Turns for different agents run
+    concurrently, turns for the same agent run in the order they were sent."""
+
+    # Echoed back in every frame answering this request.
+    id: Optional[str] = None
+    type: Literal["chat", "interact", "act", "query"]
+    agent: str
+    # Required for chat.
+    message: Optional[str] = None
+    # Required for query.
+    queries: List[str] = Field(default_factory=list)
+    send_debug: bool = False
+
+
+class SocketResponse(BaseModel):
+    """A `token` frame holds a piece of a chat or interact response in content.
+    A `done` frame holds the whole response, shaped like the response of the
+    matching HTTP endpoint, except that chat responses are InteractWithDebug.
+    An `error` frame holds what went wrong in detail."""
+
+    id: Optional[str] = None
+    type: Literal["token", "done", "error"]
+    content: Optional[str] = None
+    response: Union[InteractWithDebug, ActionCompletionWithDebug, List[int], None] = (
+        None
+    )
+    detail: Optional[str] = None
+
+    class Config:
+        smart_union = True
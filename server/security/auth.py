@@ -1,7 +1,7 @@
 from configparser import ConfigParser
 from typing import Optional
 
-from fastapi import Depends, Header, HTTPException
+from fastapi import Depends, Header, HTTPException, WebSocket, WebSocketException
 from fastapi.security import (
     HTTPAuthorizationCredentials,
     HTTPBearer,
@@ -9,6 +9,7 @@ from fastapi.security import (
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTError
 from starlette.requests import Request
+from starlette.status import WS_1008_POLICY_VIOLATION
 
 from server.context import get_config_parser
 
@@ -58,6 +59,30 @@ class OAuth2Bearer(HTTPBearer):
 authenticate = OAuth2Bearer(bearerFormat="bearerToken")
 
 
+async def authenticate_websocket(
+    websocket: WebSocket, parser: ConfigParser = Depends(get_config_parser)
+):
+    """authenticate for WebSocket routes, which close the connection instead of
+    responding with a 401."""
+    use_auth = parser.getboolean("server", "auth_required", fallback=False)
+    if use_auth:
+        token: Optional[str] = websocket.cookies.get("token")
+        if not token:
+            raise WebSocketException(
+                code=WS_1008_POLICY_VIOLATION, reason="No token provided in cookies"
+            )
+        try:
+            user = verify_token(token, parser)
+        except HTTPException as e:
+            raise WebSocketException(code=WS_1008_POLICY_VIOLATION, reason=e.detail)
+        if "email" not in user:
+            raise WebSocketException(
+                code=WS_1008_POLICY_VIOLATION, reason="No email provided."
+            )
+
+        websocket.state.email = user["email"]
+
+
 def password_protected(
     password: str = Header(None), parser: ConfigParser = Depends(get_config_parser)
 ):
@@ -1,20 +1,31 @@
 import configparser
 from typing import Any
 from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock
 
 from fakeredis import aioredis
 from fastapi.encoders import jsonable_encoder
 from httpx import AsyncClient
 from pydantic import UUID4
 
-from schema import GameDef
-from server.context import get_config_parser, get_redis
+from game.lore_vectors import LoreVectors
+from llm.fake import FakeLLM
+from schema import AgentDef, GameDef, Lore, Memory
+from server.context import (
+    SessionsType,
+    get_config_parser,
+    get_llm,
+    get_redis,
+    get_sessions,
+)
 from server.main import app
+from server.router.game_def_handlers import lore_vectors_key, save_lore_vectors
 
 
 class GameHandlerTest(IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         self._redis_fake: Any = aioredis.FakeRedis()
+        self._llm = FakeLLM(embedding_size=8)
         parser = configparser.ConfigParser()
         parser.read("example_config.ini")
 
@@ -24,12 +35,17 @@ class GameHandlerTest(IsolatedAsyncioTestCase):
         def get_test_redis():
             return self._redis_fake
 
+        def get_test_llm():
+            return self._llm
+
         app.dependency_overrides[get_config_parser] = get_test_parser
         app.dependency_overrides[get_redis] = get_test_redis
+        app.dependency_overrides[get_llm] = get_test_llm
         self._client = AsyncClient(app=app, base_url="http://test")
 
     async def asyncTearDown(self):
         await self._redis_fake.flushall()
+        app.dependency_overrides.pop(get_sessions, None)
 
     async def test_create_game(self):
         game_name = "King Game"
@@ -87,5 +103,80 @@ class GameHandlerTest(IsolatedAsyncioTestCase):
         list_resp = await self._client.get("/game/list")
         assert len(list_resp.json()) == 0
 
+    async def test_lore_computed_on_save(self):
+        agent_def = AgentDef(
+            name="King", personal_lore=[Memory(description="The crown is fake")]
+        )
+        game_def = GameDef(
+            name="King Game",
+            agents=[agent_def],
+            shared_lore=[
+                Lore(
+                    known_by={agent_def.uuid},
+                    memory=Memory(description="The queen is away"),
+                )
+            ],
+        )
+        response = await self._client.put(
+            "/game/json", params={"jsoned_game": game_def.json()}
+        )
+        assert response.status_code == 200
+        assert await self._redis_fake.exists(f"{game_def.uuid}:lore_vectors")
+
+        sessions: SessionsType = {}
+        app.dependency_overrides[get_sessions] = lambda: sessions
+        llm: Any = AsyncMock()
+        llm.embedding_size = self._llm.embedding_size
+        llm.embedding_model = self._llm.embedding_model
+        app.dependency_overrides[get_llm] = lambda: llm
+        response = await self._client.post(
+            "/session/create", params={"game_uuid": str(game_def.uuid)}
+        )
+        assert response.status_code == 200
+        assert len(sessions) == 1
+        assert not llm.mock_calls
+
+        await self._client.delete("/game/{}".format(game_def.uuid))
+        assert not await self._redis_fake.exists(f"{game_def.uuid}:lore_vectors")
+
+    async def test_lore_saves_out_of_order(self):
+        game_def = GameDef(
+            name="King Game",
+            shared_lore=[Lore(memory=Memory(description="The queen is away"))],
+        )
+        older = game_def.copy(deep=True)
+        await self._redis_fake.set(str(game_def.uuid), game_def.json())
+        key = lore_vectors_key(str(game_def.uuid))
+        # Unreadable vectors are replaced
+        await self._redis_fake.set(key, b"corrupt")
+
+        await save_lore_vectors(
+            str(game_def.uuid), game_def, self._redis_fake, self._llm
+        )
+        saved = await self._redis_fake.get(key)
+        assert len(LoreVectors.from_bytes(saved)) == 1
+
+        # The older version of the game finishing last changes nothing
+        older.shared_lore.append(Lore(memory=Memory(description="A dragon is near")))
+        await save_lore_vectors(str(game_def.uuid), older, self._redis_fake, self._llm)
+        assert await self._redis_fake.get(key) == saved
+
+    async def test_session_created_despite_unreadable_lore(self):
+        game_def = GameDef(
+            name="King Game",
+            agents=[AgentDef(name="King")],
+            shared_lore=[Lore(memory=Memory(description="The queen is away"))],
+        )
+        await self._redis_fake.set(str(game_def.uuid), game_def.json())
+        await self._redis_fake.set(lore_vectors_key(str(game_def.uuid)), b"corrupt")
+
+        sessions: SessionsType = {}
+        app.dependency_overrides[get_sessions] = lambda: sessions
+        response = await self._client.post(
+            "/session/create", params={"game_uuid": str(game_def.uuid)}
+        )
+        assert response.status_code == 200
+        assert len(sessions) == 1
+
 
 # TODO: test no accidental agent override?
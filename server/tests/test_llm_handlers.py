@@ -0,0 +1,39 @@
+import asyncio
+from typing import Any
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock
+
+from httpx import ASGITransport, AsyncClient
+from openai.error import AuthenticationError, RateLimitError
+
+from llm.retry import DeadlineExceeded
+from server.context import get_llm
+from server.main import app
+
+
+class LLMHandlerTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._llm: Any = AsyncMock()
+
+        def get_test_llm():
+            return self._llm
+
+        app.dependency_overrides[get_llm] = get_test_llm
+        transport = ASGITransport(app=app, raise_app_exceptions=False)  # type: ignore
+        self._client = AsyncClient(transport=transport, base_url="http://test")
+
+    async def asyncTearDown(self):
+        app.dependency_overrides.clear()
+
+    async def test_llm_errors(self):
+        for error, status_code in [
+            (RateLimitError("Slow down", headers={}), 503),
+            (DeadlineExceeded(), 503),
+            # Retrying or waiting won't fix these.
+            (AuthenticationError("Bad key", headers={}), 500),
+            (asyncio.TimeoutError(), 500),
+        ]:
+            with self.subTest(error=error):
+                self._llm.embed.side_effect = error
+                response = await self._client.get("/llm/embed", params={"text": "a"})
+                assert response.status_code == status_code
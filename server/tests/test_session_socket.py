@@ -0,0 +1,144 @@
+import asyncio
+import configparser
+import uuid
+from typing import Any, AsyncIterator, List
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+
+from fastapi.testclient import TestClient
+
+from game.agent import GenAgent
+from game.session import Session
+from schema import ActionCompletion, AgentDef, GameDef, Knowledge, Message
+from server.context import get_config_parser, get_sessions
+from server.main import app
+from server.router.session_handlers import stream_events
+from server.util import rate_limit
+from server.util.rate_limit import TurnRateLimiter, websocket_rate_limiter
+
+
+class SessionSocketTest(TestCase):
+    def setUp(self):
+        parser = configparser.ConfigParser()
+        parser.read("example_config.ini")
+
+        llm: Any = AsyncMock()
+
+        async def stream_chat_completion(messages: List[Message]) -> AsyncIterator[str]:
+            for piece in ["Not much", ", peasant!"]:
+                yield piece
+
+        llm.stream_chat_completion = stream_chat_completion
+        llm.action_completion.return_value = ActionCompletion(
+            action="rate", args={"rating": "Fairly."}
+        )
+        memory: Any = AsyncMock()
+        memory.retrieve_relevant_memories.return_value = []
+        memory.retrieve_relevant_memories_grouped.return_value = [[]]
+
+        agent_def = AgentDef(uuid=uuid.uuid4(), name="King")
+        game_def = GameDef(uuid=uuid.uuid4(), name="King Game", agents=[agent_def])
+        knowledge = Knowledge(game_description="", agent_def=agent_def, shared_lore=[])
+        self._agent = asyncio.run(GenAgent.create(knowledge, llm, memory))
+        self._session = Session(
+            uuid=uuid.uuid4(), game_def=game_def, agents=[self._agent]
+        )
+
+        app.dependency_overrides[get_config_parser] = lambda: parser
+        app.dependency_overrides[get_sessions] = lambda: {
+            self._session.uuid: self._session
+        }
+        self._client = TestClient(app)
+
+    def tearDown(self):
+        app.dependency_overrides.clear()
+
+    def test_chat(self):
+        with self._client.websocket_connect(
+            "/session/{}/ws".format(self._session.uuid)
+        ) as websocket:
+            websocket.send_json(
+                {"id": "1", "type": "chat", "agent": "King", "message": "What's up?"}
+            )
+
+            assert websocket.receive_json()["content"] == "Not much"
+            assert websocket.receive_json()["content"] == ", peasant!"
+            done = websocket.receive_json()
+            assert done["id"] == "1"
+            assert done["type"] == "done"
+            assert done["response"]["response"]["content"] == "Not much, peasant!"
+
+            websocket.send_json(
+                {
+                    "id": "2",
+                    "type": "query",
+                    "agent": str(self._agent.uuid),
+                    "queries": ["?"],
+                }
+            )
+            assert websocket.receive_json() == {
+                "id": "2",
+                "type": "done",
+                "content": None,
+                "response": [4],
+                "detail": None,
+            }
+
+    def test_errors(self):
+        with self._client.websocket_connect(
+            "/session/{}/ws".format(self._session.uuid)
+        ) as websocket:
+            websocket.send_json(
+                {"id": "1", "type": "chat", "agent": "Nobody", "message": "?"}
+            )
+            assert websocket.receive_json()["detail"] == "Agent not found"
+
+            websocket.send_text("not json")
+            assert websocket.receive_json()["type"] == "error"
+
+            # The connection is still usable.
+            websocket.send_json({"id": "3", "type": "act", "agent": "King"})
+            assert websocket.receive_json()["type"] == "done"
+
+    def test_turn_limit_is_per_user(self):
+        app.dependency_overrides[websocket_rate_limiter] = lambda: None
+        url = "/session/{}/ws".format(self._session.uuid)
+        query = {"id": "1", "type": "query", "agent": "King", "queries": ["?"]}
+        with (
+            patch.object(rate_limit, "enable_rate_limit", True),
+            patch.object(rate_limit, "times", 1),
+            patch.object(rate_limit, "seconds", 60),
+            patch.dict(rate_limit._turn_limiters, clear=True),  # type: ignore
+            self._client.websocket_connect(url) as first,
+            self._client.websocket_connect(url) as second,
+        ):
+            first.send_json(query)
+            assert first.receive_json()["type"] == "done"
+            # The same user's other socket is out of turns too
+            second.send_json(query)
+            assert "Too Many Requests" in second.receive_json()["detail"]
+
+
+def test_idle_turn_limiters_are_dropped():
+    with (
+        patch.object(rate_limit, "enable_rate_limit", True),
+        patch.object(rate_limit, "_SWEEP_SECONDS", 0),
+        patch.object(rate_limit, "seconds", 0),
+        patch.object(rate_limit, "minutes", 0),
+        patch.object(rate_limit, "hours", 0),
+        patch.dict(rate_limit._turn_limiters, clear=True),  # type: ignore
+    ):
+        TurnRateLimiter.for_user("a").retry_after()
+        # A window of 0 is over straight away
+        TurnRateLimiter.for_user("b")
+        assert list(rate_limit._turn_limiters) == ["b"]  # type: ignore
+
+
+async def test_stream_events_report_failures():
+    async def failing_stream() -> AsyncIterator[str]:
+        yield "Not much"
+        raise asyncio.TimeoutError()
+
+    events = [event async for event in stream_events(failing_stream(), [], False, 0)]
+    assert events[0].startswith("event: token")
+    assert events[-1].startswith("event: error")
@@ -1,7 +1,12 @@
+import time
+from collections import deque
 from configparser import ConfigParser
+from typing import Deque, Dict
 
-from fastapi import Request, Response
-from fastapi_limiter.depends import RateLimiter  # type: ignore
+from fastapi import Request, Response, WebSocket, WebSocketException
+from fastapi.requests import HTTPConnection
+from fastapi_limiter.depends import RateLimiter, WebSocketRateLimiter  # type: ignore
+from starlette.status import WS_1013_TRY_AGAIN_LATER
 
 parser = ConfigParser()
 parser.read("config.ini")
@@ -13,7 +18,7 @@ minutes = parser.getint("rate_limit", "minutes", fallback=0)
 hours = parser.getint("rate_limit", "hours", fallback=0)
 
 
-async def user(request: Request):
+async def user(request: HTTPConnection):
     if parser.getboolean("server", "auth_required", fallback=False):
         return str(request.state.email)
     if request.client:
@@ -33,3 +38,75 @@ async def rate_limiter(
 ):
     if enable_rate_limit:
         await base_limiter(request, response)
+
+
+async def too_many_connections(websocket: WebSocket, pexpire: int):
+    raise WebSocketException(code=WS_1013_TRY_AGAIN_LATER, reason="Too Many Requests")
+
+
+base_websocket_limiter = WebSocketRateLimiter(
+    times=times,
+    seconds=seconds,
+    minutes=minutes,
+    hours=hours,
+    identifier=user,
+    callback=too_many_connections,
+)
+
+
+async def websocket_rate_limiter(websocket: WebSocket):
+    """Counts opening a WebSocket as a request."""
+    if enable_rate_limit:
+        await base_websocket_limiter(websocket)
+
+
+class TurnRateLimiter:
+    """Applies the rate limit to the turns a user takes over WebSockets, in process
+    rather than with a redis round-trip per turn. Every socket of a user in this
+    process shares one limiter, see `for_user`, but other processes don't see it."""
+
+    def __init__(self):
+        self._window = seconds + 60 * minutes + 3600 * hours
+        self._turns: Deque[float] = deque()
+
+    @classmethod
+    def for_user(cls, user_id: str) -> "TurnRateLimiter":
+        """The limiter shared by every socket of `user_id`. It's kept until its
+        window is empty, so that reconnecting doesn't reset it."""
+        global _last_sweep
+        now = time.monotonic()
+        if now - _last_sweep >= _SWEEP_SECONDS:
+            _last_sweep = now
+            for idle in [
+                u for u, limiter in _turn_limiters.items() if limiter._idle(now)
+            ]:
+                del _turn_limiters[idle]
+
+        if user_id not in _turn_limiters:
+            _turn_limiters[user_id] = cls()
+        return _turn_limiters[user_id]
+
+    def retry_after(self) -> float:
+        """How many seconds until another turn can be taken. If it's 0, the turn
+        counts towards the limit."""
+        if not enable_rate_limit:
+            return 0
+
+        now = time.monotonic()
+        while self._turns and self._turns[0] <= now - self._window:
+            self._turns.popleft()
+        if len(self._turns) >= times:
+            return self._turns[0] + self._window - now
+
+        self._turns.append(now)
+        return 0
+
+    def _idle(self, now: float) -> bool:
+        """Whether none of its turns count anymore."""
+        return not self._turns or self._turns[-1] <= now - self._window
+
+
+# How often idle limiters are dropped, so that users who left don't take up memory
+_SWEEP_SECONDS = 60.0
+_turn_limiters: Dict[str, TurnRateLimiter] = {}
+_last_sweep = 0.0
@@ -1,14 +1,21 @@
+import pickle
 import uuid
-from typing import Any
+from typing import Any, AsyncIterator, Dict, List, Union
 from unittest.mock import AsyncMock
 
 from game.agent import Conversation, GenAgent, Knowledge
+from game.memory import GenAgentMemory
 from game.prompt_helpers import (
     generate_functions_from_actions,
     get_action_messages,
+    get_batched_query_messages,
+    get_batched_rate_function,
     get_chat_messages,
     get_interact_messages,
 )
+from game.ti_retriever import TIRetriever
+from llm.fake import FakeLLM
+from llm.scheduler import LLMScheduler
 from schema import (
     Action,
     ActionCompletion,
@@ -16,8 +23,10 @@ from schema import (
     GameStage,
     Lore,
     Memory,
+    MemoryConfig,
     Message,
     Parameter,
+    PromptConfig,
 )
 from tests.helpers import AsyncCopyingMock
 
@@ -211,6 +220,52 @@ async def test_chat():
     )
 
 
+async def test_update_knowledge():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    llm.chat_completion.return_value = Message(role="assistant", content="Hm.")
+    memory.retrieve_relevant_memories.return_value = []
+    await agent.chat("Who are you?")
+
+    new_knowledge = knowledge.copy(deep=True)
+    new_knowledge.agent_def.name = "Queen"
+    agent.updateKnowledge(new_knowledge)
+    await agent.chat("Who are you now?")
+
+    llm.chat_completion.assert_called_with(
+        get_chat_messages(
+            new_knowledge,
+            Conversation(),
+            [],
+            [
+                Message(role="user", content="Who are you?"),
+                Message(role="assistant", content="Hm."),
+                Message(role="user", content="Who are you now?"),
+            ],
+        )
+    )
+
+    # The action functions follow the agent def too
+    llm.completion.return_value = Message(role="assistant", content="Hm.")
+    await agent.interact("Draw!")
+    assert llm.completion.call_args.args[1] == generate_functions_from_actions(
+        knowledge.agent_def.actions
+    )
+    new_knowledge = new_knowledge.copy(deep=True)
+    new_knowledge.agent_def.actions = new_knowledge.agent_def.actions[:1]
+    agent.updateKnowledge(new_knowledge)
+    await agent.interact("Draw!")
+    assert llm.completion.call_args.args[1] == generate_functions_from_actions(
+        new_knowledge.agent_def.actions[:1]
+    )
+
+
 async def test_act():
     memory: Any = AsyncMock()
     llm: Any = AsyncMock()
@@ -249,3 +304,202 @@ async def test_act():
     assert isinstance(resp, ActionCompletion)
     assert resp.action == "attack"
     assert resp.args["character"] == "Player"
+
+
+async def test_query_retrieves_once():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    agent_def = create_agent_def()
+    knowledge = Knowledge(
+        game_description="Game description", agent_def=agent_def, shared_lore=[]
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    agent.startConversation(Conversation(scene_description="Throne room"), [])
+
+    queries = ["How happy are you?", "How angry are you?", "How sad are you?"]
+    memory.retrieve_relevant_memories_grouped.return_value = [
+        [Memory(description=str(i))] for i in range(len(queries))
+    ]
+    llm.action_completion.return_value = ActionCompletion(
+        action="Rate", args={"rating": "Very."}
+    )
+
+    assert await agent.query(queries) == [5, 5, 5]
+
+    memory.retrieve_relevant_memories_grouped.assert_called_once()
+    query_groups = memory.retrieve_relevant_memories_grouped.call_args.args[0]
+    assert [[q.description for q in group] for group in query_groups] == [
+        [query, "Throne room"] for query in queries
+    ]
+    assert llm.action_completion.call_count == len(queries)
+
+
+async def test_batched_query():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(
+        knowledge, llm, memory, prompt_config=PromptConfig(batch_queries=True)
+    )
+
+    queries = ["How happy are you?", "How angry are you?", "How sad are you?"]
+    memory.retrieve_relevant_memories_grouped.return_value = [
+        [Memory(description="Shared"), Memory(description=str(i))]
+        for i in range(len(queries))
+    ]
+    llm.action_completion.return_value = ActionCompletion(
+        action="RateAll",
+        args={"rating_1": "Very.", "rating_2": "Not at all.", "rating_3": "Fairly."},
+    )
+
+    assert await agent.query(queries) == [5, 1, 4]
+    llm.action_completion.assert_called_once_with(
+        get_batched_query_messages(
+            knowledge,
+            Conversation(),
+            ["Shared", "0", "1", "2"],
+            [],
+            queries,
+        ),
+        [get_batched_rate_function(len(queries))],
+    )
+
+    # Asked one by one if the answer doesn't rate them all
+    llm.action_completion.reset_mock()
+    llm.action_completion.side_effect = [
+        ActionCompletion(action="RateAll", args={"rating_1": "Very."}),
+        ActionCompletion(action="Rate", args={"rating": "Very."}),
+        ActionCompletion(action="Rate", args={"rating": "Moderately."}),
+        ActionCompletion(action="Rate", args={"rating": "Not very."}),
+    ]
+    assert await agent.query(queries) == [5, 3, 2]
+    assert llm.action_completion.call_count == 1 + len(queries)
+
+
+async def test_chat_stream():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+    streamed_messages: List[List[Message]] = []
+
+    async def stream_chat_completion(messages: List[Message]) -> AsyncIterator[str]:
+        streamed_messages.append(list(messages))
+        for piece in ["Ki", "ng says: Not much", ", peasant!"]:
+            yield piece
+
+    llm.stream_chat_completion = stream_chat_completion
+
+    agent_def = create_agent_def()
+    knowledge = Knowledge(
+        game_description="Game description", agent_def=agent_def, shared_lore=[]
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    memories = [Memory(description="asdf")]
+    memory.retrieve_relevant_memories.return_value = memories
+
+    stream, messages = await agent.chat_stream("What's up?")
+    # The prefix is held back until it's known to be one.
+    assert [piece async for piece in stream] == [" Not much", ", peasant!"]
+    assert streamed_messages == [messages]
+
+    stream, messages = await agent.chat_stream("Wtf?")
+    async for _ in stream:
+        pass
+    assert messages == get_chat_messages(
+        knowledge,
+        Conversation(),
+        [memory.description for memory in memories],
+        [
+            Message(role="user", content="What's up?"),
+            Message(role="assistant", content=" Not much, peasant!"),
+            Message(role="user", content="Wtf?"),
+        ],
+    )
+
+
+async def test_interact_stream_action():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    async def stream_completion(
+        messages: List[Message], functions: List[Dict[str, str]]
+    ) -> AsyncIterator[Union[str, ActionCompletion]]:
+        yield ActionCompletion(action="attack", args={"character": "Player"})
+
+    llm.stream_completion = stream_completion
+
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    memory.retrieve_relevant_memories.return_value = []
+
+    stream, _ = await agent.interact_stream("I will kill you!")
+    assert [piece async for piece in stream] == [
+        ActionCompletion(action="attack", args={"character": "Player"})
+    ]
+
+    # Actions don't join the conversation history.
+    _, messages = await agent.interact_stream(None)
+    assert messages == get_interact_messages(
+        knowledge,
+        Conversation(),
+        [],
+        [Message(role="user", content="I will kill you!")],
+    )
+
+
+async def test_prefix_cache_layout():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(
+        knowledge, llm, memory, prompt_config=PromptConfig(layout="prefix_cache")
+    )
+    llm.chat_completion.return_value = Message(role="assistant", content="Hm.")
+
+    prompts: List[List[Message]] = []
+    for turn in range(3):
+        memory.retrieve_relevant_memories.return_value = [
+            Memory(description=f"Memory {turn}")
+        ]
+        await agent.chat(f"Question {turn}")
+        prompts.append(llm.chat_completion.call_args.args[0])
+
+    # All but the memories, the latest message and the prepend carry over
+    for prompt, next_prompt in zip(prompts, prompts[1:]):
+        stable = prompt[:-3]
+        assert next_prompt[: len(stable)] == stable
+        assert "Memory" in next_prompt[-3].content
+    assert "Memory" not in prompts[-1][0].content
+
+
+async def test_pickle_leaves_out_the_llm():
+    llm = LLMScheduler(FakeLLM(embedding_size=8))
+    memory = GenAgentMemory(llm, 5, TIRetriever(MemoryConfig(embedding_dims=8)))
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+
+    # Like dev mode does with sessions when the server restarts
+    restored: GenAgent = pickle.loads(pickle.dumps(agent))
+    restored.attach_llm(llm)
+    await restored.chat("Hello")
+    await restored.add_memory(Memory(description="Someone said hello"))
+
+    # Calls go through the server's scheduler, rather than a copy of it
+    assert llm.stats()["llm_calls_interactive"] == 1
+    assert llm.stats()["llm_calls_background"] == 1
@@ -0,0 +1,90 @@
+import os
+import time
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pytest
+
+from game.prompt_helpers import get_rate_function
+from llm.cassette import Cassette, CassetteMiss, RecordingLLM, ReplayLLM
+from llm.fake import FakeLLM
+from schema import ActionCompletion, Message
+
+MESSAGES = [Message(role="user", content="Who did it?")]
+
+
+async def stream(
+    llm: Union[RecordingLLM, ReplayLLM],
+) -> List[Union[str, ActionCompletion]]:
+    return [piece async for piece in llm.stream_completion(MESSAGES, [])]
+
+
+async def test_record_and_replay(tmp_path: str):
+    recorder = RecordingLLM(FakeLLM(embedding_size=8, latency=0.05))
+    rate_function = get_rate_function()
+
+    chat = await recorder.chat_completion(MESSAGES)
+    action = await recorder.action_completion(MESSAGES, [rate_function])
+    pieces = await stream(recorder)
+    digits = await recorder.digit_completions([MESSAGES, MESSAGES[:0]])
+    embeddings = await recorder.embed_batch(["a clue", "a suspect"])
+
+    path = os.path.join(tmp_path, "cassette.jsonl.gz")
+    recorder.cassette.save(path)
+    cassette = Cassette.load(path)
+    assert len(cassette) == len(recorder.cassette)
+    assert cassette.embedding_size == 8
+
+    replay = ReplayLLM(cassette)
+    start_time = time.monotonic()
+    assert await replay.chat_completion(MESSAGES) == chat
+    assert await replay.action_completion(MESSAGES, [rate_function]) == action
+    assert await stream(replay) == pieces
+    # Recorded as a batch, replayed one at a time
+    assert await replay.digit_completions([MESSAGES[:0]]) == digits[1:]
+    assert np.allclose(await replay.embed("a suspect"), embeddings[1], atol=1e-6)
+    assert time.monotonic() - start_time < 0.05
+    assert replay.stats()["cassette_hits"] == 5
+
+
+async def test_realtime():
+    recorder = RecordingLLM(FakeLLM(latency=0.05))
+    await recorder.chat_completion(MESSAGES)
+
+    replay = ReplayLLM(recorder.cassette, realtime=True)
+    start_time = time.monotonic()
+    await replay.chat_completion(MESSAGES)
+    assert time.monotonic() - start_time >= 0.04
+
+
+async def test_miss():
+    cassette = Cassette(embedding_size=8, embedding_model="fake")
+
+    with pytest.raises(CassetteMiss):
+        await ReplayLLM(cassette).chat_completion(MESSAGES)
+
+    replay = ReplayLLM(cassette, fallback=FakeLLM(embedding_size=8))
+    assert len(await replay.embed("not recorded")) == 8
+    assert replay.stats()["cassette_misses"] == 1
+
+    with pytest.raises(CassetteMiss):
+        await stream(ReplayLLM(cassette))
+
+
+async def test_records_the_request_as_sent():
+    class RetryingLLM(FakeLLM):
+        """Asks again, like OpenAIInterface does when there's no function call."""
+
+        async def action_completion(
+            self, messages: List[Message], functions: List[Dict[str, str]]
+        ) -> Optional[ActionCompletion]:
+            messages.append(Message(role="system", content="Please call a function."))
+            return await super().action_completion(messages, functions)
+
+    recorder = RecordingLLM(RetryingLLM())
+    action = await recorder.action_completion(list(MESSAGES), [get_rate_function()])
+
+    replay = ReplayLLM(recorder.cassette)
+    assert await replay.action_completion(list(MESSAGES), [get_rate_function()]) == (
+        action
+    )
@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, List, Tuple
+
+import openai
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from llm.embed_coalescer import EmbedCoalescer
+from llm.openai import OpenAIInterface
+
+
+@asynccontextmanager
+async def fake_openai() -> AsyncGenerator[Tuple[OpenAIInterface, List[Any]], None]:
+    """An OpenAIInterface talking to a local server that embeds text as its length,
+    and the inputs of every embeddings request the server received."""
+    requests: List[Any] = []
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        requests.append(body["input"])
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # Out of order, since clients should go by index.
+        data = [
+            dict(object="embedding", index=i, embedding=[float(len(text)), 1.0])
+            for i, text in reversed(list(enumerate(inputs)))
+        ]
+        return web.json_response(dict(object="list", data=data, model="fake"))
+
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", embeddings)
+
+    api_base = openai.api_base
+    async with TestServer(app) as server, ClientSession() as session:
+        yield (
+            OpenAIInterface(
+                api_key="fake",
+                api_base=str(server.make_url("/v1")),
+                client_session=session,
+            ),
+            requests,
+        )
+    openai.api_base = api_base
+
+
+async def test_concurrent_embeds_are_batched():
+    async with fake_openai() as (llm, requests):
+        coalescer = EmbedCoalescer(llm, window_seconds=0.05)
+
+        texts = ["a", "bb", "a", "cccc"]
+        embeddings = await asyncio.gather(*[coalescer.embed(text) for text in texts])
+
+    assert embeddings == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [4.0, 1.0]]
+    assert requests == [["a", "bb", "cccc"]]
+    stats = coalescer.stats()
+    assert stats["embed_batches"] == 1
+    assert stats["embed_batched_queries"] == 3
+
+
+async def test_max_batch_size():
+    async with fake_openai() as (llm, requests):
+        coalescer = EmbedCoalescer(llm, window_seconds=10, max_batch_size=2)
+
+        # A full batch is sent without waiting for the window.
+        texts = ["a", "bb", "ccc", "d"]
+        embeddings = await asyncio.wait_for(
+            asyncio.gather(*[coalescer.embed(text) for text in texts]), timeout=5
+        )
+
+    assert [e[0] for e in embeddings] == [1.0, 2.0, 3.0, 1.0]
+    assert requests == [["a", "bb"], ["ccc", "d"]]
+
+
+async def test_errors_only_reach_their_callers():
+    class FailingLLM(OpenAIInterface):
+        async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+            raise ValueError("no")
+
+        async def embed(self, query: str) -> List[float]:
+            if query == "bad":
+                raise ValueError("no")
+            return [1.0]
+
+    coalescer = EmbedCoalescer(FailingLLM(api_key="fake"))
+
+    results = await asyncio.gather(
+        coalescer.embed("a"),
+        coalescer.embed("bad"),
+        coalescer.embed("bad"),
+        return_exceptions=True,
+    )
+    assert results[0] == [1.0]
+    assert all(isinstance(result, ValueError) for result in results[1:])
+
+    with pytest.raises(ValueError):
+        await coalescer.embed("bad")
+
+
+async def test_cancelled_batch_cancels_callers():
+    class SlowLLM(OpenAIInterface):
+        async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+            await asyncio.sleep(10)
+            return []
+
+    coalescer = EmbedCoalescer(SlowLLM(api_key="fake"), window_seconds=0)
+    caller = asyncio.ensure_future(coalescer.embed("a"))
+    await asyncio.sleep(0.01)
+
+    for send in list(coalescer._sends):  # type: ignore
+        send.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(caller, timeout=1)
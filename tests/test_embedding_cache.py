@@ -0,0 +1,78 @@
+from typing import Any, Dict, List
+from unittest.mock import AsyncMock
+
+import numpy as np
+from fakeredis import aioredis
+
+from llm.embedding_cache import EmbeddingCache
+
+
+def fake_embed(query: str) -> List[float]:
+    return [float(len(query)), 0.5]
+
+
+def no_stats() -> Dict[str, int]:
+    return {}
+
+
+def create_llm() -> Any:
+    llm: Any = AsyncMock()
+    llm.embedding_model = "model"
+    llm.stats = no_stats
+    llm.embed.side_effect = fake_embed
+    return llm
+
+
+async def test_lru():
+    llm = create_llm()
+    cache = EmbeddingCache(llm, max_entries=2)
+
+    assert await cache.embed("a") == [1.0, 0.5]
+    assert await cache.embed("a") == [1.0, 0.5]
+    await cache.embed("bb")
+    await cache.embed("a")
+    # Evicts "bb", which is the least recently used.
+    await cache.embed("ccc")
+    await cache.embed("a")
+    assert llm.embed.call_count == 3
+
+    await cache.embed("bb")
+    assert llm.embed.call_count == 4
+    assert cache.stats() == {
+        "embedding_cache_hits": 3,
+        "embedding_cache_redis_hits": 0,
+        "embedding_cache_misses": 4,
+    }
+
+
+async def test_redis_tier():
+    redis: Any = aioredis.FakeRedis()
+    llm = create_llm()
+
+    await EmbeddingCache(llm, redis=redis).embed("a")
+
+    # A new process shares nothing but redis.
+    cache = EmbeddingCache(llm, redis=redis)
+    embedding = await cache.embed("a")
+    np.testing.assert_allclose(embedding, [1.0, 0.5])
+    assert llm.embed.call_count == 1
+    assert cache.stats()["embedding_cache_redis_hits"] == 1
+
+    # Different models don't share embeddings.
+    llm.embedding_model = "other model"
+    await cache.embed("a")
+    assert llm.embed.call_count == 2
+
+
+async def test_paths_return_the_same_values():
+    redis: Any = aioredis.FakeRedis()
+    llm = create_llm()
+    llm.embed.side_effect = None
+    llm.embed.return_value = [0.1, 1 / 3]
+
+    cache = EmbeddingCache(llm, redis=redis)
+    missed = await cache.embed("a")
+    hit = await cache.embed("a")
+    redis_hit = await EmbeddingCache(llm, redis=redis).embed("a")
+    assert missed == hit == redis_hit
+    assert isinstance(hit[0], float)
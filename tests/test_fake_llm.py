@@ -0,0 +1,53 @@
+import time
+
+import numpy as np
+
+from game.prompt_helpers import get_rate_function, rating_to_int
+from llm.fake import FakeLLM
+from llm.retry import RetryPolicy
+from schema import ActionCompletion, Message
+
+
+async def test_embeddings():
+    llm = FakeLLM(embedding_size=64)
+
+    embedding = await llm.embed("The cat sat on the mat")
+    assert len(embedding) == 64
+    assert embedding == await FakeLLM(embedding_size=64).embed("The cat sat on the mat")
+
+    similar, different = await llm.embed_batch(["The cat sat", "Quantum physics"])
+    assert np.dot(embedding, similar) > np.dot(embedding, different)
+
+
+async def test_function_call():
+    llm = FakeLLM()
+    rate_function = get_rate_function()
+
+    completion = await llm.action_completion(
+        [Message(role="user", content="How much do you like me?")], [rate_function]
+    )
+    assert isinstance(completion, ActionCompletion)
+    assert completion.action == "Rate"
+    assert 1 <= rating_to_int(completion) <= 5
+
+
+async def test_errors_are_retried():
+    llm = FakeLLM(
+        error_rate=0.5, retry_policy=RetryPolicy(max_attempts=20, base_delay=0.001)
+    )
+
+    for _ in range(10):
+        await llm.chat_completion([Message(role="user", content="Hello")])
+    assert llm.stats()["llm_retries"] > 0
+
+
+async def test_latency():
+    llm = FakeLLM(latency=0.02, latency_distribution="lognormal")
+
+    start = time.monotonic()
+    digits = await llm.digit_completions(
+        [[Message(role="user", content=str(i))] for i in range(10)]
+    )
+    # The requests are concurrent, so this is closer to the slowest than the sum.
+    assert 0.01 < time.monotonic() - start < 1
+    assert all(0 <= digit <= 9 for digit in digits)
@@ -0,0 +1,112 @@
+import asyncio
+from typing import Any, List, Optional
+from unittest.mock import AsyncMock
+
+from game.history import ConversationHistory
+from schema import HistoryConfig, Message
+
+
+def summarize_messages(summary: Optional[str], history: List[Message]) -> List[Message]:
+    return [Message(role="system", content="Summarize")] + history
+
+
+def format_message(message: Message) -> Message:
+    return Message(role=message.role, content=f"Player says: {message.content}")
+
+
+def messages(count: int) -> List[Message]:
+    # 10 tokens each
+    return [Message(role="user", content=f"{i:040}") for i in range(count)]
+
+
+async def test_window():
+    llm: Any = AsyncMock()
+    history = ConversationHistory(
+        llm,
+        HistoryConfig(max_tokens=35, recent_messages=2, summarize=False),
+        summarize_messages,
+        format_message,
+    )
+
+    for message in messages(10):
+        history.append(message)
+    assert history.window() == messages(10)[-3:]
+
+    # The recent messages are sent however long they are
+    history.append(Message(role="user", content="x" * 400))
+    assert history.window() == [messages(10)[-1], history.messages[-1]]
+    llm.chat_completion.assert_not_called()
+
+
+async def test_summarize():
+    llm: Any = AsyncMock()
+    llm.chat_completion.return_value = Message(role="assistant", content="Earlier")
+    history = ConversationHistory(
+        llm,
+        HistoryConfig(max_tokens=35, recent_messages=2),
+        summarize_messages,
+        format_message,
+    )
+
+    for message in messages(4):
+        history.append(message)
+    # The window doesn't wait for the summary
+    assert history.window() == messages(4)[-3:]
+
+    await asyncio.sleep(0)
+    llm.chat_completion.assert_called_once_with(
+        summarize_messages(None, messages(4)[:2])
+    )
+    assert history.summary == "Earlier"
+    assert history.messages == messages(4)[2:]
+    window = history.window()
+    assert window[0].role == "system" and "Earlier" in window[0].content
+    assert window[1:] == messages(4)[2:]
+
+
+async def test_reset_cancels_summary():
+    llm: Any = AsyncMock()
+    summarized = asyncio.Event()
+
+    async def never_summarize(messages: List[Message]) -> Message:
+        await summarized.wait()
+        return Message(role="assistant", content="Stale")
+
+    llm.chat_completion.side_effect = never_summarize
+    history = ConversationHistory(
+        llm,
+        HistoryConfig(max_tokens=35, recent_messages=2),
+        summarize_messages,
+        format_message,
+    )
+
+    for message in messages(4):
+        history.append(message)
+    await asyncio.sleep(0)
+    history.reset([])
+    summarized.set()
+    await asyncio.sleep(0)
+
+    assert history.summary is None
+    assert history.window() == []
+
+
+async def test_formatting_is_incremental():
+    formatted: List[Message] = []
+
+    def counting_format_message(message: Message) -> Message:
+        formatted.append(message)
+        return format_message(message)
+
+    history = ConversationHistory(
+        AsyncMock(), HistoryConfig(), summarize_messages, counting_format_message
+    )
+    for message in messages(3):
+        history.append(message)
+        history.formatted_window()
+    assert formatted == messages(3)
+    assert history.formatted_window() == [format_message(m) for m in messages(3)]
+
+    history.invalidate_formatting()
+    history.formatted_window()
+    assert formatted == messages(3) * 2
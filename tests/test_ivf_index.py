@@ -0,0 +1,61 @@
+from typing import Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from game.ivf_index import IVFIndex
+
+
+def _clustered(num_rows: int, num_clusters: int, dims: int) -> NDArray[np.float32]:
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((num_clusters, dims))
+    rows = centers[rng.choice(num_clusters, num_rows)]
+    rows += 0.1 * rng.standard_normal((num_rows, dims))
+    return (rows / np.linalg.norm(rows, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_untrained_returns_every_row():
+    index = IVFIndex(num_lists=4, num_probes=1, train_size=100)
+    embeddings = _clustered(50, 4, 8)
+    for row, embedding in enumerate(embeddings):
+        index.add(row, embedding)
+
+    assert not index.trained
+    assert list(index.candidates(embeddings[:1].T, 50)) == list(range(50))
+
+
+def test_trains_and_probes_nearest_lists():
+    index = IVFIndex(num_lists=8, num_probes=1, train_size=400)
+    embeddings = _clustered(1000, 8, 16)
+
+    def rows(selected: Union[slice, NDArray[np.intp]]) -> NDArray[np.float32]:
+        return embeddings[selected]
+
+    for row, embedding in enumerate(embeddings):
+        index.add(row, embedding)
+        if index.needs_training(row + 1):
+            index.train(row + 1, rows)
+
+    assert index.trained
+    # Trained at 400 rows, then retrained at 800
+    assert not index.needs_training(1000)
+
+    for row in (0, 500, 999):
+        candidates = index.candidates(embeddings[row : row + 1].T, 1000)
+        assert row in candidates
+        # One probe out of 8 well separated clusters
+        assert len(candidates) < 300
+
+
+def test_compact():
+    index = IVFIndex(num_lists=2, num_probes=1, train_size=4)
+    embeddings = np.array([[1, 0], [0, 1], [1, 0.1], [0.1, 1]], dtype=np.float32)
+    for row, embedding in enumerate(embeddings):
+        index.add(row, embedding)
+    index.train(4, lambda selected: embeddings[selected])
+
+    index.compact(np.array([1, 2]))
+    x_query = np.array([[1.0], [0.0]], dtype=np.float32)
+    assert list(index.candidates(x_query, 2)) == [1]
+    # Only the kept rows are counted
+    assert sorted(index._list_sizes) == [1, 1]  # type: ignore
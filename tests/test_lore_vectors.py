@@ -0,0 +1,86 @@
+from typing import Any
+from unittest.mock import AsyncMock
+
+import numpy as np
+
+from game.lore_vectors import LoreVectors
+from llm.fake import FakeLLM
+from schema import AgentDef, GameDef, Lore, Memory
+
+
+def create_llm() -> Any:
+    fake = FakeLLM(embedding_size=8)
+    llm: Any = AsyncMock()
+    llm.embedding_model = fake.embedding_model
+    llm.embed_batch.side_effect = fake.embed_batch
+    llm.digit_completions.side_effect = fake.digit_completions
+    return llm
+
+
+def create_game_def() -> GameDef:
+    king = AgentDef(
+        name="King",
+        personal_lore=[
+            Memory(description="The crown is fake"),
+            Memory(description="The queen is away", importance=7),
+        ],
+    )
+    return GameDef(
+        name="King Game",
+        agents=[king],
+        shared_lore=[Lore(memory=Memory(description="The queen is away"))],
+    )
+
+
+async def test_compute_and_apply():
+    llm = create_llm()
+    vectors = await LoreVectors.compute(llm, create_game_def())
+    assert len(vectors) == 2
+    # Every text is embedded and rated once
+    assert len(llm.embed_batch.call_args.args[0]) == 2
+    assert len(llm.digit_completions.call_args.args[0]) == 2
+
+    game_def = create_game_def()
+    LoreVectors.from_bytes(vectors.to_bytes()).apply_to_game(game_def)
+    shared = game_def.shared_lore[0].memory
+    crown, queen = game_def.agents[0].personal_lore
+    assert 1 <= crown.importance <= 10 and 1 <= shared.importance <= 10
+    # Importance given in the game def is kept
+    assert queen.importance == 7
+    assert crown.embedding and queen.embedding == shared.embedding
+    np.testing.assert_allclose(
+        crown.embedding, await FakeLLM(embedding_size=8).embed("The crown is fake")
+    )
+
+
+async def test_compute_reuses_previous():
+    llm = create_llm()
+    previous = await LoreVectors.compute(llm, create_game_def())
+
+    game_def = create_game_def()
+    game_def.shared_lore.append(Lore(memory=Memory(description="A dragon is near")))
+    game_def.agents[0].personal_lore.pop(0)
+    llm.reset_mock()
+    vectors = await LoreVectors.compute(llm, game_def, previous)
+
+    llm.embed_batch.assert_called_once_with(["A dragon is near"])
+    assert len(llm.digit_completions.call_args.args[0]) == 1
+    # The crown isn't lore anymore
+    assert len(vectors) == 2
+
+
+async def test_failed_ratings_arent_kept():
+    llm = create_llm()
+    llm.digit_completions.side_effect = None
+    llm.digit_completions.return_value = [-1, -1]
+    vectors = await LoreVectors.compute(llm, create_game_def())
+
+    game_def = create_game_def()
+    vectors.apply_to_game(game_def)
+    assert game_def.agents[0].personal_lore[0].importance == 0
+
+    # They're rated again
+    llm.digit_completions.return_value = [4, 4]
+    vectors = await LoreVectors.compute(llm, create_game_def(), vectors)
+    vectors.apply_to_game(game_def)
+    assert game_def.agents[0].personal_lore[0].importance == 5
@@ -1,13 +1,16 @@
 import unittest
+import uuid
 from typing import Any, List
 from unittest.mock import AsyncMock, Mock
 
-from game.memory import GenAgentMemory
-from schema import GameStage, Memory
+from game.memory import GenAgentMemory, lore_visibility
+from game.ti_retriever import TIRetriever
+from schema import GameStage, Lore, Memory, MemoryConfig
 
 
 async def test_add_uses_llm():
     retriever: Any = Mock()
+    retriever.train_index_in_thread = AsyncMock()
     llm: Any = AsyncMock()
 
     gen_agent_memory = GenAgentMemory(llm, 5, retriever)
@@ -29,11 +32,13 @@ async def test_add_uses_llm():
     rated_memory.importance = 9
     rated_memory.embedding = fake_embed
 
-    retriever.add_memory.assert_called_once_with(rated_memory)
+    retriever.add_memory.assert_called_once_with(rated_memory, train_index=False)
+    retriever.train_index_in_thread.assert_awaited_once()
 
 
 async def test_add_doesnt_overwrite():
     retriever: Any = Mock()
+    retriever.train_index_in_thread = AsyncMock()
     llm: Any = AsyncMock()
 
     gen_agent_memory = GenAgentMemory(llm, 5, retriever)
@@ -51,7 +56,7 @@ async def test_add_doesnt_overwrite():
     llm.embed.return_value = fake_embed
 
     await gen_agent_memory.add_memory(simple_memory)
-    retriever.add_memory.assert_called_once_with(simple_memory)
+    retriever.add_memory.assert_called_once_with(simple_memory, train_index=False)
 
 
 async def test_retrieve():
@@ -70,59 +75,104 @@ async def test_retrieve():
     fake_embed = [1.0, 2.0]
     llm.embed.return_value = fake_embed
 
-    retriever.get_relevant_memories.return_value = [(query_memory, 0.04)]
+    retriever.get_relevant_memories_grouped.return_value = [[(query_memory, 0.04)]]
 
     await gen_agent_memory.retrieve_relevant_memories([query_memory.copy()], 5)
 
     llm.embed.assert_called_once_with(query_memory.description)
     embedded_query_memory = query_memory.copy()
     embedded_query_memory.embedding = fake_embed
-    retriever.get_relevant_memories.assert_called_once_with(embedded_query_memory, 5)
+    retriever.get_relevant_memories_grouped.assert_called_once_with(
+        [[embedded_query_memory]], 5
+    )
 
     # Should not call LLM when query memory is embedded.
     await gen_agent_memory.retrieve_relevant_memories([embedded_query_memory], 5)
     assert llm.embed.call_count == 1
-    assert retriever.get_relevant_memories.call_count == 2
+    assert retriever.get_relevant_memories_grouped.call_count == 2
 
 
 async def test_multi_query_retrieve():
     TOP_K = 3
     # Test that it blends in the queries and gets max of each
-    retriever: Any = Mock()
+    retriever = TIRetriever(MemoryConfig(embedding_dims=2))
     llm: Any = AsyncMock()
 
     gen_agent_memory = GenAgentMemory(llm, 5, retriever)
 
     memories: List[Memory] = []
+    # Memories 0, 2 and 4 are the closest to one of the queries
+    for i, embedding in enumerate(
+        [[1.0, 1.0], [0.5, 0.0], [2.0, 0.0], [0.0, 0.5], [0.0, 2.0]]
+    ):
+        memories.append(Memory(importance=1, description=str(i), embedding=embedding))
+        retriever.add_memory(memories[i])
 
-    query_memory1 = Memory(
-        importance=0,
-        description="I was coronated as King!",
-        timestamp=GameStage(stage=1, major=2, minor=3),
-        embedding=[],
+    query_memory1 = Memory(description="I was coronated as King!", embedding=[1, 0])
+    query_memory2 = Memory(description="blah", embedding=[0, 1])
+
+    relevant_memories = await gen_agent_memory.retrieve_relevant_memories(
+        [query_memory1, query_memory2], TOP_K
     )
+    unittest.TestCase().assertCountEqual(
+        relevant_memories, [memories[0], memories[2], memories[4]]
+    )
+    llm.embed.assert_not_called()
 
-    for i in range(5):
-        memories.append(query_memory1.copy())
-        memories[i].description = str(i)
 
-    query_memory2 = query_memory1.copy()
-    query_memory2.description = "blah"
+async def test_grouped_retrieve_embeds_once():
+    retriever = TIRetriever(MemoryConfig(embedding_dims=2))
+    llm: Any = AsyncMock()
+    llm.embed.return_value = [1.0, 0.0]
 
-    fake_embed = [1.0, 2.0]
-    llm.embed.return_value = fake_embed
+    gen_agent_memory = GenAgentMemory(llm, 5, retriever)
+    retriever.add_memory(Memory(importance=1, description="x", embedding=[1, 0]))
+
+    shared_query = Memory(description="shared")
+    groups = await gen_agent_memory.retrieve_relevant_memories_grouped(
+        [[Memory(description="a"), shared_query], [shared_query], []], 5
+    )
 
-    def side_effect(*args):  # type: ignore
-        # memories 0, 2, 4 should be returned since they have val 3
-        if args == (query_memory1, TOP_K):
-            return [(memories[0], 1), (memories[1], 2), (memories[2], 3)]
-        return [(memories[0], 3), (memories[3], 2), (memories[4], 3)]
+    assert llm.embed.call_count == 2
+    assert [[m.description for m in group] for group in groups] == [["x"], ["x"], []]
+
+
+async def test_shared_retrieve():
+    agent = uuid.uuid4()
+    other_agent = uuid.uuid4()
+    llm: Any = AsyncMock()
 
-    retriever.get_relevant_memories = side_effect
+    shared_lore = [
+        Lore(
+            memory=Memory(importance=1, description="known", embedding=[1, 0]),
+            known_by={agent, other_agent},
+        ),
+        Lore(
+            memory=Memory(importance=9, description="unknown", embedding=[1, 0]),
+            known_by={other_agent},
+        ),
+    ]
+    shared_retriever = TIRetriever(MemoryConfig(embedding_dims=2, max_memories=2))
+    for lore in shared_lore:
+        shared_retriever.add_memory(lore.memory)
+
+    gen_agent_memory = GenAgentMemory(
+        llm,
+        5,
+        TIRetriever(MemoryConfig(embedding_dims=2)),
+        shared_retriever=shared_retriever,
+        shared_visibility=lore_visibility(shared_lore, agent),
+    )
+    await gen_agent_memory.add_memory(
+        Memory(importance=5, description="private", embedding=[1, 0])
+    )
 
     relevant_memories = await gen_agent_memory.retrieve_relevant_memories(
-        [query_memory1, query_memory2], TOP_K
+        [Memory(description="query", embedding=[1, 0])], 5
     )
-    unittest.TestCase().assertCountEqual(
-        relevant_memories, [memories[0], memories[2], memories[4]]
+    assert [m.description for m in relevant_memories] == ["private", "known"]
+
+    relevant_memories = await gen_agent_memory.retrieve_relevant_memories(
+        [Memory(description="query", embedding=[1, 0])], 1
     )
+    assert [m.description for m in relevant_memories] == ["private"]
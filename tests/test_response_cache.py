@@ -0,0 +1,116 @@
+import asyncio
+from typing import Any, Dict, List
+from unittest.mock import AsyncMock
+
+from fakeredis import aioredis
+
+from llm.call_context import CallKind, call_kind
+from llm.response_cache import ResponseCache
+from schema import ActionCompletion, Message
+
+FUNCTIONS = [{"name": "Rate"}]
+
+
+def no_stats() -> Dict[str, int]:
+    return {}
+
+
+def fake_digits(query_messages: List[List[Message]]) -> List[int]:
+    return [len(messages[0].content) % 10 for messages in query_messages]
+
+
+def create_llm() -> Any:
+    llm: Any = AsyncMock()
+    llm.completion_model = "model"
+    llm.stats = no_stats
+    llm.action_completion.return_value = ActionCompletion(
+        action="Rate", args={"rating": "Very."}
+    )
+    llm.digit_completions.side_effect = fake_digits
+    return llm
+
+
+def prompt(content: str) -> List[Message]:
+    return [Message(role="user", content=content)]
+
+
+async def test_cached_kinds():
+    llm = create_llm()
+    cache = ResponseCache(llm)
+
+    with call_kind(CallKind.GUARDRAIL):
+        first = await cache.action_completion(prompt("Hello there"), FUNCTIONS)
+        # Whitespace doesn't matter
+        second = await cache.action_completion(prompt(" Hello\n there "), FUNCTIONS)
+    assert first == second
+    assert llm.action_completion.call_count == 1
+
+    # Neither do the queries of other calls
+    with call_kind(CallKind.QUERY):
+        await cache.action_completion(prompt("Hello there"), FUNCTIONS)
+    assert llm.action_completion.call_count == 2
+
+    with call_kind(CallKind.IMPORTANCE):
+        assert await cache.digit_completions([prompt("a"), prompt("bb")]) == [1, 2]
+        assert await cache.digit_completions([prompt("bb"), prompt("ccc")]) == [2, 3]
+    # Only the miss is sent the second time
+    llm.digit_completions.assert_called_with([prompt("ccc")])
+
+    stats = cache.stats()
+    assert stats["response_cache_guardrail_hits"] == 1
+    assert stats["response_cache_guardrail_misses"] == 1
+    assert stats["response_cache_importance_hits"] == 1
+    assert stats["response_cache_importance_misses"] == 3
+
+
+async def test_failures_arent_cached():
+    llm = create_llm()
+    llm.action_completion.return_value = None
+    llm.digit_completions.side_effect = None
+    llm.digit_completions.return_value = [-1]
+    cache = ResponseCache(llm)
+
+    with call_kind(CallKind.RATE):
+        for _ in range(2):
+            assert await cache.action_completion(prompt("a"), FUNCTIONS) is None
+            assert await cache.digit_completions([prompt("a")]) == [-1]
+    assert llm.action_completion.call_count == 2
+    assert llm.digit_completions.call_count == 2
+
+
+async def test_ttl_and_size():
+    llm = create_llm()
+    cache = ResponseCache(llm, max_entries=1, ttl=0.05)
+
+    with call_kind(CallKind.RATE):
+        await cache.action_completion(prompt("a"), FUNCTIONS)
+        await cache.action_completion(prompt("a"), FUNCTIONS)
+        assert llm.action_completion.call_count == 1
+
+        await asyncio.sleep(0.05)
+        await cache.action_completion(prompt("a"), FUNCTIONS)
+        assert llm.action_completion.call_count == 2
+
+        # Evicts "a"
+        await cache.action_completion(prompt("b"), FUNCTIONS)
+        await cache.action_completion(prompt("a"), FUNCTIONS)
+        assert llm.action_completion.call_count == 4
+
+
+async def test_redis_tier():
+    redis: Any = aioredis.FakeRedis()
+    llm = create_llm()
+
+    with call_kind(CallKind.RATE):
+        await ResponseCache(llm, redis=redis).action_completion(prompt("a"), FUNCTIONS)
+
+        # A new process shares nothing but redis.
+        cache = ResponseCache(llm, redis=redis)
+        completion = await cache.action_completion(prompt("a"), FUNCTIONS)
+        assert completion == llm.action_completion.return_value
+        assert llm.action_completion.call_count == 1
+
+        # Different models don't share responses.
+        llm.completion_model = "other model"
+        await cache.action_completion(prompt("a"), FUNCTIONS)
+        assert llm.action_completion.call_count == 2
@@ -0,0 +1,111 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+
+from llm.retry import DeadlineExceeded, RetryPolicy
+
+
+class Transient(Exception):
+    pass
+
+
+def retry_transient(error: BaseException) -> Optional[float]:
+    return 0 if isinstance(error, Transient) else None
+
+
+async def test_retries_transient_errors():
+    policy = RetryPolicy(base_delay=0.001)
+    attempts: List[int] = []
+
+    async def request() -> str:
+        attempts.append(len(attempts))
+        if len(attempts) < 3:
+            raise Transient()
+        return "ok"
+
+    assert await policy.run("op", request, retry_transient) == "ok"
+    assert len(attempts) == 3
+    assert policy.stats()["llm_retries"] == 2
+
+
+async def test_gives_up():
+    policy = RetryPolicy(max_attempts=2, base_delay=0.001)
+    attempts: List[int] = []
+
+    async def transient() -> str:
+        attempts.append(0)
+        raise Transient()
+
+    with pytest.raises(Transient):
+        await policy.run("op", transient, retry_transient)
+    assert len(attempts) == 2
+
+    async def fatal() -> str:
+        attempts.append(0)
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await policy.run("op", fatal, retry_transient)
+    assert len(attempts) == 3
+
+
+async def test_deadline():
+    policy = RetryPolicy(deadline=0.05)
+
+    async def slow() -> str:
+        await asyncio.sleep(10)
+        return "ok"
+
+    with pytest.raises(DeadlineExceeded):
+        await policy.run("op", slow, retry_transient)
+
+    async def retry_later() -> str:
+        raise Transient()
+
+    # Retry-After is past the deadline, so the error is raised straight away.
+    with pytest.raises(Transient):
+        await asyncio.wait_for(policy.run("op", retry_later, lambda e: 10), timeout=1)
+
+
+async def test_request_timeouts():
+    policy = RetryPolicy(base_delay=0.001)
+    attempts: List[int] = []
+
+    async def times_out() -> str:
+        attempts.append(0)
+        raise asyncio.TimeoutError()
+
+    # Well before the deadline, it's the request's own timeout, not the deadline.
+    with pytest.raises(asyncio.TimeoutError) as error:
+        await policy.run("op", times_out, retry_transient)
+    assert not isinstance(error.value, DeadlineExceeded)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await policy.run("op", times_out, lambda e: 0)
+    assert len(attempts) == 1 + 4
+
+
+async def test_hedging():
+    policy = RetryPolicy(hedge=True, hedge_min_samples=5)
+    delays = [0.0] * 5 + [10.0, 0.0]
+    cancelled: List[int] = []
+
+    async def request() -> float:
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(0)
+            raise
+        return delay
+
+    for _ in range(5):
+        await policy.run("op", request, retry_transient)
+
+    # The slow request is raced by a fast one, and then cancelled.
+    assert await asyncio.wait_for(policy.run("op", request, retry_transient), 1) == 0
+    assert cancelled == [0]
+    stats = policy.stats()
+    assert stats["llm_hedges"] == 1
+    assert stats["llm_hedge_wins"] == 1
@@ -0,0 +1,189 @@
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from llm.call_context import CallKind, call_kind
+from llm.retry import RetryPolicy
+from llm.scheduler import LLMScheduler
+from schema import Message
+
+
+def create_llm(started: List[str], release: asyncio.Event) -> Any:
+    class FakeLLM:
+        def stats(self) -> Dict[str, int]:
+            return {}
+
+        async def chat_completion(self, messages: List[Message]) -> Message:
+            started.append(messages[0].content)
+            await release.wait()
+            return messages[0]
+
+    return FakeLLM()
+
+
+async def test_priorities():
+    started: List[str] = []
+    release = asyncio.Event()
+    scheduler = LLMScheduler(create_llm(started, release), max_concurrency=1)
+
+    async def call(content: str, kind: CallKind) -> Message:
+        with call_kind(kind):
+            return await scheduler.chat_completion(
+                [Message(role="user", content=content)]
+            )
+
+    calls = [asyncio.create_task(call("first", CallKind.IMPORTANCE))]
+    await asyncio.sleep(0)
+    for content, kind in [
+        ("query", CallKind.QUERY),
+        ("act", CallKind.ACT),
+        ("chat", CallKind.CHAT),
+    ]:
+        calls.append(asyncio.create_task(call(content, kind)))
+    await asyncio.sleep(0)
+
+    assert started == ["first"]
+    stats = scheduler.stats()
+    assert stats["llm_in_flight"] == 1
+    assert stats["llm_queue_depth"] == 3
+
+    release.set()
+    await asyncio.gather(*calls)
+    assert started == ["first", "chat", "act", "query"]
+
+    stats = scheduler.stats()
+    assert stats["llm_queue_depth"] == 0
+    assert stats["llm_calls_interactive"] == 1
+    assert stats["llm_calls_action"] == 1
+    assert stats["llm_calls_background"] == 2
+
+
+async def test_token_budget():
+    started: List[str] = []
+    release = asyncio.Event()
+    release.set()
+    scheduler = LLMScheduler(create_llm(started, release), tokens_per_minute=10)
+
+    await scheduler.chat_completion([Message(role="user", content="x" * 32)])
+    over_budget = asyncio.create_task(
+        scheduler.chat_completion([Message(role="user", content="y" * 32)])
+    )
+    await asyncio.sleep(0.01)
+
+    # The first prompt's 8 tokens leave no room for another 8 within the minute.
+    assert started == ["x" * 32]
+    assert scheduler.stats()["llm_queue_depth"] == 1
+
+    over_budget.cancel()
+
+
+class Transient(Exception):
+    pass
+
+
+def retry_transient(error: BaseException) -> Optional[float]:
+    return 0.05 if isinstance(error, Transient) else None
+
+
+def create_retrying_llm(policy: RetryPolicy, requests: List[str]) -> Any:
+    """Fails each prompt's first request, and records the requests in flight."""
+
+    class RetryingLLM:
+        def __init__(self):
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        def stats(self) -> Dict[str, int]:
+            return {}
+
+        async def chat_completion(self, messages: List[Message]) -> Message:
+            content = messages[0].content
+
+            async def request() -> Message:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    requests.append(content)
+                    if requests.count(content) == 1:
+                        raise Transient()
+                    await asyncio.sleep(0.01)
+                    return messages[0]
+                finally:
+                    self.in_flight -= 1
+
+            return await policy.run("op", request, retry_transient)
+
+    return RetryingLLM()
+
+
+async def test_backoff_gives_up_the_slot():
+    requests: List[str] = []
+    policy = RetryPolicy(base_delay=0)
+    scheduler = LLMScheduler(create_retrying_llm(policy, requests), max_concurrency=1)
+
+    await asyncio.gather(
+        scheduler.chat_completion([Message(role="user", content="a")]),
+        scheduler.chat_completion([Message(role="user", content="b")]),
+    )
+    # "b" started while "a" waited to retry.
+    assert requests[:2] == ["a", "b"]
+    assert scheduler.stats()["llm_in_flight"] == 0
+
+
+async def test_hedges_need_a_slot():
+    policy = RetryPolicy(hedge=True, hedge_min_samples=1)
+    delays = [0.0, 0.1]
+    in_flight: List[int] = [0]
+    max_in_flight: List[int] = []
+
+    class HedgedLLM:
+        def stats(self) -> Dict[str, int]:
+            return {}
+
+        async def chat_completion(self, messages: List[Message]) -> Message:
+            async def request() -> Message:
+                in_flight[0] += 1
+                max_in_flight.append(in_flight[0])
+                try:
+                    await asyncio.sleep(delays.pop(0) if delays else 0)
+                    return messages[0]
+                finally:
+                    in_flight[0] -= 1
+
+            return await policy.run("op", request, retry_transient)
+
+    llm: Any = HedgedLLM()
+    scheduler = LLMScheduler(llm, max_concurrency=1)
+    for _ in range(2):
+        await scheduler.chat_completion([Message(role="user", content="a")])
+
+    # The slow request was hedged, but the call's own slot was the only one.
+    assert policy.stats()["llm_hedges"] == 1
+    assert max(max_in_flight) == 1
+    assert scheduler.stats()["llm_in_flight"] == 0
+
+
+async def test_closing_a_stream_frees_its_slot():
+    closed: List[bool] = []
+
+    class StreamingLLM:
+        def stats(self) -> Dict[str, int]:
+            return {}
+
+        async def stream_chat_completion(
+            self, messages: List[Message]
+        ) -> AsyncIterator[str]:
+            try:
+                for piece in ["a", "b", "c"]:
+                    yield piece
+            finally:
+                closed.append(True)
+
+    llm: Any = StreamingLLM()
+    scheduler = LLMScheduler(llm, max_concurrency=1)
+    stream: Any = scheduler.stream_chat_completion([Message(role="user", content="")])
+
+    assert await stream.__anext__() == "a"
+    assert scheduler.stats()["llm_in_flight"] == 1
+    await stream.aclose()
+    assert closed == [True]
+    assert scheduler.stats()["llm_in_flight"] == 0
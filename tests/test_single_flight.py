@@ -0,0 +1,103 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from llm.call_context import CallKind, call_kind
+from llm.single_flight import SingleFlight
+from schema import ActionCompletion, Message
+
+
+def no_stats() -> Dict[str, int]:
+    return {}
+
+
+class SlowLLM:
+    """Records the requests it gets, and answers them once released."""
+
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.embedded: List[List[str]] = []
+        self.rated: List[List[List[Message]]] = []
+        self.acted: List[List[Message]] = []
+        self.stats = no_stats
+
+    async def embed(self, query: str) -> List[float]:
+        return (await self.embed_batch([query]))[0]
+
+    async def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        self.embedded.append(queries)
+        await self.released.wait()
+        return [[float(len(query))] for query in queries]
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Dict[str, str]]
+    ) -> Optional[ActionCompletion]:
+        self.acted.append(messages)
+        await self.released.wait()
+        return ActionCompletion(action="Rate", args={})
+
+    async def digit_completions(self, query_messages: List[List[Message]]) -> List[int]:
+        self.rated.append(query_messages)
+        await self.released.wait()
+        if not query_messages[0]:
+            raise ValueError("Nothing to rate")
+        return [len(messages[0].content) for messages in query_messages]
+
+
+async def test_shares_in_flight_requests():
+    slow: Any = SlowLLM()
+    llm = SingleFlight(slow)
+
+    embeddings = asyncio.gather(
+        llm.embed("a"),
+        llm.embed_batch(["a", "bb", "bb"]),
+        llm.embed("ccc"),
+    )
+    await asyncio.sleep(0)
+    slow.released.set()
+    assert await embeddings == [[1.0], [[1.0], [2.0], [2.0]], [3.0]]
+    assert slow.embedded == [["a"], ["bb"], ["ccc"]]
+    assert llm.stats()["single_flight_embed_shared"] == 2
+
+    # Nothing is kept once done
+    await llm.embed("a")
+    assert slow.embedded[-1] == ["a"]
+
+
+async def test_shares_exceptions_and_survives_cancellation():
+    slow: Any = SlowLLM()
+    llm = SingleFlight(slow)
+
+    with call_kind(CallKind.IMPORTANCE):
+        first = asyncio.ensure_future(llm.digit_completions([[]]))
+        second = asyncio.ensure_future(llm.digit_completions([[]]))
+    await asyncio.sleep(0)
+    first.cancel()
+    slow.released.set()
+
+    with pytest.raises(ValueError):
+        await second
+    assert len(slow.rated) == 1
+    assert llm.stats()["single_flight_digit_completion_shared"] == 1
+
+
+async def test_only_shares_deterministic_kinds():
+    slow: Any = SlowLLM()
+    llm = SingleFlight(slow)
+    messages = [Message(role="user", content="Well?")]
+
+    async def act(kind: CallKind) -> Optional[ActionCompletion]:
+        with call_kind(kind):
+            return await llm.action_completion(messages, [])
+
+    acts = asyncio.gather(*[act(CallKind.ACT), act(CallKind.ACT)])
+    rates = asyncio.gather(*[act(CallKind.RATE), act(CallKind.RATE)])
+    await asyncio.sleep(0)
+    slow.released.set()
+    await acts
+    await rates
+
+    # Each act is sampled for its own caller
+    assert len(slow.acted) == 3
+    assert llm.stats()["single_flight_action_completion_shared"] == 1
@@ -1,6 +1,13 @@
+import asyncio
+import math
 import unittest
+from typing import Any, Dict, List, Literal
 
-from game.ti_retriever import TIRetriever
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from game.ti_retriever import TIRetriever, time_weighted_importance
 from schema import GameStage, Memory, MemoryConfig
 
 
@@ -74,7 +81,8 @@ def test_importance_retrieval():
 
     # First score is bigly_memory: embedding (10) + time weight (1) + importance (1/10)
     # First score is king_memory: embedding (1) + time weight (1) + importance (10/10)
-    unittest.TestCase().assertCountEqual(scores, [11.1, 3.0])
+    # Embeddings are stored as float32.
+    np.testing.assert_allclose(sorted(scores), [3.0, 11.1], rtol=1e-6)
 
 
 def test_many_memory_importance_retrieval():
@@ -145,4 +153,300 @@ def test_many_memory_importance_retrieval():
     unittest.TestCase().assertCountEqual(
         memories, [king_memory1, king_memory2, king_memory3]
     )
-    unittest.TestCase().assertCountEqual(scores, [3.0, 3.0, 3.0])
+    np.testing.assert_allclose(scores, [3.0, 3.0, 3.0], rtol=1e-6)
+
+
+def test_time_weighting_matches_reference():
+    ret = TIRetriever(MemoryConfig(embedding_dims=10))
+
+    memories: List[Memory] = []
+    for i in range(50):
+        memory = Memory(
+            importance=i % 10,
+            description=str(i),
+            embedding=[0.0] * 10,
+            timestamp=(
+                GameStage(stage=i % 3, major=i % 5, minor=i % 7) if i % 4 else None
+            ),
+        )
+        memories.append(memory)
+        ret.add_memory(memory)
+
+    query_memory = Memory(
+        description="gron",
+        embedding=[0.0] * 10,
+        timestamp=GameStage(stage=2, major=4, minor=6),
+    )
+
+    for memory, score in ret.get_relevant_memories(query_memory, len(memories)):
+        expected = memory.importance / 10 + time_weighted_importance(
+            query_memory.timestamp, memory
+        )
+        assert math.isclose(score, expected, rel_tol=1e-6)
+
+    # Without a query timestamp only importance counts
+    query_memory.timestamp = None
+    for memory, score in ret.get_relevant_memories(query_memory, len(memories)):
+        assert math.isclose(score, memory.importance / 10, rel_tol=1e-6)
+
+
+def test_eviction():
+    ret = TIRetriever(
+        MemoryConfig(embedding_dims=10, max_memories=20, eviction_fraction=0.25)
+    )
+
+    important_memories: List[Memory] = []
+    for i in range(100):
+        memory = Memory(
+            importance=10 if i % 10 == 0 else 1,
+            description=str(i),
+            embedding=[0.1] * 10,
+            timestamp=GameStage(stage=1, major=2, minor=3),
+        )
+        if memory.importance == 10:
+            important_memories.append(memory)
+        ret.add_memory(memory)
+
+        assert ret.stats.memories <= 20
+
+    # First eviction happens on the 21st memory, then every 5 after that
+    assert ret.stats.evictions == 16
+    assert ret.stats.evicted_memories == 80
+    assert ret.stats.memories == 20
+
+    query_memory = Memory(
+        importance=1,
+        description="gron",
+        embedding=[1.0] * 10,
+        timestamp=GameStage(stage=1, major=2, minor=3),
+    )
+    memories = [m for m, _ in ret.get_relevant_memories(query_memory, 10)]
+    unittest.TestCase().assertCountEqual(memories, important_memories)
+
+
+def test_eviction_prefers_recent_memories():
+    ret = TIRetriever(
+        MemoryConfig(embedding_dims=10, max_memories=10, eviction_fraction=0.5)
+    )
+
+    for stage in range(3):
+        for i in range(5):
+            ret.add_memory(
+                Memory(
+                    importance=5,
+                    description=f"{stage}.{i}",
+                    embedding=[0.1] * 10,
+                    timestamp=GameStage(stage=stage),
+                )
+            )
+
+    query_memory = Memory(description="gron", embedding=[1.0] * 10)
+    descriptions = [
+        m.description for m, _ in ret.get_relevant_memories(query_memory, 10)
+    ]
+    unittest.TestCase().assertCountEqual(
+        descriptions, [f"{stage}.{i}" for stage in (1, 2) for i in range(5)]
+    )
+
+
+def test_grouped_retrieval():
+    ret = TIRetriever(MemoryConfig(embedding_dims=2))
+
+    memories: List[Memory] = []
+    for i, embedding in enumerate([[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]]):
+        memories.append(Memory(importance=1, description=str(i), embedding=embedding))
+        ret.add_memory(memories[i])
+
+    x_query = Memory(description="x", embedding=[1.0, 0.0])
+    y_query = Memory(description="y", embedding=[0.0, 1.0])
+
+    groups = ret.get_relevant_memories_grouped([[x_query], [x_query, y_query], []], 2)
+
+    # Sorted from most to least relevant
+    assert [m for m, _ in groups[0]] == [memories[0], memories[2]]
+    np.testing.assert_allclose([s for _, s in groups[0]], [1.1, 0.8], rtol=1e-6)
+
+    # Memory 2 is never the best match for a single query
+    unittest.TestCase().assertCountEqual(
+        [m for m, _ in groups[1]], [memories[0], memories[1]]
+    )
+    assert groups[2] == []
+
+    # Same as querying each group on its own
+    for group, result in zip([[x_query], [x_query, y_query]], groups):
+        for query in group:
+            assert result[0][1] >= ret.get_relevant_memories(query, 1)[0][1]
+    y_result = ret.get_relevant_memories(y_query, 2)
+    assert [m for m, _ in y_result] == [memories[1], memories[2]]
+    np.testing.assert_allclose([s for _, s in y_result], [1.1, 0.8], rtol=1e-6)
+
+
+def test_embeddings_are_owned_by_retriever():
+    ret = TIRetriever(
+        MemoryConfig(embedding_dims=2, max_memories=4, eviction_fraction=0.5)
+    )
+
+    memories: List[Memory] = []
+    for i in range(5):
+        memory = Memory(importance=i + 1, description=str(i), embedding=[i, 1.0])
+        ret.add_memory(memory)
+        memories.append(memory)
+
+        assert memory.embedding is None
+        assert memory.embedding_row == ret.stats.memories - 1
+        assert ret.get_embedding(memory).dtype == np.float32
+
+    # Memories 0 and 1 were evicted, the rest were compacted to the front.
+    for row, memory in enumerate(memories[2:]):
+        assert memory.embedding_row == row
+        assert list(ret.get_embedding(memory)) == [float(row + 2), 1.0]
+
+    with pytest.raises(ValueError):
+        ret.get_embedding(memories[0])
+
+
+def _recall_against_float64(embedding_dtype: Literal["float32", "int8"]) -> float:
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((2000, 64))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = rng.standard_normal((20, 64))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    # Large enough that nothing is evicted, so only the embeddings differ
+    exact = TIRetriever(
+        MemoryConfig(embedding_dims=64, max_memories=2000, embedding_dtype="float64")
+    )
+    compact = TIRetriever(
+        MemoryConfig(
+            embedding_dims=64, max_memories=2000, embedding_dtype=embedding_dtype
+        )
+    )
+    for i, embedding in enumerate(embeddings):
+        for ret in (exact, compact):
+            ret.add_memory(
+                Memory(importance=5, description=str(i), embedding=list(embedding))
+            )
+
+    hits = 0
+    for query in queries:
+        expected = {
+            m.description
+            for m, _ in exact.get_relevant_memories(
+                Memory(description="q", embedding=list(query)), 10
+            )
+        }
+        hits += len(
+            expected
+            & {
+                m.description
+                for m, _ in compact.get_relevant_memories(
+                    Memory(description="q", embedding=list(query)), 10
+                )
+            }
+        )
+    assert exact.stats.evictions == compact.stats.evictions == 0
+    return hits / (10 * len(queries))
+
+
+def test_float32_recall():
+    assert _recall_against_float64("float32") == 1.0
+
+
+def test_int8_recall():
+    assert _recall_against_float64("int8") >= 0.9
+
+
+def test_int8_scores():
+    ret = TIRetriever(MemoryConfig(embedding_dims=3, embedding_dtype="int8"))
+    memory = Memory(importance=10, description="x", embedding=[0.5, -0.25, 0.1])
+    ret.add_memory(memory)
+
+    np.testing.assert_allclose(
+        ret.get_embedding(memory), [0.5, -0.25, 0.1], atol=0.5 / 127
+    )
+    (_, score), *_ = ret.get_relevant_memories(
+        Memory(description="q", embedding=[1.0, 1.0, 1.0]), 1
+    )
+    assert math.isclose(score, 0.35 + 1, abs_tol=1.5 / 127)
+
+
+def test_ivf_recall():
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((32, 32))
+    embeddings = centers[rng.choice(32, 3000)]
+    embeddings += 0.2 * rng.standard_normal(embeddings.shape)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    exact = TIRetriever(MemoryConfig(embedding_dims=32, max_memories=4096))
+    ivf = TIRetriever(
+        MemoryConfig(
+            embedding_dims=32,
+            max_memories=4096,
+            index="ivf",
+            ivf_lists=32,
+            ivf_probes=4,
+            ivf_train_size=1000,
+        )
+    )
+    for i, embedding in enumerate(embeddings):
+        for ret in (exact, ivf):
+            ret.add_memory(
+                Memory(importance=i % 10, description=str(i), embedding=list(embedding))
+            )
+
+    hits = 0
+    for query in embeddings[rng.choice(3000, 20)]:
+        query_memory = Memory(description="q", embedding=list(query))
+        expected = exact.get_relevant_memories(query_memory, 10)
+        actual = ivf.get_relevant_memories(query_memory, 10)
+        hits += len(
+            {m.description for m, _ in expected} & {m.description for m, _ in actual}
+        )
+
+        # Candidates are reranked with the same scores as the exact scan
+        scores = {m.description: s for m, s in expected}
+        for memory, score in actual:
+            if memory.description in scores:
+                assert math.isclose(score, scores[memory.description], rel_tol=1e-6)
+
+    assert hits / 200 >= 0.9
+
+
+async def test_ivf_trains_in_thread():
+    config = MemoryConfig(
+        embedding_dims=2, index="ivf", ivf_lists=2, ivf_probes=1, ivf_train_size=4
+    )
+    ret = TIRetriever(config)
+    for embedding in ([1.0, 0.0], [0.0, 1.0], [1.0, 0.1], [0.1, 1.0]):
+        ret.add_memory(Memory(description="", embedding=embedding), train_index=False)
+    assert not ret._index.trained  # type: ignore
+
+    training = asyncio.ensure_future(ret.train_index_in_thread())
+    await asyncio.sleep(0)
+    # Memories added while it trains are assigned once it's done
+    ret.add_memory(Memory(description="", embedding=[1.0, 0.2]), train_index=False)
+    await training
+
+    assert ret._index.trained  # type: ignore
+    query = Memory(description="", embedding=[1.0, 0.1])
+    assert len(ret.get_relevant_memories(query, 5)) == 3
+
+
+@pytest.mark.parametrize(
+    "invalid",
+    [
+        dict(max_memories=0),
+        dict(eviction_fraction=0),
+        dict(eviction_fraction=1.5),
+        dict(embedding_dims=0),
+        dict(embedding_dtype="float16"),
+        dict(ivf_lists=0),
+        dict(ivf_lists=4, ivf_probes=8),
+        dict(ivf_train_size=0),
+        # The defaults would never train the index
+        dict(index="ivf"),
+    ],
+)
+def test_memory_config_validation(invalid: Dict[str, Any]):
+    with pytest.raises(ValidationError):
+        MemoryConfig.parse_obj({"embedding_dims": 8, **invalid})